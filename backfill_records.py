@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+レコード補完スクリプト
+レコード一覧API（GET /api/records）の絞り込みに必要なフィールドを既存レコードに追加する
+
+  - exported がないレコード → exported: False（未出力）
+  - source がないレコード   → source: "web"
+
+Firestoreの一致条件は、フィールドが存在しないドキュメントには一致しないため、
+この補完を行うまで古いレコードは exported=false / source=web の絞り込みに含まれない。
+
+実行方法:
+    python backfill_records.py [--dry-run]
+
+注意:
+    - 既に値があるフィールドは変更しない（何度実行しても結果は同じ）
+"""
+
+import sys
+from google.cloud import firestore
+from dotenv import load_dotenv
+
+load_dotenv()
+
+db = firestore.Client()
+
+COL_USERS = "users"
+BATCH_SIZE = 400  # 1回のバッチ書き込みの件数（Firestoreの上限は500）
+
+DEFAULTS = {
+    "exported": False,
+    "source": "web",
+}
+
+
+def backfill_records(dry_run: bool = False):
+    """全ユーザーのレコードに不足しているフィールドを追加"""
+    print("=" * 60)
+    print("レコード補完スクリプト" + ("（確認のみ）" if dry_run else ""))
+    print("=" * 60)
+
+    total_checked = 0
+    total_updated = 0
+
+    for user_doc in db.collection(COL_USERS).stream():
+        records_ref = db.collection(COL_USERS).document(user_doc.id).collection("records")
+        batch = db.batch()
+        pending = 0
+        updated = 0
+
+        for record in records_ref.stream():
+            total_checked += 1
+            data = record.to_dict()
+            missing = {field: value for field, value in DEFAULTS.items() if field not in data}
+            if not missing:
+                continue
+
+            updated += 1
+            if dry_run:
+                continue
+            batch.update(record.reference, missing)
+            pending += 1
+            if pending >= BATCH_SIZE:
+                batch.commit()
+                batch = db.batch()
+                pending = 0
+
+        if pending:
+            batch.commit()
+        if updated:
+            print(f"✅ {user_doc.id}: {updated}件{'（未更新）' if dry_run else ''}")
+        total_updated += updated
+
+    print("\n📊 結果:")
+    print(f"  - 確認: {total_checked}件")
+    print(f"  - 補完{'対象' if dry_run else ''}: {total_updated}件")
+
+
+if __name__ == "__main__":
+    try:
+        backfill_records(dry_run="--dry-run" in sys.argv[1:])
+    except KeyboardInterrupt:
+        print("\n\n❌ 補完が中断されました")
+    except Exception as e:
+        print(f"\n\n❌ 予期しないエラーが発生しました: {str(e)}")
+        import traceback
+        traceback.print_exc()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Firestore呼び出しの同時リクエスト処理性能ベンチマーク
+
+async def ハンドラー内で同期Firestore呼び出しを直接行う場合（変更前）と、
+utils.executors.run_db 経由でスレッドプールに逃がす場合（変更後）の
+スループットを比較する。Firestoreの往復はブロッキングsleepで模擬する。
+
+実行方法:
+    python benchmarks/bench_db_concurrency.py [--requests 200] [--latency-ms 30] [--calls 3]
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.executors import run_db, shutdown_executors
+
+
+def fake_firestore_call(latency: float):
+    """Firestoreの1往復を模擬（gRPC呼び出しと同様にスレッドをブロック）"""
+    time.sleep(latency)
+    return {"ok": True}
+
+
+async def handler_blocking(latency: float, calls: int):
+    """変更前: イベントループ上で直接呼び出す"""
+    for _ in range(calls):
+        fake_firestore_call(latency)
+
+
+async def handler_executor(latency: float, calls: int):
+    """変更後: DB用スレッドプールで実行する"""
+    for _ in range(calls):
+        await run_db(fake_firestore_call, latency)
+
+
+async def run_load(handler, requests: int, latency: float, calls: int) -> dict:
+    """同時リクエストを発行して所要時間とレイテンシ（一斉到着からの応答時間）を計測"""
+    latencies = []
+
+    async def one_request():
+        await handler(latency, calls)
+        latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one_request() for _ in range(requests)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "elapsed": elapsed,
+        "rps": requests / elapsed,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Firestore呼び出しの同時処理ベンチマーク")
+    parser.add_argument("--requests", type=int, default=200, help="同時リクエスト数")
+    parser.add_argument("--latency-ms", type=float, default=30, help="Firestore 1往復の模擬レイテンシ（ミリ秒）")
+    parser.add_argument("--calls", type=int, default=3, help="1リクエストあたりのFirestore呼び出し回数")
+    args = parser.parse_args()
+
+    latency = args.latency_ms / 1000
+    print(f"requests={args.requests} latency={args.latency_ms}ms calls/request={args.calls}")
+    print("-" * 60)
+
+    for label, handler in (("before (direct)", handler_blocking), ("after (run_db)", handler_executor)):
+        result = asyncio.run(run_load(handler, args.requests, latency, args.calls))
+        print(
+            f"{label:<16} elapsed={result['elapsed']:.2f}s rps={result['rps']:.1f} "
+            f"p50={result['p50_ms']:.0f}ms p99={result['p99_ms']:.0f}ms"
+        )
+
+    shutdown_executors()
+
+
+if __name__ == "__main__":
+    main()
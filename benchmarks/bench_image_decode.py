@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+画像圧縮のデコード方式ベンチマーク
+
+全画素をデコードしてから縮小する従来の方式（legacy）と、
+JPEGの縮小デコード（draft）+ reduce を使う compress_image（current）を、
+サンプル領収書画像のコーパスに対して比較する。
+方式ごとに別プロセスで実行し、1枚あたりのCPU時間とプロセスの最大RSSを計測する。
+
+実行方法:
+    python benchmarks/bench_image_decode.py [--corpus DIR] [--repeat 3]
+    （--corpus を省略すると 12MP / 48MP の合成画像を生成して使う）
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+
+def legacy_compress(input_path: str, output_path: str, max_size: tuple = (1920, 1080), quality: int = 85):
+    """変更前の compress_image（全画素デコード → thumbnail）"""
+    from PIL import Image, ImageOps
+    with Image.open(input_path) as img:
+        img = ImageOps.exif_transpose(img)
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        img.thumbnail(max_size, Image.Resampling.LANCZOS)
+        img.save(output_path, 'JPEG', optimize=True, quality=quality)
+
+
+def current_compress(input_path: str, output_path: str):
+    from services.image_service import compress_image
+    compress_image(input_path, output_path)
+
+
+def make_synthetic_corpus(directory: str) -> list:
+    """スマートフォンで撮影した領収書を模した画像を生成（白地に文字行相当の黒い線）"""
+    from PIL import Image, ImageDraw
+    paths = []
+    for label, size in (("12mp", (3024, 4032)), ("48mp", (6000, 8000))):
+        img = Image.new("RGB", size, (236, 232, 226))
+        draw = ImageDraw.Draw(img)
+        margin = size[0] // 6
+        for y in range(margin, size[1] - margin, size[1] // 60):
+            draw.rectangle((margin, y, size[0] - margin - (y * 7) % (size[0] // 3), y + size[1] // 180), fill=(30, 30, 30))
+        noise = Image.effect_noise(size, 12).convert("RGB")
+        img = Image.blend(img, noise, 0.08)
+        path = os.path.join(directory, f"receipt_{label}.jpg")
+        img.save(path, "JPEG", quality=92)
+        paths.append(path)
+    return paths
+
+
+def _peak_rss_mb() -> float:
+    """プロセスの最大RSS（MB）。execで引き継がれない /proc の VmHWM を優先する"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _measure(variant: str, paths: list, repeat: int, workdir: str, queue):
+    """子プロセスで1方式を計測（RSSはプロセス内の最大値）"""
+    import io
+    import contextlib
+    from PIL import Image
+    func = legacy_compress if variant == "legacy" else current_compress
+    # モジュール読み込み分を除いた増分を見るため、小さい画像で一度実行してからRSSを記録
+    warmup = os.path.join(workdir, f"warmup_{variant}.jpg")
+    Image.new("RGB", (64, 64)).save(warmup, "JPEG")
+    with contextlib.redirect_stdout(io.StringIO()):
+        func(warmup, warmup)
+    baseline_mb = _peak_rss_mb()
+
+    results = {}
+    for path in paths:
+        cpu_times = []
+        for i in range(repeat):
+            output = os.path.join(workdir, f"{variant}_{i}.jpg")
+            started = time.process_time()
+            with contextlib.redirect_stdout(io.StringIO()):
+                func(path, output)
+            cpu_times.append(time.process_time() - started)
+        results[os.path.basename(path)] = {
+            "cpu_ms": min(cpu_times) * 1000,
+            "output_kb": os.path.getsize(output) / 1024,
+        }
+    queue.put({"images": results, "baseline_mb": baseline_mb, "peak_mb": _peak_rss_mb()})
+
+
+def run_variant(variant: str, paths: list, repeat: int, workdir: str) -> dict:
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=_measure, args=(variant, paths, repeat, workdir, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="画像デコード方式のベンチマーク")
+    parser.add_argument("--corpus", help="サンプル画像のディレクトリ（省略時は合成画像）")
+    parser.add_argument("--repeat", type=int, default=3, help="1枚あたりの試行回数（最小値を採用）")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_decode_")
+    try:
+        if args.corpus:
+            paths = sorted(
+                os.path.join(args.corpus, name) for name in os.listdir(args.corpus)
+                if name.lower().endswith(IMAGE_EXTENSIONS)
+            )
+        else:
+            paths = make_synthetic_corpus(workdir)
+        if not paths:
+            print("画像が見つかりません")
+            return
+
+        print(f"images={len(paths)} repeat={args.repeat}")
+        print("-" * 72)
+        summary = {variant: run_variant(variant, paths, args.repeat, workdir) for variant in ("legacy", "current")}
+
+        for path in paths:
+            name = os.path.basename(path)
+            legacy = summary["legacy"]["images"][name]
+            current = summary["current"]["images"][name]
+            print(
+                f"{name:<28} legacy={legacy['cpu_ms']:.0f}ms current={current['cpu_ms']:.0f}ms "
+                f"({legacy['cpu_ms'] / current['cpu_ms']:.1f}x) output={legacy['output_kb']:.0f}KB/{current['output_kb']:.0f}KB"
+            )
+        for variant in ("legacy", "current"):
+            s = summary[variant]
+            print(f"{variant:<8} peak RSS={s['peak_mb']:.0f}MB (increase over warmup {s['peak_mb'] - s['baseline_mb']:.0f}MB)")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+画像圧縮の実行場所による同時リクエスト処理性能ベンチマーク
+
+アップロード（compress_image）と軽い読み取りリクエストを同時に流し、
+  - direct : async def ハンドラー内で直接圧縮（変更前）
+  - thread : asyncio.to_thread で圧縮（GILを取り合う）
+  - process: utils.executors.run_image でプロセスプールに逃がす（変更後）
+の全体スループットと読み取りリクエストのレイテンシを比較する。
+
+実行方法:
+    python benchmarks/bench_image_executor.py [--uploads 16] [--reads 400] [--size 3000x4000]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+from services.image_service import compress_image
+from utils.executors import run_image, get_image_executor, shutdown_executors
+import config
+
+RECORDS = [
+    {"id": str(1700000000000 + i), "date": "2025-04-01", "vendor_name": "テスト店舗", "total_amount": 1200 + i}
+    for i in range(200)
+]
+
+
+def make_sample_photo(path: str, size: tuple):
+    """スマートフォン写真相当のJPEGを生成（ノイズ入りで圧縮が軽くなりすぎないように）"""
+    noise = Image.effect_noise(size, 64).convert("RGB")
+    noise.save(path, "JPEG", quality=95)
+
+
+def read_request():
+    """読み取りリクエストを模擬（レコード一覧のJSON化）"""
+    return json.dumps(RECORDS, ensure_ascii=False)
+
+
+async def upload_direct(src: str, dst: str):
+    compress_image(src, dst)
+
+
+async def upload_thread(src: str, dst: str):
+    await asyncio.to_thread(compress_image, src, dst)
+
+
+async def upload_process(src: str, dst: str):
+    await run_image(compress_image, src, dst)
+
+
+async def run_load(upload, sample: str, workdir: str, uploads: int, reads: int) -> dict:
+    """アップロードと読み取りを同時に発行して計測"""
+    read_latencies = []
+
+    async def one_upload(i: int):
+        await upload(sample, os.path.join(workdir, f"out_{i}.jpg"))
+
+    async def one_read(i: int):
+        # 読み取りは一定間隔で到着させ、到着予定時刻からの応答時間を計測する（イベントループの詰まりを含む）
+        arrival = started + i * 0.005
+        await asyncio.sleep(max(0, arrival - time.perf_counter()))
+        read_request()
+        read_latencies.append(time.perf_counter() - arrival)
+
+    started = time.perf_counter()
+    await asyncio.gather(
+        *(one_upload(i) for i in range(uploads)),
+        *(one_read(i) for i in range(reads))
+    )
+    elapsed = time.perf_counter() - started
+
+    read_latencies.sort()
+    return {
+        "elapsed": elapsed,
+        "rps": (uploads + reads) / elapsed,
+        "read_p50_ms": read_latencies[len(read_latencies) // 2] * 1000,
+        "read_p99_ms": read_latencies[int(len(read_latencies) * 0.99) - 1] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="画像圧縮の実行場所ベンチマーク")
+    parser.add_argument("--uploads", type=int, default=16, help="同時アップロード数")
+    parser.add_argument("--reads", type=int, default=400, help="読み取りリクエスト数")
+    parser.add_argument("--size", default="3000x4000", help="サンプル画像サイズ（幅x高さ）")
+    args = parser.parse_args()
+
+    width, height = (int(v) for v in args.size.split("x"))
+    workdir = tempfile.mkdtemp(prefix="bench_image_")
+    sample = os.path.join(workdir, "sample.jpg")
+    make_sample_photo(sample, (width, height))
+
+    print(f"uploads={args.uploads} reads={args.reads} size={args.size} cpus={os.cpu_count()}")
+    print("-" * 72)
+
+    # プロセスの起動時間は計測に含めない（常駐サーバーでは起動時に一度だけ発生する）
+    pool = get_image_executor()
+    for future in [pool.submit(os.getpid) for _ in range(config.IMAGE_EXECUTOR_WORKERS)]:
+        future.result()
+
+    try:
+        for label, upload in (("direct", upload_direct), ("thread", upload_thread), ("process", upload_process)):
+            result = asyncio.run(run_load(upload, sample, workdir, args.uploads, args.reads))
+            print(
+                f"{label:<8} elapsed={result['elapsed']:.2f}s rps={result['rps']:.1f} "
+                f"read_p50={result['read_p50_ms']:.1f}ms read_p99={result['read_p99_ms']:.1f}ms"
+            )
+    finally:
+        shutdown_executors()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+解析前処理（領収書部分の切り抜き・傾き補正・コントラスト調整）のベンチマーク
+
+圧縮済みの画像（保存用）と prepare_for_analysis で作成した解析用コピーを比べ、
+Geminiに送るバイト数と前処理に掛かる時間を計測する。
+--gemini を付けると両方の画像を実際にGeminiで解析し、応答時間も比較する（APIキーが必要・課金対象）。
+
+実行方法:
+    python benchmarks/bench_image_preprocess.py [--corpus DIR] [--gemini] [--plan free]
+    （--corpus を省略すると机の上で撮影した領収書を模した合成画像を使う）
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+
+def make_synthetic_corpus(directory: str) -> list:
+    """机（暗い背景）の上に少し傾いた白いレシートを置いた写真を模した画像を生成"""
+    from PIL import Image, ImageDraw
+    paths = []
+    for i, angle in enumerate((0, 4, -3, 7)):
+        receipt = Image.new("RGB", (520, 1150), (245, 243, 238))
+        draw = ImageDraw.Draw(receipt)
+        for y in range(60, 1080, 34):
+            draw.rectangle((40, y, 80 + (y * 37) % 400, y + 10), fill=(40, 40, 40))
+        receipt = receipt.rotate(angle, expand=True, fillcolor=(95, 72, 52))
+
+        photo = Image.new("RGB", (1440, 1920), (95, 72, 52))
+        photo = Image.blend(photo, Image.effect_noise(photo.size, 30).convert("RGB"), 0.1)
+        photo.paste(receipt, (300 + i * 80, 300 + i * 60))
+        path = os.path.join(directory, f"desk_{i}.jpg")
+        photo.save(path, "JPEG", quality=90)
+        paths.append(path)
+    return paths
+
+
+def time_gemini(path: str, plan: str) -> float:
+    """1枚の解析に掛かった時間（ミリ秒）"""
+    from services.gemini_service import analyze_with_gemini_retry
+    started = time.perf_counter()
+    analyze_with_gemini_retry(path, max_retries=1, plan=plan)
+    return (time.perf_counter() - started) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="解析前処理のベンチマーク")
+    parser.add_argument("--corpus", help="サンプル画像のディレクトリ（省略時は合成画像）")
+    parser.add_argument("--gemini", action="store_true", help="Geminiでの解析時間も計測する")
+    parser.add_argument("--plan", default="free", help="解析に使うプラン（モデル選択）")
+    args = parser.parse_args()
+
+    # 同じ画像の解析結果を再利用しないようにする（応答時間の比較のため）
+    os.environ["ANALYSIS_CACHE_ENABLED"] = "0"
+    from services.image_service import compress_image, prepare_for_analysis
+
+    workdir = tempfile.mkdtemp(prefix="bench_preprocess_")
+    try:
+        if args.corpus:
+            sources = sorted(
+                os.path.join(args.corpus, name) for name in os.listdir(args.corpus)
+                if name.lower().endswith(IMAGE_EXTENSIONS)
+            )
+        else:
+            sources = make_synthetic_corpus(workdir)
+        if not sources:
+            print("画像が見つかりません")
+            return
+
+        print(f"images={len(sources)} gemini={'on' if args.gemini else 'off'}")
+        print("-" * 72)
+        rows = []
+        for i, source in enumerate(sources):
+            stored = compress_image(source, os.path.join(workdir, f"stored_{i}.jpg"))
+            stats = prepare_for_analysis(stored)
+            row = {
+                "name": os.path.basename(source),
+                "stored_kb": os.path.getsize(stored) / 1024,
+                "sent_kb": os.path.getsize(stats["path"]) / 1024,
+                "prep_ms": stats.get("ms", 0.0),
+                "applied": not stats.get("skipped", True),
+            }
+            if args.gemini:
+                row["gemini_full_ms"] = time_gemini(stored, args.plan)
+                row["gemini_prepared_ms"] = time_gemini(stats["path"], args.plan) if row["applied"] else row["gemini_full_ms"]
+            rows.append(row)
+
+            line = (
+                f"{row['name']:<24} {row['stored_kb']:.0f}KB -> {row['sent_kb']:.0f}KB "
+                f"prep={row['prep_ms']:.0f}ms applied={row['applied']}"
+            )
+            if args.gemini:
+                line += f" gemini={row['gemini_full_ms']:.0f}ms -> {row['gemini_prepared_ms']:.0f}ms"
+            print(line)
+
+        print("-" * 72)
+        stored_total = sum(r["stored_kb"] for r in rows)
+        sent_total = sum(r["sent_kb"] for r in rows)
+        print(f"bytes sent: {stored_total:.0f}KB -> {sent_total:.0f}KB ({(1 - sent_total / stored_total) * 100:.0f}% less)")
+        print(f"preprocess median: {statistics.median(r['prep_ms'] for r in rows):.0f}ms")
+        if args.gemini:
+            print(
+                f"gemini median: {statistics.median(r['gemini_full_ms'] for r in rows):.0f}ms -> "
+                f"{statistics.median(r['gemini_prepared_ms'] for r in rows):.0f}ms"
+            )
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
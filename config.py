@@ -24,14 +24,136 @@ BUCKET_NAME = "fujishima-receipt-storage"
 # === Firestore コレクション名 ===
 COL_USERS = "users"
 COL_LINE_TOKENS = "line_tokens"
+COL_UPLOAD_JOBS = "upload_jobs"
+COL_ANALYSIS_CACHE = "analysis_cache"
+COL_RECORD_AGGREGATES = "record_aggregates"  # ユーザーごとのレコード集計（ドキュメントID = ユーザーID）
+COL_EXPORT_MANIFESTS = "export_manifests"  # Excel出力に含めたレコードIDの控え（出力済みマーク用）
 
 # === ディレクトリ設定 ===
 UPLOAD_DIR = "uploads"
 FONT_DIR = "fonts"
 
+# === 画像処理設定 ===
+IMAGE_MAX_PIXELS = int(os.getenv("IMAGE_MAX_PIXELS", str(100_000_000)))  # これを超える画像は解凍爆弾として拒否
+IMAGE_REDUCING_GAP = 2.0  # reduce で縮小した後も最終サイズの何倍の解像度を残すか（LANCZOSでの仕上げ用）
+IMAGE_OUTPUT_FORMAT = os.getenv("IMAGE_OUTPUT_FORMAT", "jpeg")  # jpeg / webp（保存・Gemini送信用の形式）
+IMAGE_BYTE_BUDGET = int(os.getenv("IMAGE_BYTE_BUDGET", str(400 * 1024)))  # 1枚あたりの目標バイト数
+IMAGE_MIN_QUALITY = int(os.getenv("IMAGE_MIN_QUALITY", "55"))  # 予算に合わせて下げる画質の下限
+IMAGE_MIN_TEXT_LONG_SIDE_PX = int(os.getenv("IMAGE_MIN_TEXT_LONG_SIDE_PX", "1280"))  # 文字が判読できる長辺の下限
+IMAGE_GRAYSCALE_AUTO = os.getenv("IMAGE_GRAYSCALE_AUTO", "1") == "1"  # 無彩色の画像はグレースケールで保存
+IMAGE_GRAYSCALE_SATURATION = 20  # 平均彩度（0〜255）がこれ未満なら無彩色とみなす
+IMAGE_PREPROCESS_ENABLED = os.getenv("IMAGE_PREPROCESS_ENABLED", "1") == "1"  # 解析用コピーの切り抜き・傾き補正・コントラスト調整
+IMAGE_CROP_MIN_AREA = 0.08  # 検出した領域が画像全体のこの割合未満なら誤検出とみなして切り抜かない
+IMAGE_CROP_MAX_AREA = 0.85  # 検出した領域がこの割合を超える場合は切り抜かない（削減効果が小さい）
+IMAGE_DESKEW_MAX_ANGLE = float(os.getenv("IMAGE_DESKEW_MAX_ANGLE", "10"))  # 傾き補正で探索する最大角度（度）
+IMAGE_LOW_CONTRAST_SPREAD = 160  # 明るさの1〜99%点の幅がこれ未満なら低コントラストとみなして補正する
+IMAGE_EXECUTOR_WORKERS = int(os.getenv("IMAGE_EXECUTOR_WORKERS", str(max(2, min(4, os.cpu_count() or 2)))))  # 画像処理用プロセス数
+PDF_MAX_PAGES = int(os.getenv("PDF_MAX_PAGES", "30"))  # 画像化するページ数の上限
+PDF_PAGE_CONCURRENCY = int(os.getenv("PDF_PAGE_CONCURRENCY", "4"))  # 同時に描画・アップロードするページ数（メモリ上限の目安）
+PDF_RENDER_DPI = int(os.getenv("PDF_RENDER_DPI", "150"))
+PDF_RENDER_MANY_PAGES = int(os.getenv("PDF_RENDER_MANY_PAGES", "10"))  # これを超えるページ数のPDFは低いDPIで描画
+PDF_RENDER_MANY_PAGES_DPI = int(os.getenv("PDF_RENDER_MANY_PAGES_DPI", "100"))
+PDF_RENDER_MAX_SIDE_PX = int(os.getenv("PDF_RENDER_MAX_SIDE_PX", "2000"))  # 描画後の長辺の上限（大判ページ対策）
+PDF_RENDER_JPEG_QUALITY = 85
+
+# === データベース設定 ===
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", "32"))  # Firestore呼び出し用スレッド数
+RECORDS_PAGE_SIZE = 50  # レコード一覧APIの1ページあたりの既定件数
+RECORDS_MAX_PAGE_SIZE = 200  # レコード一覧APIで指定できる1ページあたりの最大件数
+
+# === アップロード処理設定 ===
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", "4"))  # 1リクエスト内の同時処理ファイル数
+
+# === 非同期アップロードジョブ設定 ===
+# firestore: Firestoreに保存（複数インスタンスのどこに進捗確認が届いても参照できる）/ local: プロセス内メモリ（1インスタンス・開発用）
+# ※ 解析はレスポンス返却後にバックグラウンドで続くため、Cloud Run では CPU を常時割り当てる（deploy.yml の --no-cpu-throttling）
+JOB_BACKEND = os.getenv("JOB_BACKEND", "firestore")
+# 完了済みジョブの保持時間（local: この時間を過ぎたら破棄 / firestore: TTLポリシー用の expires_at を最終更新からこの時間後に設定）
+JOB_RETENTION_SECONDS = 60 * 60
+# Excel出力の控え（出力したレコードID）の保持時間。TTLポリシー用の expires_at を作成からこの時間後に設定
+EXPORT_MANIFEST_RETENTION_SECONDS = 60 * 60
+
+# === Gemini リクエスト設定 ===
+# ファイルをFiles APIを使わずリクエストに直接含める場合のリクエスト全体の上限（base64化後のファイル + プロンプト）
+# APIの上限は20MB。見積もりの誤差に備えて少し余裕を残す（超える場合はFiles API、まとめて解析する場合は1件ずつに切り替え）
+GEMINI_REQUEST_MAX_BYTES = int(os.getenv("GEMINI_REQUEST_MAX_BYTES", str(18 * 1024 * 1024)))
+# Files APIでアップロードした場合の所要時間（アップロード + 処理待ち）の目安。インライン送信で短縮した時間の見積もりに使う
+# （大きなファイル以外はFiles APIを使わないため実測が少ない。実測が十分あればその中央値を使う）
+GEMINI_FILES_API_BASELINE_MS = float(os.getenv("GEMINI_FILES_API_BASELINE_MS", "2000"))
+# プロンプトのコンテキストキャッシュ（remote: Gemini側にキャッシュ / local: オフライン用スタブ / off: 無効）
+# 現在のプロンプトはキャッシュの最小トークン数に届かないため既定は off（プロンプトを大きくした場合に remote を指定）
+GEMINI_CONTEXT_CACHE = os.getenv("GEMINI_CONTEXT_CACHE", "off")
+# コンテキストキャッシュを作成できる最小トークン数（これ未満のプロンプトは作成を試みない。モデルによってはより大きい）
+GEMINI_CONTEXT_CACHE_MIN_TOKENS = int(os.getenv("GEMINI_CONTEXT_CACHE_MIN_TOKENS", "1024"))
+GEMINI_CONTEXT_CACHE_TTL_SECONDS = int(os.getenv("GEMINI_CONTEXT_CACHE_TTL_SECONDS", "3600"))
+
+# === 解析結果キャッシュ設定 ===
+ANALYSIS_CACHE_ENABLED = os.getenv("ANALYSIS_CACHE_ENABLED", "1") == "1"
+ANALYSIS_CACHE_MEMORY_SIZE = int(os.getenv("ANALYSIS_CACHE_MEMORY_SIZE", "512"))  # メモリLRUの最大件数
+# Firestoreに保存した結果の保持期間（TTLポリシー用の expires_at を保存からこの時間後に設定）
+ANALYSIS_CACHE_RETENTION_SECONDS = int(os.getenv("ANALYSIS_CACHE_RETENTION_SECONDS", str(30 * 24 * 60 * 60)))
+
+# === レコードキャッシュ設定 ===
+# エクスポートのたびに全レコードを読み直さないよう、ユーザーごとのレコード一覧をメモリに保持する
+RECORD_CACHE_LISTEN = os.getenv("RECORD_CACHE_LISTEN", "0") == "1"  # 集計ドキュメントの変更を監視し、他インスタンスの更新で即座に破棄
+# 監視なしで有効にすると、他インスタンスの更新は RECORD_CACHE_TTL_SECONDS まで反映されない（既定は監視する場合のみ有効）
+RECORD_CACHE_ENABLED = os.getenv("RECORD_CACHE_ENABLED", "1" if RECORD_CACHE_LISTEN else "0") == "1"
+RECORD_CACHE_MAX_USERS = int(os.getenv("RECORD_CACHE_MAX_USERS", "200"))  # 保持するユーザー数の上限（LRU）
+RECORD_CACHE_MAX_RECORDS = int(os.getenv("RECORD_CACHE_MAX_RECORDS", "5000"))  # これより多いユーザーはキャッシュしない
+RECORD_CACHE_TTL_SECONDS = int(os.getenv("RECORD_CACHE_TTL_SECONDS", "300"))  # 保持期間（他インスタンスの更新を反映するまでの最大時間）
+
+# === Gemini モデル設定 ===
+# まず高速モデルで解析し、検証に失敗した場合のみ高精度モデルで再解析する（プランごとに PLANS で上書き可）
+GEMINI_FAST_MODEL = os.getenv("GEMINI_FAST_MODEL", "gemini-2.5-flash")
+GEMINI_PRO_MODEL = os.getenv("GEMINI_PRO_MODEL", "gemini-2.5-pro")
+GEMINI_ESCALATION_CONFIDENCE = float(os.getenv("GEMINI_ESCALATION_CONFIDENCE", "0.7"))  # これ未満は高精度モデルへ
+GEMINI_BATCH_SIZE = int(os.getenv("GEMINI_BATCH_SIZE", "5"))  # 複数アップロード時に1リクエストにまとめる画像数（1で無効）
+
+# === 解析スケジューラー設定 ===
+# Gemini解析を同時に実行する枠数（ユーザー間で PLANS の weight に応じて公平に配分）
+ANALYSIS_SLOTS = int(os.getenv("ANALYSIS_SLOTS", "8"))
+# LINE・1ファイルのアップロード（interactive）専用に空けておく枠数（複数ファイルのアップロードは残りの枠で処理）
+ANALYSIS_INTERACTIVE_RESERVED_SLOTS = int(os.getenv("ANALYSIS_INTERACTIVE_RESERVED_SLOTS", "2"))
+# 複数ファイルのアップロード（bulk）が待機しているとき、interactive に渡さず bulk 用に残す枠数（interactive が続いても bulk が止まらない）
+ANALYSIS_BULK_RESERVED_SLOTS = int(os.getenv("ANALYSIS_BULK_RESERVED_SLOTS", "1"))
+LINE_WEBHOOK_WORKERS = int(os.getenv("LINE_WEBHOOK_WORKERS", "8"))  # LINE Webhook処理用スレッド数（解析枠の待機中もスレッドを占有する）
+INTERACTIVE_LATENCY_TARGET_MS = float(os.getenv("INTERACTIVE_LATENCY_TARGET_MS", "15000"))  # 投入から完了までの目標
+
+# === PDFテキスト抽出設定 ===
+# テキストレイヤーのあるPDFは、ファイルの代わりに抽出したテキストをGeminiに送る（品質不足ならファイルで解析）
+PDF_TEXT_FAST_PATH = os.getenv("PDF_TEXT_FAST_PATH", "1") == "1"
+PDF_TEXT_MIN_CHARS_PER_PAGE = int(os.getenv("PDF_TEXT_MIN_CHARS_PER_PAGE", "40"))
+PDF_TEXT_MAX_CHARS = int(os.getenv("PDF_TEXT_MAX_CHARS", "30000"))
+PDF_TEXT_TIMEOUT_SECONDS = float(os.getenv("PDF_TEXT_TIMEOUT_SECONDS", "10"))
+
+# === Gemini ヘッジリクエスト設定 ===
+# 応答が遅い呼び出しに重複リクエストを送り、元のリクエストが失敗した場合は再試行を待たずにその結果を使う
+GEMINI_HEDGE_ENABLED = os.getenv("GEMINI_HEDGE_ENABLED", "0") == "1"
+GEMINI_HEDGE_PERCENTILE = float(os.getenv("GEMINI_HEDGE_PERCENTILE", "95"))  # この分位点の応答時間を過ぎたら重複送信
+GEMINI_HEDGE_MIN_DELAY_SECONDS = float(os.getenv("GEMINI_HEDGE_MIN_DELAY_SECONDS", "2"))
+GEMINI_HEDGE_MIN_SAMPLES = int(os.getenv("GEMINI_HEDGE_MIN_SAMPLES", "20"))  # 分位点を信用するのに必要なサンプル数
+GEMINI_HEDGE_BUDGET = float(os.getenv("GEMINI_HEDGE_BUDGET", "0.05"))  # 重複送信の上限（呼び出し数に対する割合）
+GEMINI_HEDGE_WORKERS = int(os.getenv("GEMINI_HEDGE_WORKERS", "16"))  # 重複リクエストだけを実行するスレッド数（元のリクエストは呼び出し元で実行）
+
+# === Gemini 呼び出しゲート設定（プロセス全体で共有） ===
+GEMINI_GATE_MIN_CONCURRENCY = int(os.getenv("GEMINI_GATE_MIN_CONCURRENCY", "1"))
+GEMINI_GATE_MAX_CONCURRENCY = int(os.getenv("GEMINI_GATE_MAX_CONCURRENCY", "32"))
+GEMINI_GATE_INITIAL_CONCURRENCY = int(os.getenv("GEMINI_GATE_INITIAL_CONCURRENCY", "8"))
+GEMINI_GATE_RATE_PER_SEC = float(os.getenv("GEMINI_GATE_RATE_PER_SEC", "10"))  # 0でレート制限なし
+GEMINI_GATE_BURST = int(os.getenv("GEMINI_GATE_BURST", "20"))
+GEMINI_GATE_FAILURE_THRESHOLD = int(os.getenv("GEMINI_GATE_FAILURE_THRESHOLD", "5"))  # 連続した過負荷エラーで遮断
+GEMINI_GATE_OPEN_SECONDS = float(os.getenv("GEMINI_GATE_OPEN_SECONDS", "30"))  # 遮断時間
+GEMINI_GATE_OPEN_MODE = os.getenv("GEMINI_GATE_OPEN_MODE", "queue")  # queue: 復帰まで待機 / fail: 即失敗
+GEMINI_GATE_ACQUIRE_TIMEOUT_SECONDS = float(os.getenv("GEMINI_GATE_ACQUIRE_TIMEOUT_SECONDS", "120"))
+GEMINI_GATE_LATENCY_TOLERANCE = float(os.getenv("GEMINI_GATE_LATENCY_TOLERANCE", "2.0"))  # 基準の何倍で遅延とみなすか
+
 # === Gemini AI プロンプト ===
 GEMINI_PROMPT = """領収書を解析し、以下のJSON形式で返してください:
-[ { "date": "YYYY-MM-DD", "vendor_name": "店舗名", "total_amount": 数値, "is_ic_transport": true/false, "is_parking": true/false } ]
+[ { "date": "YYYY-MM-DD", "vendor_name": "店舗名", "total_amount": 数値, "is_ic_transport": true/false, "is_parking": true/false, "confidence": 0〜1 } ]
+
+【confidence（確信度）】
+日付・店舗名・金額を正しく読み取れた確信度を0〜1の数値で記載してください。
+文字がかすれている・一部が隠れている・手書きで判読しにくい場合は低い値にしてください。
 
 【重要：is_ic_transportフラグ（厳密な判定）】
 以下の条件を「すべて」満たす場合のみ true にしてください:
@@ -94,6 +216,9 @@ PLANS = {
         "price": 0,
         "currency": "jpy",
         "stripe_price_id": None,
+        "models": {"fast": GEMINI_FAST_MODEL, "pro": GEMINI_PRO_MODEL},
+        "weight": 1,  # 解析枠の配分比率
+        "max_concurrent": 2,  # 1ユーザーの同時解析数の上限
         "features": [
             "月10件まで",
             "基本的な解析機能",
@@ -106,6 +231,9 @@ PLANS = {
         "price": 980,
         "currency": "jpy",
         "stripe_price_id": None,
+        "models": {"fast": GEMINI_FAST_MODEL, "pro": GEMINI_PRO_MODEL},
+        "weight": 2,  # 解析枠の配分比率
+        "max_concurrent": 4,  # 1ユーザーの同時解析数の上限
         "features": [
             "月100件まで",
             "高精度AI解析",
@@ -120,6 +248,9 @@ PLANS = {
         "price": 4980,
         "currency": "jpy",
         "stripe_price_id": None,
+        "models": {"fast": GEMINI_FAST_MODEL, "pro": GEMINI_PRO_MODEL},
+        "weight": 4,  # 解析枠の配分比率
+        "max_concurrent": 8,  # 1ユーザーの同時解析数の上限
         "features": [
             "月1000件まで",
             "全機能利用可能",
@@ -134,6 +265,9 @@ PLANS = {
         "price": 0,
         "currency": "jpy",
         "stripe_price_id": None,
+        "models": {"fast": GEMINI_FAST_MODEL, "pro": GEMINI_PRO_MODEL},
+        "weight": 4,  # 解析枠の配分比率
+        "max_concurrent": 8,  # 1ユーザーの同時解析数の上限
         "features": ["全機能無制限"]
     }
 }
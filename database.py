@@ -2,8 +2,11 @@
 データベース接続・初期化
 Firestore と Cloud Storage の初期化
 """
+import json
+import base64
 from google.cloud import firestore, storage
 from passlib.context import CryptContext
+from utils.executors import run_db
 import config
 
 # === Firestore / Cloud Storage 初期化 ===
@@ -37,3 +40,106 @@ def init_admin():
             }
         })
         print("[OK] 管理者アカウントを初期化しました")
+
+# === 非同期データアクセス ===
+# ルーター（async def）からはこれらを使い、イベントループをブロックしない
+
+async def get_doc(doc_ref):
+    """ドキュメントを1件取得"""
+    return await run_db(doc_ref.get)
+
+async def stream_docs(query) -> list:
+    """クエリ結果を全件取得"""
+    return await run_db(lambda: list(query.stream()))
+
+async def get_user_records(u_id: str) -> list:
+    """ユーザーの全レコードを取得（idフィールド付き）"""
+    records_ref = db.collection(config.COL_USERS).document(u_id).collection("records")
+    records = []
+    for record in await stream_docs(records_ref):
+        data = record.to_dict()
+        data["id"] = record.id
+        records.append(data)
+    return records
+
+# レコード一覧の並び順（API指定値 → (並べ替えるフィールド, 方向)）
+# created はドキュメントID（作成時刻順に採番）で並べる
+RECORD_ORDERS = {
+    "date_desc": ("date", firestore.Query.DESCENDING),
+    "date_asc": ("date", firestore.Query.ASCENDING),
+    "created_desc": ("__name__", firestore.Query.DESCENDING),
+    "created_asc": ("__name__", firestore.Query.ASCENDING),
+    "amount_desc": ("total_amount", firestore.Query.DESCENDING),
+    "amount_asc": ("total_amount", firestore.Query.ASCENDING),
+}
+
+# 一致条件で絞り込めるフィールド
+RECORD_FILTER_FIELDS = ("category", "exported", "source", "is_parking")
+
+
+def encode_records_cursor(order_value, record_id: str) -> str:
+    """次ページの開始位置（最後のレコードの並べ替え値とID）を文字列にする"""
+    payload = json.dumps({"v": order_value, "id": record_id}, ensure_ascii=False)
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_records_cursor(cursor: str) -> dict:
+    """encode_records_cursor の逆変換（不正な値は ValueError）"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+        return {"v": payload["v"], "id": str(payload["id"])}
+    except Exception:
+        raise ValueError("カーソルが不正です")
+
+
+async def get_user_records_page(u_id: str, filters: dict, order: str = "date_desc", limit: int = 50,
+                                start_date: str = None, end_date: str = None, cursor: str = None) -> dict:
+    """ユーザーのレコードを条件・並び順を指定して1ページ分取得
+
+    日付の範囲指定は date での並べ替えと組み合わせる必要がある（Firestoreの範囲条件の制約）。
+    一致条件と並べ替えの組み合わせに必要な複合インデックスは firestore.indexes.json に定義している。
+    """
+    field, direction = RECORD_ORDERS[order]
+    records_ref = db.collection(config.COL_USERS).document(u_id).collection("records")
+
+    query = records_ref
+    for name, value in filters.items():
+        query = query.where(name, "==", value)
+    if start_date:
+        query = query.where("date", ">=", start_date)
+    if end_date:
+        query = query.where("date", "<=", end_date)
+
+    query = query.order_by(field, direction=direction)
+    if field != "__name__":
+        # 同じ値のレコードはIDで並べる（ページの境界で重複・欠落しないように）
+        query = query.order_by("__name__", direction=direction)
+    if cursor:
+        position = decode_records_cursor(cursor)
+        if field == "__name__":
+            query = query.start_after({"__name__": position["id"]})
+        else:
+            query = query.start_after({field: position["v"], "__name__": position["id"]})
+
+    # 1件多く取得して次ページの有無を判定
+    docs = await stream_docs(query.limit(limit + 1))
+    records = []
+    for doc in docs[:limit]:
+        data = doc.to_dict()
+        data["id"] = doc.id
+        records.append(data)
+
+    next_cursor = None
+    if len(docs) > limit:
+        last = records[-1]
+        next_cursor = encode_records_cursor(None if field == "__name__" else last.get(field), last["id"])
+    return {"records": records, "next_cursor": next_cursor}
+
+
+async def get_user_records_by_ids(u_id: str, record_ids: list) -> list:
+    """指定IDのレコードをまとめて取得（存在するもののみ、指定順）"""
+    records_ref = db.collection(config.COL_USERS).document(u_id).collection("records")
+    refs = [records_ref.document(record_id) for record_id in record_ids]
+    docs = await run_db(lambda: {doc.id: doc for doc in db.get_all(refs) if doc.exists})
+    return [docs[record_id].to_dict() for record_id in record_ids if record_id in docs]
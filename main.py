@@ -11,6 +11,8 @@ from fastapi.staticfiles import StaticFiles
 # 設定とデータベース初期化
 import config
 from database import init_admin
+from services.job_service import stop_job_tasks
+from utils.executors import shutdown_executors
 
 # ルーター
 from routers import auth, records, line, export, admin
@@ -64,6 +66,12 @@ async def startup_event():
     print("[OK] Application ready!")
     print("=" * 50)
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """終了時処理"""
+    await stop_job_tasks()
+    shutdown_executors()
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
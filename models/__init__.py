@@ -1,4 +1,5 @@
 """
 モデルモジュール
-データモデル定義（将来の拡張用）
+データモデル定義
 """
+from models.receipt import Receipt, TransportItem, BatchEntry, parse_receipts, parse_batch, validate_and_fix_date
@@ -0,0 +1,192 @@
+"""
+領収書データモデル
+Gemini構造化出力のスキーマと型付きパーサー
+"""
+import re
+from datetime import datetime
+from typing import List, Optional
+from pydantic import BaseModel, Field, TypeAdapter, field_validator, model_validator
+
+
+def validate_and_fix_date(date_str: str) -> str:
+    """日付を検証し、和暦変換ミスを修正する"""
+    if not date_str:
+        return date_str
+
+    try:
+        # YYYY-MM-DD形式をパース
+        match = re.match(r'(\d{4})-(\d{2})-(\d{2})', date_str)
+        if not match:
+            return date_str
+
+        year = int(match.group(1))
+        month = match.group(2)
+        day = match.group(3)
+
+        current_year = datetime.now().year
+
+        # 1990年代の日付は令和と平成の誤認識の可能性が高い
+        # 平成N年 → 令和N年への修正（+30年）
+        if 1989 <= year <= 1999:
+            # 平成1-11年 → 令和1-11年の可能性
+            # 平成年 + 1988 = 西暦 → 令和年 + 2018 = 西暦
+            # 差分は 2018 - 1988 = 30年
+            corrected_year = year + 30
+            if corrected_year <= current_year + 1:  # 来年までは許容
+                print(f"⚠️ 日付修正: {year}年 → {corrected_year}年（令和への変換ミスを修正）")
+                return f"{corrected_year}-{month}-{day}"
+
+        # 2000-2018年の場合も念のためチェック
+        # ただし、これらは有効な日付の可能性もあるので警告のみ
+        if 2000 <= year <= 2018:
+            print(f"⚠️ 警告: 日付が{year}年です。古い領収書でなければ確認してください。")
+
+        # 未来の日付（2年以上先）は警告
+        if year > current_year + 1:
+            print(f"⚠️ 警告: 日付が未来（{year}年）です。")
+
+        return date_str
+
+    except Exception as e:
+        print(f"日付検証エラー: {e}")
+        return date_str
+
+
+def _fix_date_fields(data):
+    """和暦変換ミスを修正し、修正したかどうかを date_corrected に記録"""
+    if isinstance(data, dict):
+        raw = data.get("date") or ""
+        fixed = validate_and_fix_date(raw)
+        data = {**data, "date": fixed, "date_corrected": fixed != raw}
+    return data
+
+
+def _to_amount(value) -> int:
+    """金額を整数に変換（"1,200円" や 1200.0 も受け付ける）"""
+    if value is None or value == "":
+        return 0
+    if isinstance(value, str):
+        value = re.sub(r"[^\d.\-]", "", value) or "0"
+    return int(round(float(value)))
+
+
+class TransportItem(BaseModel):
+    """ICカード交通費の明細行"""
+    date: str = ""
+    vendor: str = ""
+    from_station: str = ""
+    to_station: str = ""
+    amount: int = 0
+    date_corrected: bool = Field(default=False, exclude=True)
+
+    @model_validator(mode="before")
+    @classmethod
+    def _fix_date(cls, data):
+        return _fix_date_fields(data)
+
+    @field_validator("date", "vendor", "from_station", "to_station", mode="before")
+    @classmethod
+    def _none_to_empty(cls, v):
+        return "" if v is None else v
+
+    @field_validator("amount", mode="before")
+    @classmethod
+    def _fix_amount(cls, v):
+        return _to_amount(v)
+
+
+class Receipt(BaseModel):
+    """領収書1件分の解析結果"""
+    date: str = ""
+    vendor_name: str = ""
+    total_amount: int = 0
+    is_ic_transport: bool = False
+    is_parking: bool = False
+    items: Optional[List[TransportItem]] = None
+    confidence: Optional[float] = None
+    date_corrected: bool = Field(default=False, exclude=True)
+
+    @model_validator(mode="before")
+    @classmethod
+    def _fix_date(cls, data):
+        return _fix_date_fields(data)
+
+    @field_validator("date", "vendor_name", mode="before")
+    @classmethod
+    def _none_to_empty(cls, v):
+        return "" if v is None else v
+
+    @field_validator("total_amount", mode="before")
+    @classmethod
+    def _fix_amount(cls, v):
+        return _to_amount(v)
+
+    def to_record(self) -> dict:
+        """Firestore保存用の辞書に変換（明細がなければitemsを省略）"""
+        return self.model_dump(exclude_none=True)
+
+
+class BatchEntry(BaseModel):
+    """複数画像まとめて解析した際の1画像分の結果"""
+    image_index: int
+    receipts: List[Receipt] = []
+
+
+_receipt_list = TypeAdapter(List[Receipt])
+_receipt_one = TypeAdapter(Receipt)
+_batch_list = TypeAdapter(List[BatchEntry])
+
+
+def parse_receipts(text: str) -> List[Receipt]:
+    """Geminiの応答JSONを検証して型付きの領収書リストに変換"""
+    text = text.strip()
+    if text.startswith("{"):
+        return [_receipt_one.validate_json(text)]
+    return _receipt_list.validate_json(text)
+
+
+def parse_batch(text: str) -> dict:
+    """複数画像の解析結果を検証し、画像番号 → 領収書リストの辞書に変換"""
+    return {entry.image_index: entry.receipts for entry in _batch_list.validate_json(text)}
+
+
+# === Gemini構造化出力スキーマ（config.GEMINI_PROMPT の出力形式に対応） ===
+TRANSPORT_ITEM_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "date": {"type": "STRING", "description": "利用日 YYYY-MM-DD"},
+        "vendor": {"type": "STRING", "description": "利用先や路線名"},
+        "from_station": {"type": "STRING", "description": "乗車駅"},
+        "to_station": {"type": "STRING", "description": "降車駅"},
+        "amount": {"type": "INTEGER", "description": "金額"}
+    },
+    "required": ["date", "amount"]
+}
+
+RECEIPT_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "date": {"type": "STRING", "description": "YYYY-MM-DD（和暦は西暦に変換）"},
+        "vendor_name": {"type": "STRING", "description": "店舗名"},
+        "total_amount": {"type": "INTEGER", "description": "合計金額"},
+        "is_ic_transport": {"type": "BOOLEAN"},
+        "is_parking": {"type": "BOOLEAN"},
+        "items": {"type": "ARRAY", "items": TRANSPORT_ITEM_SCHEMA, "nullable": True},
+        "confidence": {"type": "NUMBER", "description": "読み取り結果の確信度（0〜1）"}
+    },
+    "required": ["date", "vendor_name", "total_amount", "is_ic_transport", "is_parking"]
+}
+
+RECEIPT_LIST_SCHEMA = {"type": "ARRAY", "items": RECEIPT_SCHEMA}
+
+BATCH_RESULT_SCHEMA = {
+    "type": "ARRAY",
+    "items": {
+        "type": "OBJECT",
+        "properties": {
+            "image_index": {"type": "INTEGER", "description": "画像の番号（「=== 画像 N ===」のN）"},
+            "receipts": RECEIPT_LIST_SCHEMA
+        },
+        "required": ["image_index", "receipts"]
+    }
+}
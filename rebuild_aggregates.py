@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+集計再作成スクリプト
+ユーザーごとのレコード集計（record_aggregates）を全レコードから作り直す
+
+集計はレコードの登録・更新・削除のたびに差分で更新されるが、
+集計の導入前からあるレコードは含まれないため、導入時に一度このスクリプトを実行する。
+手動でのデータ修正などでずれた場合の修復にも使う。
+（1ユーザーだけなら管理API POST /admin/users/{user_id}/aggregates/rebuild でも可能）
+稼働中に実行しても、集計中に書き込みがあったユーザーは読み込みからやり直すため集計はずれない。
+
+実行方法:
+    python rebuild_aggregates.py            # 全ユーザー
+    python rebuild_aggregates.py USER_ID    # 指定ユーザーのみ
+"""
+
+import sys
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from database import db
+from services.aggregates_service import rebuild_aggregates
+import config
+
+
+def rebuild_all(user_ids: list = None):
+    """指定ユーザー（省略時は全ユーザー）の集計を作り直す"""
+    print("=" * 60)
+    print("集計再作成スクリプト")
+    print("=" * 60)
+
+    if not user_ids:
+        user_ids = [ref.id for ref in db.collection(config.COL_USERS).list_documents()]
+
+    rebuilt_count = 0
+    failed_count = 0
+    for user_id in user_ids:
+        try:
+            summary = rebuild_aggregates(user_id)
+            rebuilt_count += 1
+            print(f"✅ {user_id}: {summary['count']}件 / ¥{summary['total_amount']:,}")
+        except Exception as e:
+            failed_count += 1
+            print(f"❌ {user_id}: {str(e)}")
+
+    print("\n📊 結果:")
+    print(f"  - 成功: {rebuilt_count}件")
+    print(f"  - 失敗: {failed_count}件")
+
+
+if __name__ == "__main__":
+    try:
+        rebuild_all(sys.argv[1:])
+    except KeyboardInterrupt:
+        print("\n\n❌ 再作成が中断されました")
+    except Exception as e:
+        print(f"\n\n❌ 予期しないエラーが発生しました: {str(e)}")
+        import traceback
+        traceback.print_exc()
@@ -4,9 +4,16 @@
 """
 from fastapi import APIRouter, HTTPException, Depends
 from google.cloud import firestore
-from database import db
+from database import db, run_db, get_doc, stream_docs
 from services.auth_service import get_current_user, hash_password
+from services.analysis_cache import get_cache_stats
+from services.gemini_service import get_routing_stats, get_hedge_stats
+from services.gemini_gate import gemini_gate
+from services.scheduler import analysis_scheduler
+from services.aggregates_service import aggregates_ref, rebuild_aggregates
+from services import record_cache
 from utils.helpers import generate_user_id
+from utils import metrics
 import config
 
 router = APIRouter()
@@ -26,10 +33,9 @@ def require_admin(u_id: str = Depends(get_current_user)):
 @router.get("/admin/users")
 async def get_all_users(admin_id: str = Depends(require_admin)):
     """全ユーザーの一覧を取得（管理者のみ）"""
-    users_ref = db.collection(config.COL_USERS).stream()
     users = []
 
-    for user_doc in users_ref:
+    for user_doc in await stream_docs(db.collection(config.COL_USERS)):
         user_data = user_doc.to_dict()
         users.append({
             "id": user_doc.id,
@@ -62,8 +68,7 @@ async def create_user(data: dict, admin_id: str = Depends(require_admin)):
         raise HTTPException(status_code=400, detail="メールアドレスとパスワードは必須です")
 
     # メールアドレスの重複チェック
-    existing = db.collection(config.COL_USERS).where("email", "==", email).limit(1).stream()
-    existing_list = list(existing)
+    existing_list = await stream_docs(db.collection(config.COL_USERS).where("email", "==", email).limit(1))
     print(f"Existing users: {len(existing_list)}")
 
     if existing_list:
@@ -79,7 +84,7 @@ async def create_user(data: dict, admin_id: str = Depends(require_admin)):
 
     # ユーザー作成
     try:
-        db.collection(config.COL_USERS).document(user_id).set({
+        await run_db(db.collection(config.COL_USERS).document(user_id).set, {
             "email": email,
             "password": hash_password(password),
             "role": "user",
@@ -110,16 +115,20 @@ async def delete_user(user_id: str, admin_id: str = Depends(require_admin)):
         raise HTTPException(status_code=403, detail="管理者アカウントは削除できません")
 
     user_ref = db.collection(config.COL_USERS).document(user_id)
-    if not user_ref.get().exists:
+    if not (await get_doc(user_ref)).exists:
         raise HTTPException(status_code=404, detail="ユーザーが見つかりません")
 
-    # サブコレクションのレコードを全削除
-    records_ref = user_ref.collection("records").stream()
-    for record in records_ref:
-        record.reference.delete()
+    def delete_user_data():
+        # サブコレクションのレコードを全削除
+        for record in user_ref.collection("records").stream():
+            record.reference.delete()
 
-    # ユーザードキュメントを削除
-    user_ref.delete()
+        # 集計・ユーザードキュメントを削除
+        aggregates_ref(user_id).delete()
+        user_ref.delete()
+
+    await run_db(delete_user_data)
+    record_cache.invalidate(user_id)
 
     return {"message": "ユーザーを削除しました"}
 
@@ -134,10 +143,42 @@ async def update_user_subscription(user_id: str, data: dict, admin_id: str = Dep
     plan = config.PLANS[plan_id]
 
     # サブスク情報を更新
-    db.collection(config.COL_USERS).document(user_id).update({
+    await run_db(db.collection(config.COL_USERS).document(user_id).update, {
         "subscription.plan": plan_id,
         "subscription.limit": plan["limit"],
         "subscription.status": "active"
     })
 
     return {"message": "プランを更新しました"}
+
+@router.post("/admin/users/{user_id}/aggregates/rebuild")
+async def rebuild_user_aggregates(user_id: str, admin_id: str = Depends(require_admin)):
+    """ユーザーの集計を全レコードから作り直す（ずれの修復用、管理者のみ）"""
+    if not (await get_doc(db.collection(config.COL_USERS).document(user_id))).exists:
+        raise HTTPException(status_code=404, detail="ユーザーが見つかりません")
+
+    return {"message": "集計を再作成しました", "aggregates": await run_db(rebuild_aggregates, user_id)}
+
+@router.get("/admin/metrics")
+async def get_metrics(admin_id: str = Depends(require_admin)):
+    """処理メトリクスを取得（管理者のみ）"""
+    return {
+        "analysis_cache": get_cache_stats(),
+        "gemini_routing": get_routing_stats(),
+        "gemini_hedge": get_hedge_stats(),
+        "gemini_gate": gemini_gate.get_state(),
+        "scheduler": analysis_scheduler.get_state(),
+        "record_cache": record_cache.get_record_cache_stats(),
+        **metrics.snapshot()
+    }
+
+@router.get("/admin/gemini-gate")
+async def get_gemini_gate(admin_id: str = Depends(require_admin)):
+    """Gemini呼び出しゲートの状態を取得（管理者のみ）"""
+    return gemini_gate.get_state()
+
+@router.post("/admin/gemini-gate/reset")
+async def reset_gemini_gate(admin_id: str = Depends(require_admin)):
+    """Gemini呼び出しゲートを初期状態に戻す（管理者のみ）"""
+    gemini_gate.reset()
+    return gemini_gate.get_state()
@@ -4,7 +4,8 @@
 """
 from fastapi import APIRouter, Form, HTTPException, Depends
 from google.cloud import firestore
-from database import db
+from database import db, run_db, get_doc, stream_docs
+from services.aggregates_service import get_aggregates
 from services.auth_service import create_access_token, verify_password, hash_password, get_current_user
 from utils.helpers import generate_user_id
 import config
@@ -21,8 +22,7 @@ async def login(email: str = Form(...), password: str = Form(...)):
 
     # メールアドレスでユーザーを検索
     try:
-        users = db.collection(config.COL_USERS).where("email", "==", email).limit(1).stream()
-        user_list = list(users)
+        user_list = await stream_docs(db.collection(config.COL_USERS).where("email", "==", email).limit(1))
         print(f"[LOGIN] Users found: {len(user_list)}")
     except Exception as e:
         print(f"[ERROR] Database query failed: {str(e)}")
@@ -65,8 +65,8 @@ async def login(email: str = Form(...), password: str = Form(...)):
 async def register(email: str = Form(...), password: str = Form(...)):
     """新規ユーザー登録"""
     # メールアドレスの重複チェック
-    existing_users = db.collection(config.COL_USERS).where("email", "==", email).limit(1).stream()
-    if list(existing_users):
+    existing_users = await stream_docs(db.collection(config.COL_USERS).where("email", "==", email).limit(1))
+    if existing_users:
         raise HTTPException(status_code=400, detail="このメールアドレスは既に登録されています")
 
     # 新規ユーザーID生成
@@ -86,7 +86,7 @@ async def register(email: str = Form(...), password: str = Form(...)):
     }
 
     # Firestoreに保存
-    db.collection(config.COL_USERS).document(user_id).set({
+    await run_db(db.collection(config.COL_USERS).document(user_id).set, {
         "email": email,
         "password": hash_password(password),
         "role": "user",
@@ -102,36 +102,31 @@ async def register(email: str = Form(...), password: str = Form(...)):
 
 @router.get("/api/status")
 async def get_status(u_id: str = Depends(get_current_user)):
-    """ユーザーのステータスとレコード一覧を取得（サブコレクション対応）"""
+    """ユーザーのステータスと集計を取得（レコード本体は /api/records でページ単位に取得）"""
     # ユーザー情報を取得
-    user_doc = db.collection(config.COL_USERS).document(u_id).get()
+    user_doc = await get_doc(db.collection(config.COL_USERS).document(u_id))
     if not user_doc.exists:
         raise HTTPException(status_code=404, detail="ユーザーが見つかりません")
 
     user_data = user_doc.to_dict()
     subscription = user_data.get("subscription", {})
 
-    # サブコレクションからレコードを取得
-    records = []
-    records_ref = db.collection(config.COL_USERS).document(u_id).collection("records").stream()
-
-    for record in records_ref:
-        data = record.to_dict()
-        data["id"] = record.id
-        records.append(data)
+    # 件数・金額などの集計（集計ドキュメント1件の読み込み）
+    summary = await run_db(get_aggregates, u_id)
 
     return {
         "user_id": u_id,
         "email": user_data.get("email", ""),
         "role": user_data.get("role", "user"),
         "subscription": subscription,
-        "records": records
+        "records_count": summary["count"],
+        "summary": summary
     }
 
 @router.get("/api/subscription")
 async def get_subscription(u_id: str = Depends(get_current_user)):
     """現在のサブスク状態を取得"""
-    user_doc = db.collection(config.COL_USERS).document(u_id).get()
+    user_doc = await get_doc(db.collection(config.COL_USERS).document(u_id))
     if not user_doc.exists:
         raise HTTPException(status_code=404, detail="ユーザーが見つかりません")
 
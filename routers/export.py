@@ -5,12 +5,16 @@ CSV/Excel/PDF出力機能
 """
 import os
 import time
+import uuid
+from datetime import datetime, timedelta, timezone
 from typing import Optional, List
 from fastapi import APIRouter, HTTPException, Depends
 from fastapi.responses import FileResponse
 from jose import JWTError, jwt
-from database import db
+from database import db, run_db
+from services.record_cache import get_user_records, get_user_records_by_ids
 from services.auth_service import get_current_user_optional, get_current_user
+from services.aggregates_service import is_parking_record, is_ic_transport_record
 import config
 
 router = APIRouter()
@@ -36,6 +40,20 @@ def format_date_slash(date_str: str) -> str:
         pass
     return date_str
 
+def save_export_manifest(u_id: str, record_ids: List[str]) -> str:
+    """出力したレコードIDの控えを保存し、出力済みマークで使うIDを返す
+
+    控えは expires_at を TTL ポリシーに設定して自動削除する（export_manifests コレクション）。
+    """
+    export_id = uuid.uuid4().hex
+    db.collection(config.COL_EXPORT_MANIFESTS).document(export_id).set({
+        "user_id": u_id,
+        "record_ids": record_ids,
+        "created_at": datetime.now(timezone.utc),
+        "expires_at": datetime.now(timezone.utc) + timedelta(seconds=config.EXPORT_MANIFEST_RETENTION_SECONDS),
+    })
+    return export_id
+
 # 日本語フォント管理
 def download_japanese_font():
     """Noto Sans JPフォントをダウンロード"""
@@ -83,8 +101,7 @@ async def export_csv(token: Optional[str] = None, u_id: Optional[str] = Depends(
         raise HTTPException(status_code=401, detail="認証が必要です")
 
     # サブコレクションからレコードを取得
-    records_ref = db.collection(config.COL_USERS).document(u_id).collection("records").stream()
-    records = [r.to_dict() for r in records_ref]
+    records = await get_user_records(u_id)
 
     if not records:
         raise HTTPException(status_code=404, detail="データがありません")
@@ -115,58 +132,20 @@ async def export_excel(token: Optional[str] = None, u_id: Optional[str] = Depend
         raise HTTPException(status_code=401, detail="認証が必要です")
 
     # サブコレクションからレコードを取得
-    records_ref = db.collection(config.COL_USERS).document(u_id).collection("records").stream()
-    records = [r.to_dict() for r in records_ref]
+    records = await get_user_records(u_id)
 
     if not records:
         raise HTTPException(status_code=404, detail="データがありません")
 
-    # 駐輪場キーワード（駐車場から除外）
-    bicycle_keywords = ["駐輪", "自転車", "サイクル", "bicycle", "cycle"]
-    # 駐車場キーワード（フォールバック用）
-    parking_keywords = ["駐車", "パーキング", "コインパ", "parking", "P代"]
-
-    def is_bicycle_parking(record):
-        """駐輪場かどうかを判定"""
-        vendor = record.get("vendor_name", "").lower()
-        for kw in bicycle_keywords:
-            if kw.lower() in vendor:
-                return True
-        return False
-
-    def is_parking(record):
-        """駐車場かどうかを判定（Gemini解析結果のフラグを優先、駐輪場は除外）"""
-        # 駐輪場は駐車場に含めない
-        if is_bicycle_parking(record):
-            return False
-        # Geminiのis_parkingフラグを優先
-        if record.get("is_parking") == True:
-            return True
-        # フォールバック: キーワードマッチング
-        vendor = record.get("vendor_name", "").lower()
-        for kw in parking_keywords:
-            if kw.lower() in vendor:
-                return True
-        return False
-
-    def is_ic_transport(record):
-        """ICカード交通費かどうかを判定
-
-        Gemini解析で「ICカード交通費」という文言が書類に明示的に
-        記載されている場合のみtrueとなる。
-        通常のレシートや交通系ICカードの利用履歴はfalse。
-        """
-        return record.get("is_ic_transport") == True
-
     # レコードを分類
     parking_records = []
     transport_records = []
     other_records = []
 
     for record in records:
-        if is_parking(record):
+        if is_parking_record(record):
             parking_records.append(record)
-        elif is_ic_transport(record):
+        elif is_ic_transport_record(record):
             transport_records.append(record)
         else:
             other_records.append(record)
@@ -277,9 +256,17 @@ async def export_excel(token: Optional[str] = None, u_id: Optional[str] = Depend
     wb.save(excel_path)
     wb.close()
 
+    # ファイルに含めたレコードの控えを残す（クライアントはこのIDで実際に出力した分だけを出力済みにする）
+    export_id = await run_db(save_export_manifest, u_id, [r["id"] for r in records])
+
     # ファイル名を出力日のYYMMDD形式にする（例: 260209）
     filename_date = datetime.now().strftime("%y%m%d")
-    return FileResponse(excel_path, media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", filename=f"{filename_date}.xlsx")
+    return FileResponse(
+        excel_path,
+        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        filename=f"{filename_date}.xlsx",
+        headers={"X-Export-Id": export_id},
+    )
 
 @router.get("/api/export/pdf")
 async def export_pdf(token: Optional[str] = None, u_id: Optional[str] = Depends(get_current_user_optional)):
@@ -298,8 +285,7 @@ async def export_pdf(token: Optional[str] = None, u_id: Optional[str] = Depends(
         raise HTTPException(status_code=401, detail="認証が必要です")
 
     # サブコレクションからレコードを取得
-    records_ref = db.collection(config.COL_USERS).document(u_id).collection("records").stream()
-    records = [r.to_dict() for r in records_ref]
+    records = await get_user_records(u_id)
 
     if not records:
         raise HTTPException(status_code=404, detail="データがありません")
@@ -380,12 +366,7 @@ async def export_selected_csv(data: dict, u_id: str = Depends(get_current_user))
     print(f"User: {u_id}, Records: {len(record_ids)} items")
 
     # 選択したレコードを取得
-    records = []
-    for record_id in record_ids:
-        doc_ref = db.collection(config.COL_USERS).document(u_id).collection("records").document(record_id)
-        doc = doc_ref.get()
-        if doc.exists:
-            records.append(doc.to_dict())
+    records = await get_user_records_by_ids(u_id, record_ids)
 
     if not records:
         raise HTTPException(status_code=404, detail="データがありません")
@@ -413,62 +394,20 @@ async def export_selected_excel(data: dict, u_id: str = Depends(get_current_user
     print(f"User: {u_id}, Records: {len(record_ids)} items")
 
     # 選択したレコードを取得
-    records = []
-    for record_id in record_ids:
-        doc_ref = db.collection(config.COL_USERS).document(u_id).collection("records").document(record_id)
-        doc = doc_ref.get()
-        if doc.exists:
-            records.append(doc.to_dict())
+    records = await get_user_records_by_ids(u_id, record_ids)
 
     if not records:
         raise HTTPException(status_code=404, detail="データがありません")
 
-    # 駐輪場キーワード（駐車場から除外）
-    bicycle_keywords = ["駐輪", "自転車", "サイクル", "bicycle", "cycle"]
-    # 駐車場キーワード（フォールバック用）
-    parking_keywords = ["駐車", "パーキング", "コインパ", "parking", "P代"]
-
-    def is_bicycle_parking(record):
-        """駐輪場かどうかを判定"""
-        vendor = record.get("vendor_name", "").lower()
-        for kw in bicycle_keywords:
-            if kw.lower() in vendor:
-                return True
-        return False
-
-    def is_parking(record):
-        """駐車場かどうかを判定（Gemini解析結果のフラグを優先、駐輪場は除外）"""
-        # 駐輪場は駐車場に含めない
-        if is_bicycle_parking(record):
-            return False
-        # Geminiのis_parkingフラグを優先
-        if record.get("is_parking") == True:
-            return True
-        # フォールバック: キーワードマッチング
-        vendor = record.get("vendor_name", "").lower()
-        for kw in parking_keywords:
-            if kw.lower() in vendor:
-                return True
-        return False
-
-    def is_ic_transport(record):
-        """ICカード交通費かどうかを判定
-
-        Gemini解析で「ICカード交通費」という文言が書類に明示的に
-        記載されている場合のみtrueとなる。
-        通常のレシートや交通系ICカードの利用履歴はfalse。
-        """
-        return record.get("is_ic_transport") == True
-
     # レコードを分類
     parking_records = []
     transport_records = []
     other_records = []
 
     for record in records:
-        if is_parking(record):
+        if is_parking_record(record):
             parking_records.append(record)
-        elif is_ic_transport(record):
+        elif is_ic_transport_record(record):
             transport_records.append(record)
         else:
             other_records.append(record)
@@ -577,9 +516,17 @@ async def export_selected_excel(data: dict, u_id: str = Depends(get_current_user
     wb.save(excel_path)
     wb.close()
 
+    # ファイルに含めたレコードの控えを残す（クライアントはこのIDで実際に出力した分だけを出力済みにする）
+    export_id = await run_db(save_export_manifest, u_id, [r["id"] for r in records])
+
     # ファイル名を出力日のYYMMDD形式にする（例: 260209）
     filename_date = datetime.now().strftime("%y%m%d")
-    return FileResponse(excel_path, media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", filename=f"{filename_date}.xlsx")
+    return FileResponse(
+        excel_path,
+        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        filename=f"{filename_date}.xlsx",
+        headers={"X-Export-Id": export_id},
+    )
 
 @router.post("/api/export/selected/pdf")
 async def export_selected_pdf(data: dict, u_id: str = Depends(get_current_user)):
@@ -595,12 +542,7 @@ async def export_selected_pdf(data: dict, u_id: str = Depends(get_current_user))
     print(f"User: {u_id}, Records: {len(record_ids)} items")
 
     # 選択したレコードを取得
-    records = []
-    for record_id in record_ids:
-        doc_ref = db.collection(config.COL_USERS).document(u_id).collection("records").document(record_id)
-        doc = doc_ref.get()
-        if doc.exists:
-            records.append(doc.to_dict())
+    records = await get_user_records_by_ids(u_id, record_ids)
 
     if not records:
         raise HTTPException(status_code=404, detail="データがありません")
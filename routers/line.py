@@ -3,19 +3,22 @@ LINE連携ルーター
 LINE Bot Webhook・トークン管理
 """
 import os
-import time
 import re
 from fastapi import APIRouter, Request, HTTPException, Depends
 from google.cloud import firestore
 from linebot import LineBotApi, WebhookHandler
 from linebot.exceptions import InvalidSignatureError
 from linebot.models import MessageEvent, ImageMessage, TextMessage, TextSendMessage
-from database import db
+from database import db, run_db, get_doc
 from services.auth_service import get_current_user
-from services.gemini_service import analyze_with_gemini_retry
-from services.image_service import compress_image
+from services.gemini_service import analyze_with_gemini_retry, GeminiAnalysisError
+from services.gemini_gate import gemini_gate
+from services.scheduler import analysis_scheduler, LANE_INTERACTIVE
+from services.image_service import compress_image_in_pool, prepare_for_analysis_in_pool
 from services.storage_service import upload_to_gcs
-from utils.helpers import generate_token, get_user_by_line_id, check_usage_limit
+from services.upload_service import commit_receipt_records
+from utils.executors import run_line
+from utils.helpers import generate_token, generate_record_id, get_user_by_line_id, check_usage_limit, get_user_subscription
 import config
 
 router = APIRouter()
@@ -27,28 +30,31 @@ handler = WebhookHandler(config.LINE_CHANNEL_SECRET)
 @router.get("/api/line-token")
 async def generate_line_token(u_id: str = Depends(get_current_user)):
     """LINE連携用トークンを生成"""
-    # 既存のトークンを削除（1ユーザー1トークン）
-    old_tokens = db.collection(config.COL_LINE_TOKENS).where("user_id", "==", u_id).stream()
-    for old_token in old_tokens:
-        old_token.reference.delete()
-
     # 新しいトークンを生成
     token = generate_token(8)
 
-    # Firestoreに保存
-    db.collection(config.COL_LINE_TOKENS).document(token).set({
-        "user_id": u_id,
-        "created_at": firestore.SERVER_TIMESTAMP,
-        "used": False,
-        "expires_at": firestore.SERVER_TIMESTAMP  # 24時間後に期限切れにする場合は別途処理
-    })
+    def replace_token():
+        # 既存のトークンを削除（1ユーザー1トークン）
+        old_tokens = db.collection(config.COL_LINE_TOKENS).where("user_id", "==", u_id).stream()
+        for old_token in old_tokens:
+            old_token.reference.delete()
+
+        # Firestoreに保存
+        db.collection(config.COL_LINE_TOKENS).document(token).set({
+            "user_id": u_id,
+            "created_at": firestore.SERVER_TIMESTAMP,
+            "used": False,
+            "expires_at": firestore.SERVER_TIMESTAMP  # 24時間後に期限切れにする場合は別途処理
+        })
+
+    await run_db(replace_token)
 
     return {"token": token, "message": "LINEでこのトークンを送信してください"}
 
 @router.get("/api/line-status")
 async def get_line_status(u_id: str = Depends(get_current_user)):
     """LINE連携ステータスを取得"""
-    user_doc = db.collection(config.COL_USERS).document(u_id).get()
+    user_doc = await get_doc(db.collection(config.COL_USERS).document(u_id))
     if not user_doc.exists:
         raise HTTPException(status_code=404, detail="ユーザーが見つかりません")
 
@@ -63,7 +69,7 @@ async def get_line_status(u_id: str = Depends(get_current_user)):
 @router.post("/api/line-disconnect")
 async def disconnect_line(u_id: str = Depends(get_current_user)):
     """LINE連携を解除"""
-    db.collection(config.COL_USERS).document(u_id).update({
+    await run_db(db.collection(config.COL_USERS).document(u_id).update, {
         "line_user_id": None
     })
 
@@ -75,7 +81,8 @@ async def webhook(request: Request):
     signature = request.headers.get("X-Line-Signature")
     body = await request.body()
     try:
-        handler.handle(body.decode("utf-8"), signature)
+        # ハンドラーは同期処理（Firestore・Gemini呼び出し、解析枠の待機）のため専用スレッドプールで実行
+        await run_line(handler.handle, body.decode("utf-8"), signature)
     except InvalidSignatureError:
         raise HTTPException(status_code=400)
     return "OK"
@@ -157,13 +164,22 @@ def handle_image_message(event):
         )
         return
 
+    # Gemini呼び出しが遮断中（即失敗モード）なら画像を取得せずに知らせる
+    if gemini_gate.open_mode == "fail" and gemini_gate.is_open():
+        line_bot_api.reply_message(
+            event.reply_token,
+            TextSendMessage(text="⏳ ただいま解析が混雑しています。\n\nしばらくしてから画像を再送信してください。")
+        )
+        return
+
     try:
         print("📥 Downloading image...")
         # 画像をダウンロード
         message_content = line_bot_api.get_message_content(event.message.id)
 
         # 一時保存
-        temp_path = os.path.join(config.UPLOAD_DIR, f"line_{int(time.time())}.jpg")
+        file_id = generate_record_id()
+        temp_path = os.path.join(config.UPLOAD_DIR, f"line_{file_id}.jpg")
         print(f"Saving to: {temp_path}")
 
         # image_contentは既にバイナリデータ
@@ -172,41 +188,42 @@ def handle_image_message(event):
 
         # 画像を圧縮
         print("Compressing image...")
-        temp_path = compress_image(temp_path, max_size=(1920, 1080), quality=85)
+        temp_path = compress_image_in_pool(temp_path, max_size=(1920, 1080), quality=85)
 
         print("☁️ Uploading to GCS...")
         # GCSにアップロード
-        gcs_file_name = f"line_receipts/{int(time.time())}.jpg"
+        gcs_file_name = f"line_receipts/{file_id}{os.path.splitext(temp_path)[1]}"
         public_url = upload_to_gcs(temp_path, gcs_file_name)
         print(f"GCS URL: {public_url}")
 
+        # 解析用のコピーを作成（机などの背景を切り抜き、傾き・コントラストを補正）
+        analysis_path = prepare_for_analysis_in_pool(temp_path)
+
         print("🤖 Analyzing with Gemini...")
-        # Gemini解析（リトライ機能付き）
-        data_list = analyze_with_gemini_retry(temp_path, max_retries=3)
+        # Gemini解析（リトライ機能付き・プランに応じたモデル選択）
+        # 解析枠はWebアップロードと共有（チャットで返信を待っているため優先レーンで実行）
+        plan = (get_user_subscription(user_id) or {}).get("plan", "free")
+        with analysis_scheduler.slot(user_id, plan, LANE_INTERACTIVE):
+            data_list = analyze_with_gemini_retry(analysis_path, max_retries=3, plan=plan)
 
         print("💾 Saving to Firestore...")
-        # サブコレクションに保存
-        for item in (data_list if isinstance(data_list, list) else [data_list]):
-            doc_id = str(int(time.time()*1000))
-            time.sleep(0.001)
+        # レコードと使用回数のインクリメントをまとめて保存
+        items = data_list if isinstance(data_list, list) else [data_list]
+        for item in items:
             item.update({
                 "image_url": public_url,
-                "id": doc_id,
                 "created_at": firestore.SERVER_TIMESTAMP,
                 "is_pdf": False,
                 "pdf_images": [],
                 "category": "その他",
                 "source": "line"
             })
-            db.collection(config.COL_USERS).document(user_id).collection("records").document(doc_id).set(item)
-
-        # 使用回数をインクリメント
-        db.collection(config.COL_USERS).document(user_id).update({
-            "subscription.used": firestore.Increment(1)
-        })
+        commit_receipt_records(user_id, items)
 
         # 一時ファイル削除
         os.remove(temp_path)
+        if analysis_path != temp_path:
+            os.remove(analysis_path)
         print("✅ Processing complete")
 
         # 結果を通知
@@ -224,6 +241,14 @@ def handle_image_message(event):
         )
 
     except Exception as e:
+        if isinstance(e, GeminiAnalysisError) and e.kind == "overloaded":
+            print(f"⚠️ LINE image analysis rejected by Gemini gate: {str(e)}")
+            line_bot_api.reply_message(
+                event.reply_token,
+                TextSendMessage(text="⏳ ただいま解析が混雑しています。\n\nしばらくしてから画像を再送信してください。")
+            )
+            return
+
         print(f"❌ LINE image processing error: {str(e)}")
         import traceback
         traceback.print_exc()
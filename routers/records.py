@@ -2,127 +2,113 @@
 レコード管理ルーター
 アップロード・編集・削除機能
 """
-import os
-import time
-import shutil
-from typing import List
+from typing import List, Optional
 from fastapi import APIRouter, UploadFile, File, HTTPException, Depends
 from google.cloud import firestore
-from database import db
+from database import db, run_db, get_doc, stream_docs, get_user_records_page, RECORD_ORDERS
 from services.auth_service import get_current_user
-from services.gemini_service import analyze_with_gemini_retry
-from services.image_service import compress_image, convert_pdf_to_images
-from services.storage_service import upload_to_gcs, delete_from_gcs
-from utils.helpers import check_usage_limit
+from services.storage_service import delete_from_gcs
+from services.upload_service import save_upload_file, process_files_concurrently
+from services.job_service import enqueue_job, get_job
+from services.gemini_gate import gemini_gate
+from services.aggregates_service import update_records, delete_records
+from utils.helpers import check_usage_limit, get_user_subscription
 import config
 
 router = APIRouter()
 
+def _delete_record_images(record_data: dict):
+    """レコードの画像（GCS）を削除（同期処理）"""
+    # GCSから画像削除
+    image_url = record_data.get("image_url", "")
+    if image_url:
+        delete_from_gcs(image_url)
+
+    # PDF画像も削除
+    if record_data.get("is_pdf") and record_data.get("pdf_images"):
+        for pdf_img_url in record_data["pdf_images"]:
+            delete_from_gcs(pdf_img_url)
+
+def _delete_record_docs(u_id: str, record_ids: list) -> tuple:
+    """複数レコードを削除して (削除件数, 失敗件数) を返す（同期処理）
+
+    Firestoreのレコード削除と集計の更新をトランザクションで行い、削除できたレコードの画像を消す。
+    """
+    try:
+        deleted = delete_records(u_id, record_ids)
+    except Exception as e:
+        print(f"Error deleting records: {e}")
+        return 0, len(record_ids)
+
+    for record_id, record_data in deleted:
+        try:
+            _delete_record_images(record_data)
+        except Exception as e:
+            print(f"Error deleting images of {record_id}: {e}")
+    return len(deleted), len(record_ids) - len(deleted)
+
 @router.post("/upload")
-async def upload_receipt(files: List[UploadFile] = File(...), u_id: str = Depends(get_current_user)):
-    """複数ファイルのアップロード（サブコレクション対応）"""
+async def upload_receipt(files: List[UploadFile] = File(...), async_mode: bool = False, u_id: str = Depends(get_current_user)):
+    """複数ファイルのアップロード（サブコレクション対応）
+
+    async_mode=true の場合はファイル保存後すぐにジョブIDを返し、
+    解析はバックグラウンドワーカーで実行する（進捗は /api/jobs/{job_id}）。
+    """
     print(f"=== Upload request received ===")
     print(f"User: {u_id}")
     print(f"Files count: {len(files) if files else 0}")
+    print(f"Async mode: {async_mode}")
 
     if not files or len(files) == 0:
         raise HTTPException(status_code=400, detail="ファイルが選択されていません")
 
     # 使用上限チェック
-    if not check_usage_limit(u_id):
+    if not await run_db(check_usage_limit, u_id):
         raise HTTPException(
             status_code=403,
             detail="月間上限に達しました。プランをアップグレードしてください。"
         )
 
-    all_results = []
+    # Gemini呼び出しが遮断中（即失敗モード）ならファイルを受け取る前に断る
+    if gemini_gate.open_mode == "fail" and gemini_gate.is_open():
+        raise HTTPException(
+            status_code=503,
+            detail="解析サービスが混雑しています。しばらくしてから再度お試しください。",
+            headers={"Retry-After": str(int(config.GEMINI_GATE_OPEN_SECONDS))}
+        )
+
+    # プランに応じて解析モデルを選択するため、プランを取得
+    subscription = await run_db(get_user_subscription, u_id) or {}
+    plan = subscription.get("plan", "free")
 
+    # 1. 一時保存（ファイル読み込みは順番に実施）
+    saved_files = []
+    save_errors = {}
     for idx, file in enumerate(files):
-        print(f"\n--- Processing file {idx + 1}/{len(files)}: {file.filename} ---")
         try:
-            # ファイル名をサニタイズ
-            original_filename = file.filename
-            file_ext = os.path.splitext(original_filename)[1]
-            safe_filename = f"{int(time.time() * 1000)}{file_ext}"
-
-            print(f"Original filename: {original_filename}")
-            print(f"Safe filename: {safe_filename}")
-
-            # 1. 一時保存
-            temp_path = os.path.join(config.UPLOAD_DIR, safe_filename)
-            print(f"Saving to: {temp_path}")
-
-            with open(temp_path, "wb") as b:
-                shutil.copyfileobj(file.file, b)
-
-            # PDFファイルかどうかをチェック
-            is_pdf = original_filename.lower().endswith('.pdf')
-            print(f"Is PDF: {is_pdf}")
-
-            # 画像の場合は圧縮
-            if not is_pdf and file_ext.lower() in ['.jpg', '.jpeg', '.png', '.webp']:
-                print("Compressing image...")
-                temp_path = compress_image(temp_path, max_size=(1920, 1080), quality=85)
-
-            # 2. Cloud Storageへアップロード
-            gcs_file_name = f"receipts/{safe_filename}"
-            print(f"Uploading to GCS: {gcs_file_name}")
-            public_url = upload_to_gcs(temp_path, gcs_file_name)
-            print(f"GCS URL: {public_url}")
-
-            # 3. PDFの場合は画像化
-            pdf_image_urls = []
-            if is_pdf:
-                print("Converting PDF to images...")
-                pdf_image_urls = convert_pdf_to_images(temp_path)
-                print(f"PDF images created: {len(pdf_image_urls)}")
-
-            # 4. Gemini 解析（リトライ機能付き）
-            print("Starting Gemini analysis...")
-            data_list = analyze_with_gemini_retry(temp_path, max_retries=3)
-
-            # 5. サブコレクションに保存
-            print("Saving to Firestore subcollection...")
-            for item in (data_list if isinstance(data_list, list) else [data_list]):
-                doc_id = str(int(time.time()*1000))
-                time.sleep(0.001)
-                item.update({
-                    "image_url": public_url,
-                    "id": doc_id,
-                    "created_at": firestore.SERVER_TIMESTAMP,
-                    "is_pdf": is_pdf,
-                    "pdf_images": pdf_image_urls if is_pdf else [],
-                    "original_filename": original_filename,
-                    "category": "その他",
-                    "source": "web"
-                })
-                # サブコレクションに保存
-                db.collection(config.COL_USERS).document(u_id).collection("records").document(doc_id).set(item)
-
-            # 使用回数をインクリメント
-            db.collection(config.COL_USERS).document(u_id).update({
-                "subscription.used": firestore.Increment(1)
-            })
-
-            # 6. 一時ファイルを削除
-            os.remove(temp_path)
-
-            all_results.append({
-                "filename": original_filename,
-                "status": "success",
-                "records_count": len(data_list) if isinstance(data_list, list) else 1
-            })
-            print(f"✅ Success: {original_filename}")
-
+            saved_files.append(save_upload_file(file, idx))
         except Exception as e:
-            print(f"❌ Error processing {file.filename}: {type(e).__name__}: {str(e)}")
-            import traceback
-            traceback.print_exc()
-            all_results.append({
+            print(f"❌ Error saving {file.filename}: {type(e).__name__}: {str(e)}")
+            save_errors[idx] = {
                 "filename": str(file.filename),
                 "status": "error",
                 "error": str(e)
-            })
+            }
+
+    # 非同期モード: ジョブを登録して即座に返す
+    if async_mode:
+        job = await enqueue_job(u_id, saved_files, save_errors, plan)
+        return {
+            "job_id": job["id"],
+            "status": job["status"],
+            "total": job["total"]
+        }
+
+    # 2. 圧縮・GCS・PDF画像化・Gemini解析・保存を並列実行
+    processed = iter(await process_files_concurrently(u_id, saved_files, plan))
+
+    # 結果をアップロード順に並べる
+    all_results = [save_errors[idx] if idx in save_errors else next(processed) for idx in range(len(files))]
 
     print(f"\n=== Upload complete ===")
     success_count = len([r for r in all_results if r['status'] == 'success'])
@@ -139,6 +125,68 @@ async def upload_receipt(files: List[UploadFile] = File(...), u_id: str = Depend
         }
     }
 
+@router.get("/api/jobs/{job_id}")
+async def get_upload_job(job_id: str, u_id: str = Depends(get_current_user)):
+    """非同期アップロードジョブの進捗と結果を取得"""
+    job = await run_db(get_job, job_id, u_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="ジョブが見つかりません")
+
+    files = job.get("files", [])
+    return {
+        "job_id": job["id"],
+        "status": job["status"],
+        "total": job["total"],
+        "processed": job["processed"],
+        "files": files,
+        "summary": {
+            "total": job["total"],
+            "success": len([f for f in files if f["status"] == "success"]),
+            "errors": len([f for f in files if f["status"] == "error"])
+        }
+    }
+
+@router.get("/api/records")
+async def list_records(
+    limit: int = config.RECORDS_PAGE_SIZE,
+    cursor: Optional[str] = None,
+    order: str = "date_desc",
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    category: Optional[str] = None,
+    exported: Optional[bool] = None,
+    source: Optional[str] = None,
+    is_parking: Optional[bool] = None,
+    u_id: str = Depends(get_current_user)
+):
+    """レコード一覧をページ単位で取得（サブコレクション対応）
+
+    次のページは、レスポンスの next_cursor を cursor に指定して取得する（最終ページでは null）。
+    order: date_desc / date_asc / created_desc / created_asc / amount_desc / amount_asc
+    """
+    if order not in RECORD_ORDERS:
+        raise HTTPException(status_code=400, detail=f"並び順の指定が不正です: {order}")
+    if (start_date or end_date) and not order.startswith("date_"):
+        raise HTTPException(status_code=400, detail="日付で絞り込む場合は日付順（date_desc / date_asc）を指定してください")
+
+    filters = {
+        name: value
+        for name, value in (("category", category), ("exported", exported), ("source", source), ("is_parking", is_parking))
+        if value is not None
+    }
+    limit = max(1, min(limit, config.RECORDS_MAX_PAGE_SIZE))
+
+    try:
+        page = await get_user_records_page(u_id, filters, order, limit, start_date, end_date, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return {
+        "records": page["records"],
+        "count": len(page["records"]),
+        "next_cursor": page["next_cursor"]
+    }
+
 @router.put("/api/records/{record_id}")
 async def update_record(record_id: str, data: dict, u_id: str = Depends(get_current_user)):
     """レコードの情報を更新（サブコレクション対応）"""
@@ -148,7 +196,7 @@ async def update_record(record_id: str, data: dict, u_id: str = Depends(get_curr
 
         # サブコレクションからレコードを取得
         doc_ref = db.collection(config.COL_USERS).document(u_id).collection("records").document(record_id)
-        doc = doc_ref.get()
+        doc = await get_doc(doc_ref)
 
         if not doc.exists:
             raise HTTPException(status_code=404, detail="レコードが見つかりません")
@@ -172,9 +220,9 @@ async def update_record(record_id: str, data: dict, u_id: str = Depends(get_curr
         if "category" in data:
             update_data["category"] = data["category"]
 
-        # Firestoreを更新
+        # Firestoreを更新（集計も同じトランザクションで更新）
         if update_data:
-            doc_ref.update(update_data)
+            await run_db(update_records, u_id, [record_id], update_data)
             print(f"✅ Updated record {record_id}: {update_data}")
 
         return {"message": "更新しました", "id": record_id, "updated_fields": update_data}
@@ -194,36 +242,14 @@ async def delete_all_records(u_id: str = Depends(get_current_user)):
     print(f"User: {u_id}")
 
     records_ref = db.collection(config.COL_USERS).document(u_id).collection("records")
-    all_records = records_ref.stream()
-
-    deleted_count = 0
-    failed_count = 0
-
-    for doc in all_records:
-        try:
-            record_data = doc.to_dict()
-
-            # GCSから画像削除
-            image_url = record_data.get("image_url", "")
-            if image_url:
-                delete_from_gcs(image_url)
-
-            # PDF画像も削除
-            if record_data.get("is_pdf") and record_data.get("pdf_images"):
-                for pdf_img_url in record_data["pdf_images"]:
-                    delete_from_gcs(pdf_img_url)
+    record_ids = await run_db(lambda: [ref.id for ref in records_ref.list_documents()])
 
-            # Firestoreから削除
-            doc.reference.delete()
-            deleted_count += 1
-        except Exception as e:
-            print(f"Error deleting {doc.id}: {e}")
-            failed_count += 1
+    deleted_count, failed_count = await run_db(_delete_record_docs, u_id, record_ids)
 
     # 使用カウントをリセット
     if deleted_count > 0:
         try:
-            db.collection(config.COL_USERS).document(u_id).update({
+            await run_db(db.collection(config.COL_USERS).document(u_id).update, {
                 "subscription.used": 0
             })
         except Exception as e:
@@ -244,28 +270,18 @@ async def delete_record(record_id: str, u_id: str = Depends(get_current_user)):
     try:
         # サブコレクションからレコード取得
         doc_ref = db.collection(config.COL_USERS).document(u_id).collection("records").document(record_id)
-        doc = doc_ref.get()
+        doc = await get_doc(doc_ref)
 
         if not doc.exists:
             raise HTTPException(status_code=404, detail="レコードが見つかりません")
 
-        record_data = doc.to_dict()
-
-        # GCSから画像ファイルを削除
-        image_url = record_data.get("image_url", "")
-        if image_url:
-            delete_from_gcs(image_url)
-
-        # PDF画像も削除
-        if record_data.get("is_pdf") and record_data.get("pdf_images"):
-            for pdf_img_url in record_data["pdf_images"]:
-                delete_from_gcs(pdf_img_url)
-
-        # Firestoreからドキュメントを削除
-        doc_ref.delete()
+        # Firestoreドキュメント（集計を含む）とGCS画像を削除
+        deleted_count, _ = await run_db(_delete_record_docs, u_id, [record_id])
+        if deleted_count == 0:
+            raise HTTPException(status_code=500, detail="削除に失敗しました")
 
         # 使用カウントを減らす
-        db.collection(config.COL_USERS).document(u_id).update({
+        await run_db(db.collection(config.COL_USERS).document(u_id).update, {
             "subscription.used": firestore.Increment(-1)
         })
 
@@ -282,37 +298,11 @@ async def bulk_delete_records(data: dict, u_id: str = Depends(get_current_user))
     if not record_ids:
         raise HTTPException(status_code=400, detail="削除するレコードが指定されていません")
 
-    deleted_count = 0
-    failed_count = 0
-
-    for record_id in record_ids:
-        try:
-            # サブコレクションから削除
-            doc_ref = db.collection(config.COL_USERS).document(u_id).collection("records").document(record_id)
-            doc = doc_ref.get()
-
-            if doc.exists:
-                record_data = doc.to_dict()
-
-                # GCSから画像削除
-                image_url = record_data.get("image_url", "")
-                if image_url:
-                    delete_from_gcs(image_url)
-
-                # PDF画像も削除
-                if record_data.get("is_pdf") and record_data.get("pdf_images"):
-                    for pdf_img_url in record_data["pdf_images"]:
-                        delete_from_gcs(pdf_img_url)
-
-                doc_ref.delete()
-                deleted_count += 1
-        except Exception as e:
-            print(f"Error deleting {record_id}: {e}")
-            failed_count += 1
+    deleted_count, failed_count = await run_db(_delete_record_docs, u_id, record_ids)
 
     # 使用カウントを減らす
     if deleted_count > 0:
-        db.collection(config.COL_USERS).document(u_id).update({
+        await run_db(db.collection(config.COL_USERS).document(u_id).update, {
             "subscription.used": firestore.Increment(-deleted_count)
         })
 
@@ -339,9 +329,6 @@ async def bulk_update_records(data: dict, u_id: str = Depends(get_current_user))
     print(f"Record IDs: {record_ids}")
     print(f"Update fields: {update_fields}")
 
-    updated_count = 0
-    failed_count = 0
-
     # 更新データを準備
     update_data = {}
 
@@ -354,21 +341,12 @@ async def bulk_update_records(data: dict, u_id: str = Depends(get_current_user))
     if not update_data:
         raise HTTPException(status_code=400, detail="有効な更新フィールドがありません")
 
-    for record_id in record_ids:
-        try:
-            doc_ref = db.collection(config.COL_USERS).document(u_id).collection("records").document(record_id)
-            doc = doc_ref.get()
-
-            if doc.exists:
-                doc_ref.update(update_data)
-                updated_count += 1
-                print(f"[OK] Updated record {record_id}")
-            else:
-                print(f"[WARNING] Record {record_id} not found")
-                failed_count += 1
-        except Exception as e:
-            print(f"[ERROR] Failed to update {record_id}: {e}")
-            failed_count += 1
+    # 存在するレコードだけを更新（集計も同じトランザクションで更新）
+    updated_ids = await run_db(update_records, u_id, record_ids, update_data)
+    updated_count = len(updated_ids)
+    failed_count = len(record_ids) - updated_count
+    for record_id in set(record_ids) - set(updated_ids):
+        print(f"[WARNING] Record {record_id} not found")
 
     print(f"=== Bulk update complete ===")
     print(f"Updated: {updated_count}, Failed: {failed_count}")
@@ -382,67 +360,44 @@ async def bulk_update_records(data: dict, u_id: str = Depends(get_current_user))
 
 @router.post("/api/records/mark-exported")
 async def mark_records_exported(data: dict, u_id: str = Depends(get_current_user)):
-    """レコードを出力済みにマーク"""
+    """レコードを出力済みにマーク（export_id の場合はそのExcel出力に含めたレコード）"""
     record_ids = data.get("record_ids", [])
 
-    if not record_ids:
+    export_id = data.get("export_id")
+    if export_id:
+        manifest_ref = db.collection(config.COL_EXPORT_MANIFESTS).document(str(export_id))
+        manifest = await get_doc(manifest_ref)
+        if not manifest.exists or manifest.to_dict().get("user_id") != u_id:
+            raise HTTPException(status_code=404, detail="出力記録が見つかりません")
+        record_ids = manifest.to_dict().get("record_ids", [])
+        await run_db(manifest_ref.delete)
+        if not record_ids:
+            return {"message": "0件を出力済みにマークしました", "updated": 0}
+    elif not record_ids:
         raise HTTPException(status_code=400, detail="マークするレコードが指定されていません")
 
     print(f"=== Mark as exported ===")
     print(f"User: {u_id}, Records: {len(record_ids)} items")
 
-    updated_count = 0
-    for record_id in record_ids:
-        try:
-            doc_ref = db.collection(config.COL_USERS).document(u_id).collection("records").document(record_id)
-            doc = doc_ref.get()
-            if doc.exists:
-                doc_ref.update({"exported": True})
-                updated_count += 1
-        except Exception as e:
-            print(f"Error marking {record_id}: {e}")
+    updated_count = len(await run_db(update_records, u_id, record_ids, {"exported": True}))
 
     return {"message": f"{updated_count}件を出力済みにマークしました", "updated": updated_count}
 
 @router.post("/api/records/bulk-delete-exported")
 async def bulk_delete_exported(u_id: str = Depends(get_current_user)):
     """出力済みレコードを一括削除"""
-    from services.storage_service import delete_from_gcs
-
     print(f"=== Bulk delete exported records ===")
     print(f"User: {u_id}")
 
     # 出力済みレコードを取得
     records_ref = db.collection(config.COL_USERS).document(u_id).collection("records")
-    exported_records = records_ref.where("exported", "==", True).stream()
-
-    deleted_count = 0
-    failed_count = 0
-
-    for doc in exported_records:
-        try:
-            record_data = doc.to_dict()
-
-            # GCSから画像削除
-            image_url = record_data.get("image_url", "")
-            if image_url:
-                delete_from_gcs(image_url)
+    exported_records = await stream_docs(records_ref.where("exported", "==", True).select([]))
 
-            # PDF画像も削除
-            if record_data.get("is_pdf") and record_data.get("pdf_images"):
-                for pdf_img_url in record_data["pdf_images"]:
-                    delete_from_gcs(pdf_img_url)
-
-            # Firestoreから削除
-            doc.reference.delete()
-            deleted_count += 1
-        except Exception as e:
-            print(f"Error deleting {doc.id}: {e}")
-            failed_count += 1
+    deleted_count, failed_count = await run_db(_delete_record_docs, u_id, [doc.id for doc in exported_records])
 
     # 使用カウントを減らす
     if deleted_count > 0:
-        db.collection(config.COL_USERS).document(u_id).update({
+        await run_db(db.collection(config.COL_USERS).document(u_id).update, {
             "subscription.used": firestore.Increment(-deleted_count)
         })
 
@@ -0,0 +1,260 @@
+"""
+集計サービス
+ユーザーごとのレコード集計（件数・金額・カテゴリ別・月別など）を1つのドキュメントで管理
+"""
+import re
+from google.cloud import firestore
+from google.api_core import exceptions as google_exceptions
+from database import db
+from services import record_cache
+import config
+
+# 駐輪場キーワード（駐車場から除外）
+BICYCLE_KEYWORDS = ["駐輪", "自転車", "サイクル", "bicycle", "cycle"]
+# 駐車場キーワード（フォールバック用）
+PARKING_KEYWORDS = ["駐車", "パーキング", "コインパ", "parking", "P代"]
+
+# 1回のトランザクションで扱うレコード数（Firestoreの書き込み上限500件に集計ドキュメント分の余裕を残す）
+TRANSACTION_CHUNK_SIZE = 200
+# 再作成中に書き込みがあった場合のやり直し回数
+REBUILD_MAX_ATTEMPTS = 5
+
+_MONTH_PATTERN = re.compile(r"^\d{4}-\d{2}")
+
+
+def is_bicycle_parking(record: dict) -> bool:
+    """駐輪場かどうかを判定"""
+    vendor = (record.get("vendor_name") or "").lower()
+    return any(kw.lower() in vendor for kw in BICYCLE_KEYWORDS)
+
+
+def is_parking_record(record: dict) -> bool:
+    """駐車場かどうかを判定（Gemini解析結果のフラグを優先、駐輪場は除外）"""
+    # 駐輪場は駐車場に含めない
+    if is_bicycle_parking(record):
+        return False
+    # Geminiのis_parkingフラグを優先
+    if record.get("is_parking") == True:
+        return True
+    # フォールバック: キーワードマッチング
+    vendor = (record.get("vendor_name") or "").lower()
+    return any(kw.lower() in vendor for kw in PARKING_KEYWORDS)
+
+
+def is_ic_transport_record(record: dict) -> bool:
+    """ICカード交通費かどうかを判定
+
+    Gemini解析で「ICカード交通費」という文言が書類に明示的に
+    記載されている場合のみtrueとなる。
+    通常のレシートや交通系ICカードの利用履歴はfalse。
+    """
+    return record.get("is_ic_transport") == True
+
+
+def _amount(record: dict) -> int:
+    try:
+        return int(record.get("total_amount") or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def record_contribution(record: dict) -> dict:
+    """1件のレコードが集計に加える値（キーはフィールドのパス）"""
+    if not record:
+        return {}
+    amount = _amount(record)
+    values = {
+        ("count",): 1,
+        ("total_amount",): amount,
+        ("by_category", record.get("category") or "その他", "count"): 1,
+        ("by_category", record.get("category") or "その他", "amount"): amount,
+    }
+    if record.get("exported") != True:
+        values[("unexported_count",)] = 1
+    if is_parking_record(record):
+        values[("parking", "count")] = 1
+        values[("parking", "amount")] = amount
+    elif is_ic_transport_record(record):
+        values[("ic_transport", "count")] = 1
+        values[("ic_transport", "amount")] = amount
+    date = record.get("date") or ""
+    if _MONTH_PATTERN.match(date):
+        values[("by_month", date[:7], "count")] = 1
+        values[("by_month", date[:7], "amount")] = amount
+    return values
+
+
+def _delta(changes: list) -> dict:
+    """(変更前, 変更後) のリストから集計の差分を計算（変化のないパスは除く）"""
+    delta = {}
+    for old, new in changes:
+        for path, value in record_contribution(new).items():
+            delta[path] = delta.get(path, 0) + value
+        for path, value in record_contribution(old).items():
+            delta[path] = delta.get(path, 0) - value
+    return {path: value for path, value in delta.items() if value}
+
+
+def _nested(values: dict) -> dict:
+    """パスをキーにした値を入れ子の辞書にする
+
+    カテゴリ名（日本語・記号を含む）をドット区切りのフィールドパスとして解釈させないよう、
+    update ではなく入れ子の辞書 + merge で書き込む。
+    """
+    nested = {}
+    for path, value in values.items():
+        node = nested
+        for key in path[:-1]:
+            node = node.setdefault(key, {})
+        node[path[-1]] = value
+    return nested
+
+
+def aggregates_ref(u_id: str):
+    return db.collection(config.COL_RECORD_AGGREGATES).document(u_id)
+
+
+def apply_record_changes(writer, u_id: str, changes: list):
+    """レコードの変更に合わせた集計の増減を書き込みに追加（writer はバッチまたはトランザクション）
+
+    changes は (変更前のレコード, 変更後のレコード) のリスト。追加は変更前、削除は変更後を None にする。
+    レコードの書き込みと同じコミットに含めることで、集計がレコードとずれないようにする。
+    """
+    if not changes:
+        return
+    # 集計値が変わらない変更でも updated_at・version は更新する（レコードキャッシュの変更検知に使う）
+    # write_token はこのインスタンスの書き込みかどうかを監視側で見分けるための値
+    increments = {path: firestore.Increment(value) for path, value in _delta(changes).items()}
+    increments[("updated_at",)] = firestore.SERVER_TIMESTAMP
+    increments[("version",)] = firestore.Increment(1)
+    increments[("write_token",)] = record_cache.new_write_token()
+    writer.set(aggregates_ref(u_id), _nested(increments), merge=True)
+
+
+def _change_records(u_id: str, record_ids: list, build) -> list:
+    """レコードを読み込んで変更し、集計と一緒にトランザクションでコミット（同期処理）
+
+    build(変更前のレコード) は更新するフィールドの辞書、削除する場合は None を返す。
+    戻り値は変更したレコードの (ID, 変更前のレコード) のリスト。存在しないIDは含まれない。
+    """
+    records_ref = db.collection(config.COL_USERS).document(u_id).collection("records")
+    changed = []
+
+    for start in range(0, len(record_ids), TRANSACTION_CHUNK_SIZE):
+        refs = [records_ref.document(record_id) for record_id in record_ids[start:start + TRANSACTION_CHUNK_SIZE]]
+
+        @firestore.transactional
+        def run(transaction):
+            results, changes = [], []
+            for snapshot in transaction.get_all(refs):
+                if not snapshot.exists:
+                    continue
+                old = snapshot.to_dict()
+                fields = build(old)
+                if fields is None:
+                    transaction.delete(snapshot.reference)
+                    changes.append((old, None))
+                else:
+                    transaction.update(snapshot.reference, fields)
+                    changes.append((old, {**old, **fields}))
+                results.append((snapshot.id, old))
+            apply_record_changes(transaction, u_id, changes)
+            return results
+
+        changed.extend(run(db.transaction()))
+    return changed
+
+
+def update_records(u_id: str, record_ids: list, fields: dict) -> list:
+    """レコードを更新して集計・レコードキャッシュに反映（戻り値は更新したレコードのID）"""
+    try:
+        updated = [record_id for record_id, _ in _change_records(u_id, record_ids, lambda old: fields)]
+    except Exception:
+        # 一部のトランザクションだけコミットされた可能性がある
+        record_cache.invalidate(u_id)
+        raise
+    record_cache.patch_records(u_id, updated, fields)
+    return updated
+
+
+def delete_records(u_id: str, record_ids: list) -> list:
+    """レコードを削除して集計・レコードキャッシュに反映（戻り値は削除したレコードの (ID, 削除前のレコード)）"""
+    try:
+        deleted = _change_records(u_id, record_ids, lambda old: None)
+    except Exception:
+        record_cache.invalidate(u_id)
+        raise
+    record_cache.remove_records(u_id, [record_id for record_id, _ in deleted])
+    return deleted
+
+
+def _empty_aggregates() -> dict:
+    return {
+        "count": 0,
+        "total_amount": 0,
+        "unexported_count": 0,
+        "parking": {"count": 0, "amount": 0},
+        "ic_transport": {"count": 0, "amount": 0},
+        "by_category": {},
+        "by_month": {},
+    }
+
+
+def _summarize(data: dict) -> dict:
+    """集計ドキュメントを応答用に整形（件数0になったカテゴリ・月は除く）"""
+    summary = _empty_aggregates()
+    for key in ("count", "total_amount", "unexported_count"):
+        summary[key] = data.get(key, 0)
+    for key in ("parking", "ic_transport"):
+        summary[key].update(data.get(key, {}))
+    for key in ("by_category", "by_month"):
+        summary[key] = {
+            name: {"count": values.get("count", 0), "amount": values.get("amount", 0)}
+            for name, values in sorted((data.get(key) or {}).items())
+            if values.get("count", 0) > 0
+        }
+    return summary
+
+
+def rebuild_aggregates(u_id: str) -> dict:
+    """全レコードから集計を計算し直して上書き（ずれの修復・導入前のレコードの取り込み用、同期処理）
+
+    レコードの書き込みは必ず集計ドキュメントの更新と同じコミットで行われるため、
+    読み込み開始時の集計ドキュメントの更新時刻を前提条件にして書き込む。
+    集計中に他の書き込みがあった場合は前提条件が満たされず、読み込みからやり直す。
+    """
+    records_ref = db.collection(config.COL_USERS).document(u_id).collection("records")
+    doc_ref = aggregates_ref(u_id)
+
+    for attempt in range(1, REBUILD_MAX_ATTEMPTS + 1):
+        snapshot = doc_ref.get()
+        totals = {}
+        for record in records_ref.stream():
+            for path, value in record_contribution(record.to_dict()).items():
+                totals[path] = totals.get(path, 0) + value
+
+        data = _empty_aggregates()
+        data.update(_nested(totals))
+        # トップレベルのフィールドを丸ごと置き換える（updateでも set と同じ結果になる）
+        fields = {**data, "updated_at": firestore.SERVER_TIMESTAMP, "rebuilt_at": firestore.SERVER_TIMESTAMP}
+        try:
+            if snapshot.exists:
+                doc_ref.update(fields, option=db.write_option(last_update_time=snapshot.update_time))
+            else:
+                doc_ref.create(fields)
+        except (google_exceptions.FailedPrecondition, google_exceptions.Conflict):
+            print(f"⚠️ Aggregates changed during rebuild for {u_id}, retrying ({attempt}/{REBUILD_MAX_ATTEMPTS})")
+            continue
+        print(f"[OK] Aggregates rebuilt for {u_id}: {data['count']} records")
+        return _summarize(data)
+
+    raise RuntimeError(f"集計の再作成中に書き込みが続いたため完了できませんでした: {u_id}")
+
+
+def get_aggregates(u_id: str) -> dict:
+    """ユーザーの集計を取得（同期処理）
+
+    読み取りの途中で作り直すことはしない（導入前のレコードは rebuild_aggregates.py で取り込む）。
+    """
+    doc = aggregates_ref(u_id).get()
+    return _summarize(doc.to_dict() if doc.exists else {})
@@ -0,0 +1,123 @@
+"""
+解析結果キャッシュサービス
+同一画像のGemini解析結果を再利用する（メモリLRU + Firestore）
+"""
+import copy
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from google.cloud import firestore
+from database import db
+from models.receipt import RECEIPT_LIST_SCHEMA
+from utils import metrics
+import config
+
+# プロンプトや出力スキーマが変わればキーも変わり、古い結果は参照されなくなる
+PROMPT_HASH = hashlib.sha256(
+    (config.GEMINI_PROMPT + json.dumps(RECEIPT_LIST_SCHEMA, sort_keys=True)).encode("utf-8")
+).hexdigest()[:16]
+
+_lru = OrderedDict()
+_lock = threading.Lock()
+
+
+def make_cache_key(file_bytes: bytes, model_name: str) -> str:
+    """キャッシュキーを生成（ファイル内容のSHA-256 + プロンプトハッシュ + モデル名）"""
+    file_hash = hashlib.sha256(file_bytes).hexdigest()
+    return hashlib.sha256(f"{file_hash}:{PROMPT_HASH}:{model_name}".encode("utf-8")).hexdigest()
+
+
+def _remember(key: str, result):
+    """メモリLRUに格納（上限を超えたら古いものから破棄）"""
+    with _lock:
+        _lru[key] = result
+        _lru.move_to_end(key)
+        while len(_lru) > config.ANALYSIS_CACHE_MEMORY_SIZE:
+            _lru.popitem(last=False)
+
+
+def get_cached_result(*keys: str):
+    """キャッシュから解析結果を取得（なければNone）
+
+    複数のキーを渡した場合は先に指定したものを優先し、Firestoreは1回の読み込みで確認する。
+    ヒット・ミスは呼び出し1回につき1件として数える。
+    """
+    if not config.ANALYSIS_CACHE_ENABLED:
+        return None
+    keys = list(dict.fromkeys(key for key in keys if key))
+
+    result = None
+    with _lock:
+        for key in keys:
+            result = _lru.get(key)
+            if result is not None:
+                _lru.move_to_end(key)
+                break
+
+    if result is not None:
+        metrics.incr("analysis_cache.hit_memory")
+        return copy.deepcopy(result)
+
+    collection = db.collection(config.COL_ANALYSIS_CACHE)
+    try:
+        docs = {doc.id: doc for doc in db.get_all([collection.document(key) for key in keys])}
+    except Exception as e:
+        print(f"⚠️ Analysis cache read error: {str(e)}")
+        metrics.incr("analysis_cache.error")
+        return None
+
+    now = datetime.now(timezone.utc)
+    for key in keys:
+        doc = docs.get(key)
+        if doc is None or not doc.exists:
+            continue
+        data = doc.to_dict()
+        # TTLポリシーによる削除は遅れることがあるため、期限切れのものは使わない
+        expires_at = data.get("expires_at")
+        if data.get("result") is None or (expires_at is not None and expires_at <= now):
+            continue
+        metrics.incr("analysis_cache.hit_firestore")
+        _remember(key, data["result"])
+        return copy.deepcopy(data["result"])
+
+    metrics.incr("analysis_cache.miss")
+    return None
+
+
+def store_result(key: str, result, model_name: str):
+    """解析結果をキャッシュに保存"""
+    if not config.ANALYSIS_CACHE_ENABLED:
+        return
+
+    _remember(key, copy.deepcopy(result))
+    try:
+        db.collection(config.COL_ANALYSIS_CACHE).document(key).set({
+            "result": result,
+            "model": model_name,
+            "prompt_hash": PROMPT_HASH,
+            "created_at": firestore.SERVER_TIMESTAMP,
+            # Firestore の TTL ポリシー（analysis_cache コレクションの expires_at）で削除される時刻
+            "expires_at": datetime.now(timezone.utc) + timedelta(seconds=config.ANALYSIS_CACHE_RETENTION_SECONDS)
+        })
+        metrics.incr("analysis_cache.store")
+    except Exception as e:
+        print(f"⚠️ Analysis cache write error: {str(e)}")
+        metrics.incr("analysis_cache.error")
+
+
+def get_cache_stats() -> dict:
+    """ヒット率などの統計を取得"""
+    hits = metrics.get_counter("analysis_cache.hit_memory") + metrics.get_counter("analysis_cache.hit_firestore")
+    misses = metrics.get_counter("analysis_cache.miss")
+    with _lock:
+        size = len(_lru)
+    return {
+        "enabled": config.ANALYSIS_CACHE_ENABLED,
+        "memory_entries": size,
+        "hit_memory": metrics.get_counter("analysis_cache.hit_memory"),
+        "hit_firestore": metrics.get_counter("analysis_cache.hit_firestore"),
+        "miss": misses,
+        "hit_rate": round(hits / (hits + misses), 3) if hits + misses else None
+    }
@@ -0,0 +1,272 @@
+"""
+Gemini 呼び出しゲート
+プロセス全体で共有する同時実行数の自動調整（AIMD）・レート制限・サーキットブレーカー
+"""
+import time
+import threading
+from contextlib import contextmanager
+from google.api_core import exceptions as google_exceptions
+from utils import metrics
+import config
+
+# 過負荷とみなすエラー（同時実行数を減らし、ブレーカーの失敗として数える）
+OVERLOAD_ERRORS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.TooManyRequests,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.InternalServerError,
+)
+
+# これより短い応答時間の差は遅延とみなさない（基準値が極端に小さい場合の誤判定防止）
+LATENCY_FLOOR_MS = 100.0
+
+
+class GeminiOverloadedError(Exception):
+    """ゲートがリクエストを受け付けなかった（ブレーカー作動中・待ち時間超過）"""
+
+    def __init__(self, message: str, retry_after: float = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """トークンバケット方式のレート制限（rate: 毎秒の補充数 / burst: 最大保持数）"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def take(self, deadline: float) -> bool:
+        """トークンを1つ取得（なければ補充を待つ。期限までに取れなければFalse）"""
+        if self.rate <= 0:
+            return True
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            if now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    @property
+    def tokens(self) -> float:
+        with self._lock:
+            self._refill(time.monotonic())
+            return self._tokens
+
+
+class GeminiGate:
+    """Gemini API 呼び出しの入口
+
+    - 同時実行数: 成功ごとに少しずつ増やし、過負荷エラーや応答遅延で半減する（AIMD）
+    - レート制限: トークンバケットで毎秒のリクエスト数を抑える
+    - サーキットブレーカー: 過負荷エラーが続いたら一定時間遮断し、その後1件だけ試して復帰を判断する
+      遮断中は open_mode に応じて即失敗（fail）または復帰まで待機（queue）する
+    ワーカースレッドから呼ばれる前提（待機はスレッドをブロックする）。
+    """
+
+    def __init__(self, min_limit: int, max_limit: int, initial_limit: int, rate: float, burst: int,
+                 failure_threshold: int, open_seconds: float, open_mode: str, acquire_timeout: float,
+                 latency_tolerance: float):
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.initial_limit = min(self.max_limit, max(self.min_limit, initial_limit))
+        self.failure_threshold = max(1, failure_threshold)
+        self.open_seconds = open_seconds
+        self.open_mode = open_mode
+        self.acquire_timeout = acquire_timeout
+        self.latency_tolerance = latency_tolerance
+        self.bucket = TokenBucket(rate, burst)
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._waiting = 0
+        self._probe_in_flight = False
+        self._reset_state()
+
+    def _reset_state(self):
+        """同時実行数の調整とブレーカーの状態を初期値に戻す
+
+        実行中・待機中の数と復帰確認中のフラグは、枠を持っている呼び出しが release で戻すため変更しない。
+        """
+        self._limit = float(self.initial_limit)
+        self._baseline_ms = None
+        self._last_decrease = 0.0
+        self._state = "closed"
+        self._failures = 0
+        self._opened_until = 0.0
+
+    def reset(self):
+        """同時実行数の調整とブレーカーを初期値に戻す（管理者用、実行中の呼び出しはそのまま）"""
+        with self._cond:
+            self._reset_state()
+            self._cond.notify_all()
+        print("[OK] Gemini gate reset")
+
+    def _check_breaker(self, now: float):
+        """ブレーカーの状態を判定（通せない場合は待つべき秒数、通せる場合はNone）"""
+        if self._state == "open":
+            if now < self._opened_until:
+                return self._opened_until - now
+            self._state = "half_open"
+            metrics.incr("gemini_gate.half_open")
+        if self._state == "half_open":
+            if self._probe_in_flight:
+                return 0.5
+            return None
+        return None
+
+    def acquire(self) -> bool:
+        """実行枠を取得（戻り値: 復帰確認用の試行リクエストかどうか）"""
+        started = time.monotonic()
+        deadline = started + self.acquire_timeout
+
+        with self._cond:
+            self._waiting += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait = self._check_breaker(now)
+                    if wait is not None:
+                        if self.open_mode == "fail" or now + wait > deadline:
+                            metrics.incr("gemini_gate.rejected")
+                            raise GeminiOverloadedError(
+                                "Gemini APIが混雑しているため、しばらくしてから再度お試しください",
+                                retry_after=round(max(wait, 1.0), 1)
+                            )
+                        self._cond.wait(min(wait, deadline - now))
+                        continue
+                    if self._in_flight < int(self._limit):
+                        break
+                    if now >= deadline:
+                        metrics.incr("gemini_gate.rejected")
+                        raise GeminiOverloadedError("Gemini APIの処理待ちがタイムアウトしました")
+                    self._cond.wait(deadline - now)
+
+                probe = self._state == "half_open"
+                if probe:
+                    self._probe_in_flight = True
+                self._in_flight += 1
+            finally:
+                self._waiting -= 1
+
+        # レート制限（同時実行枠を確保したまま待つ）
+        if not self.bucket.take(deadline):
+            self.release(probe, success=False, overloaded=False, latency_ms=None)
+            metrics.incr("gemini_gate.rejected")
+            raise GeminiOverloadedError("Gemini APIのリクエスト数が上限に達しています")
+
+        metrics.observe("gemini_gate.wait_ms", (time.monotonic() - started) * 1000)
+        return probe
+
+    def release(self, probe: bool, success: bool, overloaded: bool, latency_ms: float = None):
+        """実行枠を返却し、結果に応じて同時実行数とブレーカーを更新"""
+        with self._cond:
+            self._in_flight -= 1
+            if probe:
+                self._probe_in_flight = False
+
+            now = time.monotonic()
+            slow = False
+            if success and latency_ms is not None:
+                if self._baseline_ms is None:
+                    self._baseline_ms = latency_ms
+                slow = latency_ms > max(self._baseline_ms, LATENCY_FLOOR_MS) * self.latency_tolerance
+                # 基準値はゆっくり追従させる（遅延が続いた場合も基準が上がりきらないように）
+                self._baseline_ms = self._baseline_ms * 0.95 + min(latency_ms, max(self._baseline_ms, LATENCY_FLOOR_MS) * 2) * 0.05
+
+            if overloaded or slow:
+                # 乗法的減少（連続した失敗で一気に下がりすぎないよう1秒に1回まで）
+                if now - self._last_decrease >= 1.0:
+                    self._limit = max(self.min_limit, self._limit / 2)
+                    self._last_decrease = now
+                    metrics.incr("gemini_gate.decrease")
+            elif success:
+                # 加法的増加（同時実行数ぶん成功するとおよそ+1）
+                self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+
+            if overloaded:
+                self._failures += 1
+                metrics.incr("gemini_gate.overloaded")
+                if probe or self._failures >= self.failure_threshold:
+                    if self._state != "open":
+                        print(f"⚠️ Gemini circuit opened ({self._failures} consecutive overload errors)")
+                        metrics.incr("gemini_gate.opened")
+                    self._state = "open"
+                    self._opened_until = now + self.open_seconds
+            elif success:
+                self._failures = 0
+                if self._state == "half_open" and probe:
+                    print("[OK] Gemini circuit closed")
+                    self._state = "closed"
+
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self):
+        """with文で実行枠を確保（例外の種類から結果を判定）"""
+        probe = self.acquire()
+        started = time.perf_counter()
+        try:
+            yield
+        except OVERLOAD_ERRORS:
+            self.release(probe, success=False, overloaded=True)
+            raise
+        except Exception:
+            # 入力不正・応答不正などはGemini側の負荷とは無関係
+            self.release(probe, success=False, overloaded=False)
+            raise
+        else:
+            self.release(probe, success=True, overloaded=False,
+                         latency_ms=(time.perf_counter() - started) * 1000)
+
+    def is_open(self) -> bool:
+        """ブレーカーが遮断中か（即失敗モードでの事前チェック用）"""
+        with self._cond:
+            return self._state == "open" and time.monotonic() < self._opened_until
+
+    def get_state(self) -> dict:
+        """現在の状態を取得"""
+        with self._cond:
+            now = time.monotonic()
+            return {
+                "limit": round(self._limit, 2),
+                "min_limit": self.min_limit,
+                "max_limit": self.max_limit,
+                "in_flight": self._in_flight,
+                "waiting": self._waiting,
+                "latency_baseline_ms": round(self._baseline_ms, 1) if self._baseline_ms is not None else None,
+                "rate_per_sec": self.bucket.rate,
+                "tokens": round(self.bucket.tokens, 2),
+                "circuit": {
+                    "state": self._state,
+                    "open_mode": self.open_mode,
+                    "consecutive_failures": self._failures,
+                    "reopens_in_seconds": round(max(0.0, self._opened_until - now), 1) if self._state == "open" else 0
+                }
+            }
+
+
+gemini_gate = GeminiGate(
+    min_limit=config.GEMINI_GATE_MIN_CONCURRENCY,
+    max_limit=config.GEMINI_GATE_MAX_CONCURRENCY,
+    initial_limit=config.GEMINI_GATE_INITIAL_CONCURRENCY,
+    rate=config.GEMINI_GATE_RATE_PER_SEC,
+    burst=config.GEMINI_GATE_BURST,
+    failure_threshold=config.GEMINI_GATE_FAILURE_THRESHOLD,
+    open_seconds=config.GEMINI_GATE_OPEN_SECONDS,
+    open_mode=config.GEMINI_GATE_OPEN_MODE,
+    acquire_timeout=config.GEMINI_GATE_ACQUIRE_TIMEOUT_SECONDS,
+    latency_tolerance=config.GEMINI_GATE_LATENCY_TOLERANCE
+)
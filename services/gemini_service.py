@@ -4,100 +4,727 @@ Gemini AI サービス
 """
 import time
 import json
-import re
-from datetime import datetime
+import random
+import hashlib
+import threading
+import mimetypes
+from datetime import timedelta
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
+from pydantic import ValidationError
+from models.receipt import RECEIPT_LIST_SCHEMA, BATCH_RESULT_SCHEMA, parse_receipts, parse_batch
+from services.analysis_cache import make_cache_key, get_cached_result, store_result
+from services.gemini_gate import gemini_gate, GeminiOverloadedError
+from services.scheduler import slot_released
+from services.pdf_text_service import extract_pdf_text
+from utils import metrics
+from utils.executors import get_hedge_executor
 import config
 
 # Gemini 設定
 genai.configure(api_key=config.GEMINI_API_KEY)
-model = genai.GenerativeModel('gemini-2.5-pro')
+# 応答はスキーマ付きJSONで受け取る（フェンス除去やパース失敗による再試行を不要にする）
+GENERATION_CONFIG = genai.GenerationConfig(
+    response_mime_type="application/json",
+    response_schema=RECEIPT_LIST_SCHEMA
+)
+# PDFのテキストレイヤーを送る場合の前置き
+PDF_TEXT_INSTRUCTION = "以下は領収書・明細書PDFから抽出したテキストです（レイアウトは空白で表現）。画像の代わりにこのテキストを解析してください。\n\n"
 
+# 複数画像をまとめて解析する場合の出力形式
+BATCH_GENERATION_CONFIG = genai.GenerationConfig(
+    response_mime_type="application/json",
+    response_schema=BATCH_RESULT_SCHEMA
+)
+BATCH_INSTRUCTION = (
+    "上記の{count}枚の画像はそれぞれ別の書類です。各画像の直前にある「=== 画像 N ===」の番号Nを image_index とし、"
+    "画像ごとに以下のルールで解析した結果を receipts 配列に入れてください。画像をまたいで内容を混ぜないでください。"
+)
 
-def validate_and_fix_date(date_str: str) -> str:
-    """日付を検証し、和暦変換ミスを修正する"""
-    if not date_str:
-        return date_str
+_models = {}
+_models_lock = threading.Lock()
 
+
+def _get_model(model_name: str):
+    """モデル名ごとの GenerativeModel を取得（初回のみ生成）"""
+    with _models_lock:
+        if model_name not in _models:
+            _models[model_name] = genai.GenerativeModel(model_name, generation_config=GENERATION_CONFIG)
+        return _models[model_name]
+
+
+class GeminiAnalysisError(Exception):
+    """Gemini解析の失敗（kind: classify_error の分類）"""
+
+    def __init__(self, message: str, kind: str):
+        super().__init__(message)
+        self.kind = kind
+
+# リトライ設定（エラー種別ごとのバックオフ基準秒・上限秒）
+RETRY_BASE_SECONDS = {"transient": 1.0, "parse": 0.5, "quota": 5.0}
+RETRY_MAX_SECONDS = {"transient": 8.0, "parse": 2.0, "quota": 60.0}
+
+# コンテキストキャッシュの作成に失敗した後、再作成を試みるまでの秒数
+CONTEXT_CACHE_RETRY_SECONDS = 600
+
+
+class PromptCache:
+    """システムプロンプト（config.GEMINI_PROMPT）のコンテキストキャッシュを管理
+
+    remote: Gemini のキャッシュ済みコンテンツを作成し、以降は画像だけを送信する
+    local : ネットワークを使わないスタブ（system_instruction にプロンプトを設定したモデルを返す）
+    off   : 使用しない（毎回プロンプトを送信）
+    TTL切れ・プロンプト変更時は作り直し、作成に失敗した場合はしばらく通常送信に戻す。
+    プロンプトが最小トークン数に届かない場合は、プロンプトが変わるまで作成を試みない。
+    作成（ネットワーク呼び出し）はロックの外で1スレッドだけが行い、その間の他の呼び出しは通常送信する。
+    """
+
+    def __init__(self, mode: str, ttl_seconds: int):
+        self.mode = mode
+        self.ttl_seconds = ttl_seconds
+        self._entries = {}  # モデル名 → {"model", "prompt_hash", "expires_at", "name"}
+        self._disabled_until = {}
+        self._too_small = {}  # モデル名 → 最小トークン数に届かなかったプロンプトのハッシュ
+        self._creating = set()
+        self._lock = threading.Lock()
+
+    def get_model(self, model_name: str):
+        """キャッシュ済みプロンプトを使うモデルを取得（使えない場合はNone）"""
+        if self.mode == "off":
+            return None
+
+        prompt_hash = hashlib.sha256(config.GEMINI_PROMPT.encode("utf-8")).hexdigest()
+        now = time.time()
+
+        with self._lock:
+            if self._disabled_until.get(model_name, 0) > now or self._too_small.get(model_name) == prompt_hash:
+                return None
+
+            entry = self._entries.get(model_name)
+            # 期限の1分前、またはプロンプトが変わったら作り直す
+            if entry and entry["prompt_hash"] == prompt_hash and entry["expires_at"] - 60 > now:
+                metrics.incr("gemini.context_cache.reuse")
+                return entry["model"]
+
+            # 他のスレッドが作成中なら待たずに通常送信する
+            if model_name in self._creating:
+                return None
+            self._creating.add(model_name)
+
+        try:
+            entry = self._create(model_name, prompt_hash, now)
+        except Exception as e:
+            print(f"⚠️ Context cache create failed ({model_name}): {str(e)}")
+            metrics.incr("gemini.context_cache.create_error")
+            entry = None
+        finally:
+            with self._lock:
+                self._creating.discard(model_name)
+
+        with self._lock:
+            if entry is None:
+                self._entries.pop(model_name, None)
+                if self._too_small.get(model_name) != prompt_hash:
+                    self._disabled_until[model_name] = now + CONTEXT_CACHE_RETRY_SECONDS
+                return None
+            self._entries[model_name] = entry
+        metrics.incr("gemini.context_cache.create")
+        print(f"✅ Context cache ready: {entry['name']} ({model_name})")
+        return entry["model"]
+
+    def invalidate(self, model_name: str):
+        """サーバー側で失効したキャッシュを破棄"""
+        with self._lock:
+            self._entries.pop(model_name, None)
+        metrics.incr("gemini.context_cache.invalidated")
+
+    def _prompt_too_small(self, model_name: str, prompt_hash: str) -> bool:
+        """プロンプトがキャッシュの最小トークン数に届かないか確認（届かない場合は記録する）"""
+        tokens = _get_model(model_name).count_tokens(config.GEMINI_PROMPT).total_tokens
+        if tokens >= config.GEMINI_CONTEXT_CACHE_MIN_TOKENS:
+            return False
+        print(f"ℹ️ Context cache skipped ({model_name}): prompt has {tokens} tokens "
+              f"(minimum {config.GEMINI_CONTEXT_CACHE_MIN_TOKENS})")
+        metrics.incr("gemini.context_cache.too_small")
+        with self._lock:
+            self._too_small[model_name] = prompt_hash
+        return True
+
+    def _create(self, model_name: str, prompt_hash: str, now: float):
+        """キャッシュを作成（プロンプトが最小トークン数に届かない場合はNone）"""
+        if self.mode == "local":
+            cached_model = genai.GenerativeModel(
+                model_name,
+                system_instruction=config.GEMINI_PROMPT,
+                generation_config=GENERATION_CONFIG
+            )
+            name = f"local/{prompt_hash[:12]}"
+        else:
+            if self._prompt_too_small(model_name, prompt_hash):
+                return None
+            cached_content = genai.caching.CachedContent.create(
+                model=f"models/{model_name}",
+                display_name=f"receipt-prompt-{prompt_hash[:12]}",
+                system_instruction=config.GEMINI_PROMPT,
+                ttl=timedelta(seconds=self.ttl_seconds)
+            )
+            cached_model = genai.GenerativeModel.from_cached_content(
+                cached_content=cached_content,
+                generation_config=GENERATION_CONFIG
+            )
+            name = cached_content.name
+
+        return {
+            "model": cached_model,
+            "prompt_hash": prompt_hash,
+            "expires_at": now + self.ttl_seconds,
+            "name": name
+        }
+
+prompt_cache = PromptCache(config.GEMINI_CONTEXT_CACHE, config.GEMINI_CONTEXT_CACHE_TTL_SECONDS)
+
+
+def _generate(model_name: str, parts: list, generation_config=None):
+    """生成リクエストを送信（キャッシュ済みプロンプトがあれば画像のみ送信）
+
+    呼び出しはすべて共有ゲート（同時実行数・レート制限・ブレーカー）を通す。
+    """
+    cached_model = prompt_cache.get_model(model_name)
+    if cached_model is not None:
+        try:
+            with gemini_gate.slot():
+                response = cached_model.generate_content(parts, generation_config=generation_config)
+            _record_usage(response)
+            return response
+        except google_exceptions.NotFound as e:
+            # TTL前にサーバー側で失効した場合はプロンプト付きで送り直す
+            print(f"⚠️ Cached content not found, falling back: {str(e)}")
+            prompt_cache.invalidate(model_name)
+
+    with gemini_gate.slot():
+        response = _get_model(model_name).generate_content(parts + [config.GEMINI_PROMPT], generation_config=generation_config)
+    _record_usage(response)
+    return response
+
+
+def _record_usage(response):
+    """入力トークン数（うちキャッシュ分）を記録"""
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    metrics.observe("gemini.prompt_tokens", usage.prompt_token_count)
+    metrics.observe("gemini.cached_tokens", getattr(usage, "cached_content_token_count", 0))
+
+
+def _guess_mime_type(file_path: str) -> str:
+    """拡張子からMIMEタイプを判定"""
+    mime_type, _ = mimetypes.guess_type(file_path)
+    return mime_type or "application/octet-stream"
+
+
+# リクエストのJSON構造・区切りなど、ファイルとプロンプト以外の分の見積もり
+_REQUEST_OVERHEAD_BYTES = 16 * 1024
+
+
+def _request_bytes(file_sizes: list, text: str = "") -> int:
+    """ファイルをインラインで送る場合のリクエストサイズの見積もり（base64で4/3倍 + プロンプト + text）"""
+    encoded = sum((size + 2) // 3 * 4 for size in file_sizes)
+    return encoded + len((config.GEMINI_PROMPT + text).encode("utf-8")) + _REQUEST_OVERHEAD_BYTES
+
+
+# Files APIの実測の中央値を見積もりに使うのに必要なサンプル数
+FILES_API_BASELINE_MIN_SAMPLES = 10
+
+
+def _files_api_baseline_ms() -> float:
+    """Files APIで送った場合の所要時間の見積もり（実測が十分あれば中央値、なければ設定値）"""
+    if metrics.sample_count("gemini.files_api_ms") >= FILES_API_BASELINE_MIN_SAMPLES:
+        return metrics.percentile("gemini.files_api_ms", 50)
+    return config.GEMINI_FILES_API_BASELINE_MS
+
+
+def _prepare_file_part(file_path: str, file_bytes: bytes):
+    """Geminiに渡すファイルパートを準備
+
+    リクエスト全体が上限に収まるファイルはバイト列をそのままリクエストに含める。
+    収まらない大きなファイルのみFiles APIでアップロードし、処理完了を待つ。
+    """
+    mime_type = _guess_mime_type(file_path)
+    metrics.observe("gemini.bytes_sent", len(file_bytes))
+
+    started = time.perf_counter()
+    if _request_bytes([len(file_bytes)]) <= config.GEMINI_REQUEST_MAX_BYTES:
+        part = {"mime_type": mime_type, "data": file_bytes}
+        # Files APIで送った場合と比べて短縮した時間（見積もり）を呼び出しごとに記録
+        inline_ms = (time.perf_counter() - started) * 1000
+        metrics.incr("gemini.inline_calls")
+        metrics.observe("gemini.inline_saved_ms", max(0.0, _files_api_baseline_ms() - inline_ms))
+        return part
+
+
+    # ファイルをアップロード
+    with gemini_gate.slot():
+        genai_file = genai.upload_file(path=file_path, mime_type=mime_type)
+
+    # 処理待ち（短い間隔から徐々に延ばす）
+    poll_interval = 0.25
+    while genai_file.state.name == "PROCESSING":
+        time.sleep(poll_interval)
+        poll_interval = min(poll_interval * 2, 2.0)
+        genai_file = genai.get_file(genai_file.name)
+
+    metrics.incr("gemini.files_api_calls")
+    metrics.observe("gemini.files_api_ms", (time.perf_counter() - started) * 1000)
+    return genai_file
+
+
+def classify_error(e: Exception) -> str:
+    """エラーを分類（quota: 利用上限 / invalid: 入力不正 / parse: 応答不正 / overloaded: ゲートで拒否 / transient: 一時的）"""
+    if isinstance(e, GeminiOverloadedError):
+        return "overloaded"
+    if isinstance(e, (json.JSONDecodeError, ValidationError)):
+        return "parse"
+    if isinstance(e, google_exceptions.ResourceExhausted):
+        return "quota"
+    if isinstance(e, (google_exceptions.InvalidArgument, google_exceptions.FailedPrecondition,
+                      google_exceptions.PermissionDenied, google_exceptions.Unauthenticated)):
+        return "invalid"
+    if isinstance(e, (genai.types.BlockedPromptException, genai.types.StopCandidateException)):
+        return "invalid"
+    if isinstance(e, ValueError):
+        # 空の応答・想定外の構造など（再生成で直る可能性がある）
+        return "parse"
+    return "transient"
+
+
+def _backoff_seconds(kind: str, attempt: int) -> float:
+    """ジッター付き指数バックオフの待ち時間（quotaは長め・下限あり）"""
+    ceiling = min(RETRY_MAX_SECONDS[kind], RETRY_BASE_SECONDS[kind] * (2 ** attempt))
+    if kind == "quota":
+        return ceiling / 2 + random.uniform(0, ceiling / 2)
+    return random.uniform(0, ceiling)
+
+
+def _run_stage(stage: str, func, max_retries: int):
+    """1つの段階だけをリトライ実行（入力不正は即失敗）"""
+    for attempt in range(max_retries):
+        try:
+            return func()
+        except Exception as e:
+            kind = classify_error(e)
+            metrics.incr(f"gemini.error.{kind}")
+            print(f"❌ Gemini {stage} error [{kind}] (attempt {attempt + 1}/{max_retries}): {str(e)}")
+
+            if kind == "invalid":
+                raise GeminiAnalysisError(f"Gemini API解析に失敗しました（入力エラー）: {str(e)}", kind)
+            if kind == "overloaded":
+                # ゲート側で待機済みのため、呼び出し元ごとのバックオフは重ねない
+                raise GeminiAnalysisError(str(e), kind)
+            if attempt == max_retries - 1:
+                raise GeminiAnalysisError(f"Gemini API解析に失敗しました（{max_retries}回試行）: {str(e)}", kind)
+
+            wait_time = _backoff_seconds(kind, attempt)
+            metrics.incr(f"gemini.retry.{stage}")
+            print(f"Retrying {stage} in {wait_time:.1f} seconds...")
+            if kind == "quota":
+                # 長い待機の間は解析枠を手放して他の処理を通す（待機後は改めて順番を待つ）
+                with slot_released():
+                    time.sleep(wait_time)
+            else:
+                time.sleep(wait_time)
+
+
+def _parse_response(text: str) -> list:
+    """スキーマ付きJSON応答を検証して型付きの領収書リストに変換（日付はモデル側で修正）"""
+    if not text:
+        raise ValueError("Gemini APIからの応答が空です")
+
+    return parse_receipts(text)
+
+
+def get_plan_models(plan: str = None) -> dict:
+    """プランに応じた解析モデル（fast / pro）を取得"""
+    plan_info = config.PLANS.get(plan or "free", config.PLANS["free"])
+    models = plan_info.get("models", {})
+    return {
+        "fast": models.get("fast", config.GEMINI_FAST_MODEL),
+        "pro": models.get("pro", config.GEMINI_PRO_MODEL)
+    }
+
+
+def escalation_reason(receipts: list):
+    """高精度モデルで再解析すべき理由を返す（問題なければNone）"""
+    if not receipts:
+        return "empty"
+
+    for receipt in receipts:
+        if not receipt.date:
+            return "missing_date"
+        if receipt.total_amount <= 0:
+            return "missing_amount"
+        if receipt.date_corrected or any(item.date_corrected for item in receipt.items or []):
+            return "date_corrected"
+        if receipt.items and sum(item.amount for item in receipt.items) != receipt.total_amount:
+            return "items_total_mismatch"
+        if receipt.confidence is not None and receipt.confidence < config.GEMINI_ESCALATION_CONFIDENCE:
+            return "low_confidence"
+
+    return None
+
+
+def _timed_attempt(func, metric_name: str):
+    """1回の呼び出しの所要時間を記録して実行（失敗した呼び出しも含める）"""
+    started = time.perf_counter()
     try:
-        # YYYY-MM-DD形式をパース
-        match = re.match(r'(\d{4})-(\d{2})-(\d{2})', date_str)
-        if not match:
-            return date_str
-
-        year = int(match.group(1))
-        month = match.group(2)
-        day = match.group(3)
-
-        current_year = datetime.now().year
-
-        # 1990年代の日付は令和と平成の誤認識の可能性が高い
-        # 平成N年 → 令和N年への修正（+30年）
-        if 1989 <= year <= 1999:
-            # 平成1-11年 → 令和1-11年の可能性
-            # 平成年 + 1988 = 西暦 → 令和年 + 2018 = 西暦
-            # 差分は 2018 - 1988 = 30年
-            corrected_year = year + 30
-            if corrected_year <= current_year + 1:  # 来年までは許容
-                print(f"⚠️ 日付修正: {year}年 → {corrected_year}年（令和への変換ミスを修正）")
-                return f"{corrected_year}-{month}-{day}"
-
-        # 2000-2018年の場合も念のためチェック
-        # ただし、これらは有効な日付の可能性もあるので警告のみ
-        if 2000 <= year <= 2018:
-            print(f"⚠️ 警告: 日付が{year}年です。古い領収書でなければ確認してください。")
-
-        # 未来の日付（2年以上先）は警告
-        if year > current_year + 1:
-            print(f"⚠️ 警告: 日付が未来（{year}年）です。")
-
-        return date_str
+        return func()
+    finally:
+        metrics.observe(metric_name, (time.perf_counter() - started) * 1000)
+
+
+def _hedge_delay_seconds(metric_name: str):
+    """重複送信までの待ち時間（サンプルが足りなければNone）"""
+    if metrics.sample_count(metric_name) < config.GEMINI_HEDGE_MIN_SAMPLES:
+        return None
+    delay_ms = metrics.percentile(metric_name, config.GEMINI_HEDGE_PERCENTILE)
+    return max(config.GEMINI_HEDGE_MIN_DELAY_SECONDS, delay_ms / 1000)
+
+
+def _hedge_budget_available() -> bool:
+    """重複送信数が予算（呼び出し数 × GEMINI_HEDGE_BUDGET）の範囲内か"""
+    fired = metrics.get_counter("gemini.hedge.fired")
+    return fired + 1 <= config.GEMINI_HEDGE_BUDGET * metrics.get_counter("gemini.hedge.eligible")
+
+
+def _call_with_hedge(func, kind: str):
+    """生成 + 解析をヘッジ付きで実行
+
+    元のリクエストは呼び出し元のスレッドで実行し、過去の応答時間の分位点を過ぎても
+    終わらなければ同じリクエストをヘッジ用スレッドプールでもう1件送る。
+    元のリクエストが失敗した場合はヘッジ側の結果を待って使い、再試行（バックオフ）を省く。
+    """
+    metric_name = f"gemini.attempt_ms.{kind}"
+    if not config.GEMINI_HEDGE_ENABLED:
+        return _timed_attempt(func, metric_name)
+
+    metrics.incr("gemini.hedge.eligible")
+    delay = _hedge_delay_seconds(metric_name)
+    if delay is None:
+        return _timed_attempt(func, metric_name)
+
+    lock = threading.Lock()
+    state = {"primary_done": False, "hedge": None, "hedge_done_at": None}
+
+    def run_hedge():
+        try:
+            return _timed_attempt(func, metric_name)
+        finally:
+            state["hedge_done_at"] = time.perf_counter()
 
+    def send_hedge():
+        with lock:
+            if state["primary_done"]:
+                return
+            if not _hedge_budget_available():
+                metrics.incr("gemini.hedge.budget_exhausted")
+                return
+            metrics.incr("gemini.hedge.fired")
+            print(f"⏱️ Gemini {kind} call slower than {delay:.1f}s, sending hedge request")
+            state["hedge"] = get_hedge_executor().submit(run_hedge)
+
+    timer = threading.Timer(delay, send_hedge)
+    timer.daemon = True
+    timer.start()
+    started = time.perf_counter()
+    try:
+        result = _timed_attempt(func, metric_name)
+        error = None
     except Exception as e:
-        print(f"日付検証エラー: {e}")
-        return date_str
+        result, error = None, e
+    timer.cancel()
+    with lock:
+        state["primary_done"] = True
+        hedge = state["hedge"]
 
+    if hedge is None:
+        if error is not None:
+            raise error
+        return result
 
-def analyze_with_gemini_retry(file_path: str, max_retries: int = 3) -> dict:
-    """Gemini APIを使用して画像を解析（リトライ機能付き）"""
-    for attempt in range(max_retries):
+    if error is None:
+        if hedge.done() and hedge.exception() is None:
+            # ヘッジ側が先に終わっていた（元のリクエストを待った時間を記録）
+            metrics.incr("gemini.hedge.wins")
+            metrics.observe("gemini.hedge.lead_ms", (time.perf_counter() - state["hedge_done_at"]) * 1000)
+        return result
+
+    # 元のリクエストが失敗した場合はヘッジ側の結果を使う（両方失敗したら元のエラーを返す）
+    try:
+        hedged = hedge.result()
+    except Exception:
+        metrics.observe("gemini.hedge.failed_ms", (time.perf_counter() - started) * 1000)
+        raise error
+    metrics.incr("gemini.hedge.rescued")
+    return hedged
+
+
+def get_hedge_stats() -> dict:
+    """ヘッジリクエストの統計（送信率・先着数・救済数）"""
+    eligible = metrics.get_counter("gemini.hedge.eligible")
+    fired = metrics.get_counter("gemini.hedge.fired")
+    lead = metrics.snapshot()["timings"].get("gemini.hedge.lead_ms")
+    return {
+        "enabled": config.GEMINI_HEDGE_ENABLED,
+        "budget": config.GEMINI_HEDGE_BUDGET,
+        "eligible_calls": eligible,
+        "hedges_fired": fired,
+        "hedge_rate": round(fired / eligible, 4) if eligible else None,
+        "hedge_wins": metrics.get_counter("gemini.hedge.wins"),
+        "rescued_errors": metrics.get_counter("gemini.hedge.rescued"),
+        "budget_exhausted": metrics.get_counter("gemini.hedge.budget_exhausted"),
+        "hedge_lead_ms": lead
+    }
+
+
+def _analyze_with_model(model_name: str, tier: str, file_part, max_retries: int) -> list:
+    """指定モデルで生成 + JSON解析（段階別リトライ）"""
+    def attempt():
+        response = _generate(model_name, [file_part])
+        return _parse_response(response.text)
+
+    def generate_and_parse():
+        started = time.perf_counter()
+        receipts = _call_with_hedge(attempt, tier)
+        metrics.observe("gemini.generate_ms", (time.perf_counter() - started) * 1000)
+        return receipts
+
+    started = time.perf_counter()
+    metrics.incr(f"gemini.tier.{tier}.calls")
+    try:
+        return _run_stage("generate", generate_and_parse, max_retries)
+    finally:
+        metrics.observe(f"gemini.tier.{tier}_ms", (time.perf_counter() - started) * 1000)
+
+
+def _analyze_pdf_text(file_path: str, file_bytes: bytes, models: dict, max_retries: int):
+    """PDFの抽出テキストを高速モデルで解析（テキストが使えない・検証に失敗した場合はNone）"""
+    text = extract_pdf_text(file_path)
+    if text is None:
+        return None
+
+    model_name = models["fast"] or models["pro"]
+    try:
+        receipts = _analyze_with_model(model_name, "text", PDF_TEXT_INSTRUCTION + text, max_retries)
+    except GeminiAnalysisError as e:
+        if e.kind == "overloaded":
+            raise
+        print(f"⚠️ PDF text analysis failed, using file: {str(e)}")
+        metrics.incr("pdf_text.fallback.analysis_failed")
+        return None
+
+    reason = escalation_reason(receipts)
+    if reason is not None:
+        print(f"↩️ PDF text result needs file analysis: {reason}")
+        metrics.incr(f"pdf_text.fallback.{reason}")
+        return None
+
+    metrics.incr("pdf_text.used")
+    metrics.incr("pdf_text.bytes_saved", max(0, len(file_bytes) - len(text.encode("utf-8"))))
+    print(f"✅ Gemini analysis successful from PDF text ({model_name})")
+    return [receipt.to_record() for receipt in receipts]
+
+
+def analyze_with_gemini_retry(file_path: str, max_retries: int = 3, plan: str = None) -> list:
+    """Gemini APIを使用して画像を解析（段階別リトライ・同一画像は結果を再利用）
+
+    まず高速モデルで解析し、日付・金額の欠落、日付の補正、IC明細の合計不一致、
+    低い確信度のいずれかに該当した場合のみ高精度モデルで再解析する。
+    テキストレイヤーのあるPDFは抽出テキストでの解析を先に試し、使えなければファイルで解析する。
+    ファイル準備（アップロード）と生成・解析を別々にリトライするため、
+    応答の解析失敗や一時的な生成エラーでファイルを再アップロードしない。
+    ワーカースレッドから呼ばれる前提（バックオフの待機はイベントループを止めない）。
+    """
+    models = get_plan_models(plan)
+
+    with open(file_path, "rb") as f:
+        file_bytes = f.read()
+
+    # 同じ内容のファイルを解析済みならキャッシュから返す（高精度モデルの結果を優先）
+    cache_keys = _cache_keys(file_bytes, models)
+    cached = get_cached_result(cache_keys["pro"], cache_keys["fast"])
+    if cached is not None:
+        print("✅ Gemini analysis cache hit")
+        return cached
+
+    return _analyze_file(file_path, file_bytes, models, cache_keys, max_retries)
+
+
+def _cache_keys(file_bytes: bytes, models: dict) -> dict:
+    """モデルの階層ごとのキャッシュキー（fast と pro が同じモデルなら同じキー）"""
+    return {tier: make_cache_key(file_bytes, name) for tier, name in models.items()}
+
+
+def _analyze_file(file_path: str, file_bytes: bytes, models: dict, cache_keys: dict, max_retries: int,
+                  start_tier: str = "fast") -> list:
+    """キャッシュを確認済みのファイルを解析して結果をキャッシュに保存（analyze_with_gemini_retry の本体）
+
+    start_tier="pro" は高速モデルの結果が不十分と分かっている場合（まとめて解析した結果など）で、
+    高速モデルを飛ばして高精度モデルで解析する。
+    """
+    # テキストレイヤーのあるPDFは、まず抽出テキストだけで解析する
+    if start_tier == "fast" and config.PDF_TEXT_FAST_PATH and _guess_mime_type(file_path) == "application/pdf":
+        data_list = _analyze_pdf_text(file_path, file_bytes, models, max_retries)
+        if data_list is not None:
+            store_result(cache_keys["fast"], data_list, models["fast"])
+            return data_list
+
+    # 1. ファイル準備（小さいファイルはインライン送信、ハンドルは以降の試行・モデルで使い回す）
+    file_part = _run_stage("upload", lambda: _prepare_file_part(file_path, file_bytes), max_retries)
+
+    # 2. 高速モデルで解析
+    tier = "pro"
+    if start_tier == "fast" and models["fast"] and models["fast"] != models["pro"]:
         try:
-            print(f"Gemini API attempt {attempt + 1}/{max_retries}...")
+            receipts = _analyze_with_model(models["fast"], "fast", file_part, max_retries)
+            reason = escalation_reason(receipts)
+        except GeminiAnalysisError as e:
+            if e.kind in ("invalid", "overloaded"):
+                raise
+            reason = "fast_failed"
+
+        if reason is None:
+            tier = "fast"
+        else:
+            print(f"⬆️ Escalating to {models['pro']}: {reason}")
+            metrics.incr("gemini.escalations")
+            metrics.incr(f"gemini.escalation.{reason}")
+
+    # 3. 必要な場合のみ高精度モデルで解析
+    if tier == "pro":
+        receipts = _analyze_with_model(models["pro"], "pro", file_part, max_retries)
 
-            # ファイルをアップロード
-            genai_file = genai.upload_file(path=file_path)
+    data_list = [receipt.to_record() for receipt in receipts]
+    print(f"✅ Gemini analysis successful ({models[tier]})")
+    store_result(cache_keys[tier], data_list, models[tier])
+    return data_list
 
-            # 処理待ち
-            while genai_file.state.name == "PROCESSING":
-                time.sleep(1)
-                genai_file = genai.get_file(genai_file.name)
 
-            # 解析実行
-            response = model.generate_content([genai_file, config.GEMINI_PROMPT])
+def analyze_batch_with_gemini(file_paths: list, max_retries: int = 3, plan: str = None) -> list:
+    """複数の画像を1リクエストでまとめて解析
 
+    画像ごとに区切りを入れて送信し、画像番号付きの結果を受け取る。
+    検証に失敗した画像は高精度モデルで解析し直し、結果のない画像・インライン送信できないファイルは
+    1件ずつの解析（高速モデルから）に切り替える。
+    戻り値は file_paths と同じ順序のリストで、各要素は解析結果（辞書のリスト）または例外。
+    """
+    models = get_plan_models(plan)
+    batch_tier = "fast" if models["fast"] and models["fast"] != models["pro"] else "pro"
+    batch_model = models[batch_tier]
+    results = [None] * len(file_paths)
+    escalated = set()
+
+    # キャッシュ済み・まとめて送信可能な画像を振り分け
+    pending = []
+    contents = {}
+    for i, file_path in enumerate(file_paths):
+        with open(file_path, "rb") as f:
+            file_bytes = f.read()
+        contents[i] = file_bytes
+
+        cache_keys = _cache_keys(file_bytes, models)
+        results[i] = get_cached_result(cache_keys["pro"], cache_keys["fast"])
+
+        mime_type = _guess_mime_type(file_path)
+        if results[i] is None and mime_type.startswith("image/"):
+            pending.append((i, mime_type, file_bytes))
+
+    # リクエスト全体（base64化後の画像 + 区切り + プロンプト）が上限に収まる分だけまとめる（残りは1件ずつ解析）
+    fitting = []
+    for item in pending:
+        sizes = [len(file_bytes) for _, _, file_bytes in fitting] + [len(item[2])]
+        text = "=== 画像 00 ===" * len(sizes) + BATCH_INSTRUCTION
+        if _request_bytes(sizes, text) <= config.GEMINI_REQUEST_MAX_BYTES:
+            fitting.append(item)
+        else:
+            metrics.incr("gemini.batch.oversize")
+    pending = fitting
+
+    if len(pending) >= 2:
+        parts = []
+        for number, (_, mime_type, file_bytes) in enumerate(pending, start=1):
+            parts.append(f"=== 画像 {number} ===")
+            parts.append({"mime_type": mime_type, "data": file_bytes})
+            metrics.observe("gemini.bytes_sent", len(file_bytes))
+        parts.append(BATCH_INSTRUCTION.format(count=len(pending)))
+
+        def attempt():
+            response = _generate(batch_model, parts, BATCH_GENERATION_CONFIG)
             if not response.text:
                 raise ValueError("Gemini APIからの応答が空です")
+            return parse_batch(response.text)
 
-            # JSONをパース
-            data_list = json.loads(response.text.strip().replace('```json', '').replace('```', ''))
+        def generate_and_parse():
+            started = time.perf_counter()
+            batch = _call_with_hedge(attempt, "batch")
+            metrics.observe("gemini.batch_ms", (time.perf_counter() - started) * 1000)
+            return batch
 
-            # 日付の検証と修正
-            if isinstance(data_list, list):
-                for item in data_list:
-                    if "date" in item:
-                        item["date"] = validate_and_fix_date(item["date"])
-            elif isinstance(data_list, dict) and "date" in data_list:
-                data_list["date"] = validate_and_fix_date(data_list["date"])
-
-            print(f"✅ Gemini analysis successful")
-            return data_list
+        metrics.incr("gemini.batch.requests")
+        metrics.incr("gemini.batch.images", len(pending))
+        try:
+            batch = _run_stage("generate", generate_and_parse, max_retries)
+        except GeminiAnalysisError as e:
+            if e.kind == "overloaded":
+                # 混雑中に1件ずつ送り直すと負荷が増えるため、まとめて失敗扱いにする
+                for i, _, _ in pending:
+                    results[i] = e
+            else:
+                print(f"⚠️ Batch analysis failed, falling back to single requests: {str(e)}")
+            batch = {}
 
-        except Exception as e:
-            print(f"❌ Gemini API error (attempt {attempt + 1}): {str(e)}")
+        for number, (i, _, file_bytes) in enumerate(pending, start=1):
+            if results[i] is not None:
+                continue
+            receipts = batch.get(number)
+            if receipts is None:
+                # 結果がない画像は1件ずつ高速モデルから解析し直す
+                metrics.incr("gemini.batch.fallbacks")
+                print(f"↩️ Batch image {number} needs single analysis: missing_in_batch")
+                continue
 
-            if attempt < max_retries - 1:
-                wait_time = 2 ** attempt  # 指数バックオフ: 1秒, 2秒, 4秒
-                print(f"Retrying in {wait_time} seconds...")
-                time.sleep(wait_time)
+            # 1件ずつの解析と同じく、画像ごとに階層の呼び出し・エスカレーションを数える
+            metrics.incr(f"gemini.tier.{batch_tier}.calls")
+            reason = escalation_reason(receipts) if batch_tier == "fast" else None
+            if reason is None:
+                results[i] = [receipt.to_record() for receipt in receipts]
+                store_result(make_cache_key(file_bytes, batch_model), results[i], batch_model)
             else:
-                raise Exception(f"Gemini API解析に失敗しました（{max_retries}回試行）: {str(e)}")
+                # 高速モデルの結果は出ているため、高精度モデルで直接解析する
+                print(f"⬆️ Batch image {number} escalating to {models['pro']}: {reason}")
+                metrics.incr("gemini.batch.fallbacks")
+                metrics.incr("gemini.escalations")
+                metrics.incr(f"gemini.escalation.{reason}")
+                escalated.add(i)
+
+    # 残りは1件ずつ解析（モデル振り分け・リトライ付き、キャッシュは確認済み）
+    for i, file_path in enumerate(file_paths):
+        if results[i] is None:
+            file_bytes = contents[i]
+            start_tier = "pro" if i in escalated else "fast"
+            try:
+                results[i] = _analyze_file(file_path, file_bytes, models, _cache_keys(file_bytes, models), max_retries,
+                                           start_tier=start_tier)
+            except Exception as e:
+                results[i] = e
+
+    return results
+
+
+def get_routing_stats() -> dict:
+    """モデル振り分けの統計（階層ごとの呼び出し数・エスカレーション率）"""
+    fast_calls = metrics.get_counter("gemini.tier.fast.calls")
+    return {
+        "fast_calls": fast_calls,
+        "pro_calls": metrics.get_counter("gemini.tier.pro.calls"),
+        "escalations": metrics.get_counter("gemini.escalations"),
+        "escalation_rate": metrics.ratio("gemini.escalations", "gemini.tier.fast.calls")
+    }
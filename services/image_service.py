@@ -1,28 +1,129 @@
 """
 画像処理サービス
-画像の圧縮・PDF変換を管理
+画像の圧縮・解析前処理・PDF変換を管理
 """
+import io
 import os
+import re
+import math
 import time
-from PIL import Image, ImageOps
-from services.storage_service import upload_to_gcs
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+from PIL import Image, ImageOps, ImageStat, features
+from utils import metrics
 import config
 
+# 解凍爆弾対策（Pillow自体の上限も合わせる。プロセスプールの子プロセスでも読み込み時に設定される）
+Image.MAX_IMAGE_PIXELS = config.IMAGE_MAX_PIXELS
+
+# EXIFの向きのうち、縦横が入れ替わるもの
+_SWAPPED_ORIENTATIONS = (5, 6, 7, 8)
+
 # PDF処理用インポート
 try:
-    from pdf2image import convert_from_path
+    from pdf2image import convert_from_path, pdfinfo_from_path
     PDF_SUPPORT = True
 except ImportError:
     PDF_SUPPORT = False
     print("警告: pdf2imageがインストールされていません。PDF画像化機能は無効です。")
 
-def compress_image(input_path: str, output_path: str = None, max_size: tuple = (1920, 1080), quality: int = 85) -> str:
-    """画像を圧縮してファイルサイズを削減"""
-    if output_path is None:
-        output_path = input_path
+def _decode_target_size(img: Image.Image, max_size: tuple) -> tuple:
+    """max_size に収めるのに必要なデコード後のサイズ（回転前の向き）
 
+    JPEGの縮小デコードはこのサイズ以上の解像度を保つため、余裕は持たせない。
+    """
+    width, height = img.size
     try:
+        orientation = img.getexif().get(0x0112, 1)
+    except Exception:
+        orientation = 1
+    if orientation in _SWAPPED_ORIENTATIONS:
+        box = (max_size[1], max_size[0])
+    else:
+        box = max_size
+
+    scale = min(box[0] / width, box[1] / height, 1.0)
+    return (max(1, math.ceil(width * scale)), max(1, math.ceil(height * scale)))
+
+
+def _is_monochrome(img: Image.Image) -> bool:
+    """ほぼ無彩色の画像か（感熱紙のレシートなど）。縮小画像の平均彩度で判定"""
+    small = img.resize((64, 64), Image.Resampling.BILINEAR).convert("HSV")
+    return ImageStat.Stat(small.getchannel("S")).mean[0] < config.IMAGE_GRAYSCALE_SATURATION
+
+
+def _encode(img: Image.Image, fmt: str, quality: int) -> bytes:
+    buffer = io.BytesIO()
+    if fmt == "WEBP":
+        img.save(buffer, "WEBP", quality=quality, method=4)
+    else:
+        img.save(buffer, "JPEG", quality=quality, optimize=True)
+    return buffer.getvalue()
+
+
+def _encode_within_budget(img: Image.Image, fmt: str, max_quality: int) -> tuple:
+    """バイト予算に収まる最も高い画質でエンコード
+
+    画質を IMAGE_MIN_QUALITY まで下げても収まらない場合は、長辺が文字の判読に必要な
+    IMAGE_MIN_TEXT_LONG_SIDE_PX を下回らない範囲で縮小して再試行する。
+    戻り値は (エンコード結果, 画質, 最終的な画像)。
+    """
+    budget = config.IMAGE_BYTE_BUDGET
+    while True:
+        data = _encode(img, fmt, max_quality)
+        if len(data) <= budget:
+            return data, max_quality, img
+
+        # 予算内に収まる最も高い画質を二分探索
+        best = None
+        low, high = config.IMAGE_MIN_QUALITY, max_quality - 1
+        while low <= high:
+            mid = (low + high) // 2
+            candidate = _encode(img, fmt, mid)
+            if len(candidate) <= budget:
+                best = (candidate, mid)
+                low = mid + 1
+            else:
+                high = mid - 1
+        if best is not None:
+            return best[0], best[1], img
+
+        scaled = (int(img.width * 0.85), int(img.height * 0.85))
+        if max(scaled) < config.IMAGE_MIN_TEXT_LONG_SIDE_PX:
+            # これ以上は縮小しない（予算超過のまま最低画質で保存）
+            return _encode(img, fmt, config.IMAGE_MIN_QUALITY), config.IMAGE_MIN_QUALITY, img
+        img = img.resize(scaled, Image.Resampling.LANCZOS)
+
+
+def compress_image_with_stats(input_path: str, output_path: str = None, max_size: tuple = (1920, 1080), quality: int = 85) -> dict:
+    """画像を圧縮し、出力パスと統計（サイズ・時間・画質・形式）を返す
+
+    JPEGは必要な解像度までDCT段階で縮小してデコードし（draft）、それ以外も整数倍の縮小（reduce）で
+    仕上げ前の画素数を減らす。画素数が IMAGE_MAX_PIXELS を超える画像は解凍爆弾として拒否する。
+    出力は IMAGE_BYTE_BUDGET に収まるよう画質・解像度を調整し、無彩色の画像はグレースケールにする。
+    output_path を省略した場合は入力と同じ場所に出力形式の拡張子で保存し、元ファイルは削除する。
+    """
+    started = time.perf_counter()
+    fmt = "WEBP" if config.IMAGE_OUTPUT_FORMAT == "webp" and features.check("webp") else "JPEG"
+    extension = ".webp" if fmt == "WEBP" else ".jpg"
+    replace_input = output_path is None
+    if replace_input:
+        output_path = os.path.splitext(input_path)[0] + extension
+
+    try:
+        input_bytes = os.path.getsize(input_path)
         with Image.open(input_path) as img:
+            # ヘッダーの画素数だけで判定（デコード前）
+            if img.width * img.height > config.IMAGE_MAX_PIXELS:
+                raise Image.DecompressionBombError(
+                    f"画像の画素数が上限を超えています: {img.width}x{img.height}"
+                )
+
+            # 必要な解像度までの縮小デコード（JPEGのみ有効、その他は何もしない）
+            target = _decode_target_size(img, max_size)
+            img.draft(None, target)
+
             # EXIF情報に基づいて画像を回転
             try:
                 img = ImageOps.exif_transpose(img)
@@ -39,41 +140,359 @@ def compress_image(input_path: str, output_path: str = None, max_size: tuple = (
             elif img.mode != 'RGB':
                 img = img.convert('RGB')
 
-            # サイズ調整
+            # サイズ調整（整数倍の縮小で画素数を減らしてからLANCZOSで仕上げる）
+            factor = int(max(img.width / max_size[0], img.height / max_size[1]) / config.IMAGE_REDUCING_GAP)
+            if factor >= 2:
+                img = img.reduce(factor)
             img.thumbnail(max_size, Image.Resampling.LANCZOS)
 
-            # 保存
-            img.save(output_path, 'JPEG', optimize=True, quality=quality)
+            # 感熱紙など無彩色の画像はグレースケールで保存（色差成分のぶん小さくなる）
+            grayscale = config.IMAGE_GRAYSCALE_AUTO and _is_monochrome(img)
+            if grayscale:
+                img = img.convert("L")
+
+            # 保存（バイト予算に合わせて画質・解像度を調整）
+            data, used_quality, img = _encode_within_budget(img, fmt, quality)
+            with open(output_path, "wb") as f:
+                f.write(data)
 
-            print(f"✅ Image compressed: {input_path} -> {output_path}")
-            return output_path
+        if replace_input and output_path != input_path:
+            os.remove(input_path)
+
+        stats = {
+            "path": output_path,
+            "format": fmt.lower(),
+            "input_bytes": input_bytes,
+            "output_bytes": len(data),
+            "width": img.width,
+            "height": img.height,
+            "quality": used_quality,
+            "grayscale": grayscale,
+            "over_budget": len(data) > config.IMAGE_BYTE_BUDGET,
+            "ms": round((time.perf_counter() - started) * 1000, 1)
+        }
+        print(
+            f"✅ Image compressed: {input_path} -> {output_path} "
+            f"({input_bytes // 1024}KB -> {len(data) // 1024}KB, {stats['format']} q{used_quality}, "
+            f"{img.width}x{img.height}{', gray' if grayscale else ''})"
+        )
+        return stats
+    except Image.DecompressionBombError:
+        # 元画像のまま解析に回すと危険なため、圧縮失敗とは区別して呼び出し元に伝える
+        raise
     except Exception as e:
         print(f"⚠️ Image compression failed: {str(e)}, using original")
+        return {"path": input_path, "error": str(e)}
+
+
+def compress_image(input_path: str, output_path: str = None, max_size: tuple = (1920, 1080), quality: int = 85) -> str:
+    """画像を圧縮してファイルサイズを削減（出力パスを返す）"""
+    return compress_image_with_stats(input_path, output_path, max_size, quality)["path"]
+
+
+def _record_image_stats(stats: dict):
+    """画像ごとの圧縮統計をメトリクスに記録（子プロセスの結果を親プロセスで集計する）"""
+    if "error" in stats:
+        metrics.incr("image.compress_failed")
+        return
+    metrics.incr(f"image.format.{stats['format']}")
+    metrics.observe("image.input_bytes", stats["input_bytes"])
+    metrics.observe("image.output_bytes", stats["output_bytes"])
+    metrics.observe("image.encode_ms", stats["ms"])
+    metrics.observe("image.quality", stats["quality"])
+    metrics.incr("image.bytes_saved", max(0, stats["input_bytes"] - stats["output_bytes"]))
+    if stats["grayscale"]:
+        metrics.incr("image.grayscale")
+    if stats["over_budget"]:
+        metrics.incr("image.over_budget")
+
+
+def compress_image_in_pool(input_path: str, output_path: str = None, max_size: tuple = (1920, 1080), quality: int = 85) -> str:
+    """compress_image を画像処理用プロセスプールで実行（呼び出し元のスレッドは結果を待つ）
+
+    Pillowの処理でGILを握り続けないよう別プロセスに任せる。プールが使えない場合はその場で圧縮する。
+    """
+    from utils.executors import get_image_executor
+
+    started = time.perf_counter()
+    try:
+        future = get_image_executor().submit(compress_image_with_stats, input_path, output_path, max_size, quality)
+        stats = future.result()
+    except BrokenProcessPool as e:
+        print(f"⚠️ Image executor unavailable, compressing inline: {str(e)}")
+        metrics.incr("image.executor_fallback")
+        stats = compress_image_with_stats(input_path, output_path, max_size, quality)
+    metrics.observe("image.compress_ms", (time.perf_counter() - started) * 1000)
+    _record_image_stats(stats)
+    return stats["path"]
+
+
+# 解析前処理の検出用に縮小する長辺のサイズ
+_DETECT_LONG_SIDE_PX = 512
+
+
+def _otsu_threshold(values: np.ndarray) -> tuple:
+    """大津の方法で明暗を分ける閾値を求める（戻り値は (閾値, 明暗の平均の差)）"""
+    hist = np.bincount(values.ravel(), minlength=256).astype(np.float64)
+    total = hist.sum()
+    levels = np.arange(256)
+    weight_dark = np.cumsum(hist)
+    sum_dark = np.cumsum(hist * levels)
+    weight_bright = total - weight_dark
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_dark = sum_dark / weight_dark
+        mean_bright = (sum_dark[-1] - sum_dark) / weight_bright
+        between = weight_dark * weight_bright * (mean_dark - mean_bright) ** 2
+    between = np.nan_to_num(between)
+    threshold = int(np.argmax(between))
+    return threshold, float(np.nan_to_num(mean_bright[threshold] - mean_dark[threshold]))
+
+
+def _smooth(profile: np.ndarray) -> np.ndarray:
+    """行・列ごとの割合を移動平均でならす（文字の行で紙の割合が途切れないように）"""
+    window = max(3, len(profile) // 20)
+    return np.convolve(profile, np.ones(window) / window, mode="same")
+
+
+def _longest_run(flags: np.ndarray, anchor: int) -> tuple:
+    """anchor を含む True の連続区間（[start, end)）"""
+    start = end = anchor
+    while start > 0 and flags[start - 1]:
+        start -= 1
+    while end < len(flags) and flags[end]:
+        end += 1
+    return start, end
+
+
+def _detect_receipt_box(gray: np.ndarray):
+    """背景より明るい紙の領域を検出（縮小画像上の (left, top, right, bottom)。見つからなければNone）
+
+    明暗を大津の方法で二値化し、行・列ごとの紙の画素の割合から最も紙の多い帯を切り出す。
+    帯の内側で行と列を交互に絞り込むため、机の端など画像の縁にある明るい部分に引きずられにくい。
+    """
+    threshold, separation = _otsu_threshold(gray)
+    if separation < 40:
+        # 紙と背景の明るさがほとんど変わらない（全面が紙・暗い写真など）
+        return None
+    paper = gray > threshold
+
+    height, width = paper.shape
+    top, bottom, left, right = 0, height, 0, width
+    for _ in range(2):
+        cols = _smooth(paper[top:bottom].mean(axis=0))
+        left, right = _longest_run(cols >= cols.max() * 0.5, int(np.argmax(cols)))
+        rows = _smooth(paper[:, left:right].mean(axis=1))
+        top, bottom = _longest_run(rows >= rows.max() * 0.5, int(np.argmax(rows)))
+
+    area = (right - left) * (bottom - top) / (width * height)
+    if not config.IMAGE_CROP_MIN_AREA <= area <= config.IMAGE_CROP_MAX_AREA:
+        return None
+    if paper[top:bottom, left:right].mean() < 0.6:
+        return None
+
+    # 文字が縁に掛からないよう少し余白を付ける
+    margin_x, margin_y = max(2, width // 50), max(2, height // 50)
+    return (max(0, left - margin_x), max(0, top - margin_y), min(width, right + margin_x), min(height, bottom + margin_y))
+
+
+def _estimate_skew(gray: Image.Image) -> float:
+    """文字行の傾き（度）を推定（行ごとの文字画素数の変化が最も鋭くなる回転角）"""
+    values = np.asarray(gray)
+    threshold, separation = _otsu_threshold(values)
+    ink = values <= threshold
+    if separation < 40 or not 0.005 <= ink.mean() <= 0.4:
+        return 0.0
+    ink_image = Image.fromarray((ink * 255).astype(np.uint8))
+
+    def score(angle: float) -> float:
+        rows = np.asarray(ink_image.rotate(angle, resample=Image.Resampling.NEAREST)).sum(axis=1, dtype=np.float64)
+        return float(np.sum(np.diff(rows) ** 2))
+
+    max_angle = config.IMAGE_DESKEW_MAX_ANGLE
+    coarse = np.arange(-max_angle, max_angle + 0.01, 1.0)
+    best = max(coarse, key=score)
+    fine = np.arange(best - 0.75, best + 0.76, 0.25)
+    best = float(max(fine, key=score))
+
+    # 0度との差が小さければ補正しない（補正による画質低下を避ける）
+    if abs(best) < 0.5 or score(best) < score(0.0) * 1.05:
+        return 0.0
+    return round(best, 2)
+
+
+def prepare_for_analysis(input_path: str) -> dict:
+    """解析用のコピーを作成（領収書部分の切り抜き・傾き補正・コントラスト調整）
+
+    机の上で撮影した写真は背景の分だけ送信量と解析時間が増えるため、紙の領域だけを送る。
+    どれも該当しない画像はそのまま使う（再エンコードによる画質低下を避ける）。
+    保存用（GCS）の画像には手を加えず、解析に使う別ファイルを出力する。
+    """
+    started = time.perf_counter()
+    try:
+        input_bytes = os.path.getsize(input_path)
+        with Image.open(input_path) as img:
+            img.load()
+            fmt = "WEBP" if img.format == "WEBP" else "JPEG"
+            if img.mode not in ("RGB", "L"):
+                img = img.convert("RGB")
+
+            small = img.convert("L")
+            small.thumbnail((_DETECT_LONG_SIDE_PX, _DETECT_LONG_SIDE_PX), Image.Resampling.BILINEAR)
+            scale = img.width / small.width
+
+            # 1. 領収書の領域を切り抜く
+            box = _detect_receipt_box(np.asarray(small))
+            if box is not None:
+                small = small.crop(box)
+                img = img.crop(tuple(round(v * scale) for v in box))
+
+            # 2. 傾き補正（はみ出した角は白で埋める）
+            angle = _estimate_skew(small)
+            if angle:
+                fill = 255 if img.mode == "L" else (255, 255, 255)
+                img = img.rotate(angle, resample=Image.Resampling.BICUBIC, expand=True, fillcolor=fill)
+
+            # 3. 色あせた感熱紙など、明暗の幅が狭い画像はコントラストを広げる
+            low, high = np.percentile(np.asarray(small), (1, 99))
+            low_contrast = bool(high - low < config.IMAGE_LOW_CONTRAST_SPREAD)
+            if box is None and not angle and not low_contrast:
+                return {"path": input_path, "skipped": True, "input_bytes": input_bytes,
+                        "ms": round((time.perf_counter() - started) * 1000, 1)}
+            img = ImageOps.autocontrast(img, cutoff=1, preserve_tone=True)
+
+            data, _, img = _encode_within_budget(img, fmt, 85)
+
+        output_path = f"{os.path.splitext(input_path)[0]}_analysis{'.webp' if fmt == 'WEBP' else '.jpg'}"
+        with open(output_path, "wb") as f:
+            f.write(data)
+
+        stats = {
+            "path": output_path,
+            "skipped": False,
+            "cropped": box is not None,
+            "angle": angle,
+            "contrast": low_contrast,
+            "input_bytes": input_bytes,
+            "output_bytes": len(data),
+            "ms": round((time.perf_counter() - started) * 1000, 1)
+        }
+        print(
+            f"✅ Image prepared for analysis: {output_path} ({input_bytes // 1024}KB -> {len(data) // 1024}KB, "
+            f"crop={stats['cropped']}, angle={angle}, contrast={low_contrast})"
+        )
+        return stats
+    except Exception as e:
+        print(f"⚠️ Image preprocessing failed: {str(e)}, using original")
+        return {"path": input_path, "error": str(e)}
+
+
+def _record_preprocess_stats(stats: dict):
+    """解析前処理の統計をメトリクスに記録"""
+    if "error" in stats:
+        metrics.incr("image.preprocess.failed")
+        return
+    metrics.observe("image.preprocess.ms", stats["ms"])
+    if stats["skipped"]:
+        metrics.incr("image.preprocess.skipped")
+        return
+    metrics.incr("image.preprocess.applied")
+    metrics.observe("image.preprocess.input_bytes", stats["input_bytes"])
+    metrics.observe("image.preprocess.output_bytes", stats["output_bytes"])
+    metrics.incr("image.preprocess.bytes_saved", max(0, stats["input_bytes"] - stats["output_bytes"]))
+    for key in ("cropped", "contrast"):
+        if stats[key]:
+            metrics.incr(f"image.preprocess.{key}")
+    if stats["angle"]:
+        metrics.incr("image.preprocess.deskewed")
+
+
+def prepare_for_analysis_in_pool(input_path: str) -> str:
+    """prepare_for_analysis を画像処理用プロセスプールで実行し、解析に使うファイルのパスを返す
+
+    IMAGE_PREPROCESS_ENABLED が無効の場合は何もせず入力パスを返す。
+    """
+    if not config.IMAGE_PREPROCESS_ENABLED:
         return input_path
 
+    from utils.executors import get_image_executor
+
+    try:
+        stats = get_image_executor().submit(prepare_for_analysis, input_path).result()
+    except BrokenProcessPool as e:
+        print(f"⚠️ Image executor unavailable, preprocessing inline: {str(e)}")
+        metrics.incr("image.executor_fallback")
+        stats = prepare_for_analysis(input_path)
+    _record_preprocess_stats(stats)
+    return stats["path"]
+
+
+def choose_pdf_dpi(info: dict, page_count: int) -> int:
+    """描画DPIを決定（ページ数が多いPDFは下げ、大判ページは長辺が上限を超えないよう下げる）"""
+    dpi = config.PDF_RENDER_DPI if page_count <= config.PDF_RENDER_MANY_PAGES else config.PDF_RENDER_MANY_PAGES_DPI
+
+    # "595.276 x 841.89 pts (A4)" 形式のページサイズ（1pt = 1/72インチ）
+    match = re.match(r"\s*([\d.]+)\s*x\s*([\d.]+)", str(info.get("Page size", "")))
+    if match:
+        longest_pts = max(float(match.group(1)), float(match.group(2)))
+        if longest_pts > 0:
+            dpi = min(dpi, int(config.PDF_RENDER_MAX_SIDE_PX * 72 / longest_pts))
+
+    return max(50, dpi)
+
+
+def render_pdf_page(pdf_path: str, page_number: int, dpi: int, quality: int) -> bytes:
+    """PDFの1ページだけを描画してJPEGのバイト列を返す（プロセスプールで実行）"""
+    images = convert_from_path(pdf_path, dpi=dpi, first_page=page_number, last_page=page_number)
+    buffer = io.BytesIO()
+    try:
+        images[0].save(buffer, "JPEG", quality=quality)
+    finally:
+        for image in images:
+            image.close()
+    return buffer.getvalue()
+
+
 def convert_pdf_to_images(pdf_path: str) -> list:
-    """PDFを画像に変換してGCSにアップロード"""
+    """PDFを画像に変換してGCSにアップロード
+
+    1ページずつプロセスプールで描画し、メモリ上でJPEG化したものを並行してアップロードする。
+    同時に扱うページ数は PDF_PAGE_CONCURRENCY まで（全ページを一度にメモリへ展開しない）。
+    """
     if not PDF_SUPPORT:
         print("PDF画像化機能が無効です")
         return []
 
+    from services.storage_service import upload_bytes
+    from utils.executors import get_image_executor
+
     try:
-        images = convert_from_path(pdf_path, dpi=150)
-        image_urls = []
+        started = time.perf_counter()
+        info = pdfinfo_from_path(pdf_path)
+        page_count = int(info.get("Pages", 0))
+        pages = min(page_count, config.PDF_MAX_PAGES)
+        if page_count > pages:
+            print(f"⚠️ PDF has {page_count} pages, rendering first {pages}")
+            metrics.incr("pdf_render.pages_skipped", page_count - pages)
+        dpi = choose_pdf_dpi(info, pages)
 
         base_filename = os.path.splitext(os.path.basename(pdf_path))[0]
         timestamp = int(time.time())
+        render_pool = get_image_executor()
 
-        for i, image in enumerate(images):
-            temp_image_path = os.path.join(config.UPLOAD_DIR, f"{base_filename}_page{i+1}.jpg")
-            image.save(temp_image_path, "JPEG", quality=85)
-
-            gcs_file_name = f"pdf_images/{timestamp}_{base_filename}_page{i+1}.jpg"
-            public_url = upload_to_gcs(temp_image_path, gcs_file_name)
-            image_urls.append(public_url)
+        def render_and_upload(page_number: int) -> str:
+            data = render_pool.submit(
+                render_pdf_page, pdf_path, page_number, dpi, config.PDF_RENDER_JPEG_QUALITY
+            ).result()
+            gcs_file_name = f"pdf_images/{timestamp}_{base_filename}_page{page_number}.jpg"
+            metrics.incr("pdf_render.bytes", len(data))
+            return upload_bytes(data, gcs_file_name)
 
-            os.remove(temp_image_path)
+        with ThreadPoolExecutor(max_workers=max(1, config.PDF_PAGE_CONCURRENCY), thread_name_prefix="pdf-page") as pool:
+            image_urls = list(pool.map(render_and_upload, range(1, pages + 1)))
 
+        metrics.incr("pdf_render.pages", pages)
+        metrics.observe("pdf_render.ms", (time.perf_counter() - started) * 1000)
+        print(f"PDF rendered: {pages} pages at {dpi} dpi")
         return image_urls
     except Exception as e:
         print(f"PDF画像化エラー: {e}")
@@ -0,0 +1,201 @@
+"""
+アップロードジョブサービス
+非同期アップロードのジョブ管理とバックグラウンド処理
+"""
+import time
+import uuid
+import asyncio
+import threading
+from datetime import datetime, timedelta, timezone
+from google.cloud import firestore
+from services.upload_service import process_receipt_batch, plan_batches
+from services.scheduler import analysis_scheduler, lane_for_upload
+from utils.executors import run_db, run_analysis
+import config
+
+
+class LocalJobStore:
+    """プロセス内メモリにジョブ状態を保持（外部サービス不要）"""
+
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def create(self, job: dict):
+        with self._lock:
+            self._purge_expired()
+            self._jobs[job["id"]] = job
+
+    def get(self, job_id: str):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            return {**job, "files": [dict(f) for f in job["files"]]}
+
+    def update_file(self, job_id: str, idx: int, fields: dict, job_fields: dict = None):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            job["files"][idx].update(fields)
+            job.update(job_fields or {})
+            job["updated_at"] = time.time()
+
+    def _purge_expired(self):
+        """保持期間を過ぎた完了済みジョブを破棄"""
+        cutoff = time.time() - config.JOB_RETENTION_SECONDS
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job["status"] in ("completed", "failed") and job["updated_at"] < cutoff
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+
+def _expires_at() -> datetime:
+    """Firestore の TTL ポリシーで削除される時刻（upload_jobs コレクションの expires_at に TTL を設定して使う）"""
+    return datetime.now(timezone.utc) + timedelta(seconds=config.JOB_RETENTION_SECONDS)
+
+
+class FirestoreJobStore:
+    """Firestoreにジョブ状態を保持（複数インスタンスから参照可能）"""
+
+    def __init__(self):
+        from database import db
+        self._db = db
+        self._collection = db.collection(config.COL_UPLOAD_JOBS)
+
+    def create(self, job: dict):
+        self._collection.document(job["id"]).set({**job, "expires_at": _expires_at()})
+
+    def get(self, job_id: str):
+        doc = self._collection.document(job_id).get()
+        return doc.to_dict() if doc.exists else None
+
+    def update_file(self, job_id: str, idx: int, fields: dict, job_fields: dict = None):
+        # files配列の要素単位の更新はできないため、トランザクションで読み書きする
+        doc_ref = self._collection.document(job_id)
+
+        @firestore.transactional
+        def apply(transaction):
+            snapshot = doc_ref.get(transaction=transaction)
+            if not snapshot.exists:
+                return
+            files = snapshot.to_dict().get("files", [])
+            files[idx].update(fields)
+            transaction.update(doc_ref, {
+                "files": files, "updated_at": time.time(), "expires_at": _expires_at(), **(job_fields or {})
+            })
+
+        apply(self._db.transaction())
+
+
+def _create_store():
+    if config.JOB_BACKEND == "firestore":
+        return FirestoreJobStore()
+    return LocalJobStore()
+
+
+job_store = _create_store()
+
+# 処理中・待機中の解析タスク（イベントループ内でのみ操作）
+_tasks = set()
+# 完了数の集計（ジョブIDごと）
+_progress = {}
+
+
+async def stop_job_tasks():
+    """待機中・処理中の解析タスクを停止"""
+    for task in list(_tasks):
+        task.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
+    _tasks.clear()
+
+
+async def enqueue_job(u_id: str, saved_files: list, failed_files: dict = None, plan: str = None) -> dict:
+    """保存済みファイルからジョブを作成し、解析スケジューラーに投入"""
+    failed_files = failed_files or {}
+
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    total = len(saved_files) + len(failed_files)
+
+    files = []
+    saved_iter = iter(saved_files)
+    queued = []
+    for idx in range(total):
+        if idx in failed_files:
+            files.append(failed_files[idx])
+        else:
+            saved = next(saved_iter)
+            files.append({"filename": saved["original_filename"], "status": "queued"})
+            queued.append((idx, saved))
+
+    job = {
+        "id": job_id,
+        "user_id": u_id,
+        "status": "queued" if queued else "failed",
+        "total": total,
+        "processed": len(failed_files),
+        "files": files,
+        "created_at": now,
+        "updated_at": now
+    }
+    await run_db(job_store.create, job)
+
+    if queued:
+        _progress[job_id] = {"remaining": len(queued), "processed": len(failed_files), "errors": len(failed_files)}
+    # 画像はまとめて解析できる単位ごとに投入（実行順はスケジューラーがユーザー間で公平に決める）
+    lane = lane_for_upload(total)
+    for unit in plan_batches([saved for _, saved in queued]):
+        task = asyncio.create_task(_run_unit(job_id, u_id, [queued[i] for i, _ in unit], plan, lane))
+        _tasks.add(task)
+        task.add_done_callback(_tasks.discard)
+
+    print(f"📥 Upload job queued: {job_id} ({len(queued)} files)")
+    return job
+
+
+def get_job(job_id: str, u_id: str):
+    """ジョブ状態を取得（本人のジョブのみ）"""
+    job = job_store.get(job_id)
+    if not job or job.get("user_id") != u_id:
+        return None
+    return job
+
+
+async def _run_unit(job_id: str, u_id: str, unit: list, plan: str, lane: str):
+    """ファイル（まとめて解析する単位）を順番が来たら処理"""
+    try:
+        async with analysis_scheduler.async_slot(u_id, plan, lane) as lease:
+            for idx, _ in unit:
+                await run_db(
+                    job_store.update_file, job_id, idx, {"status": "processing"}, {"status": "running"}
+                )
+            results = await run_analysis(lease.bind(process_receipt_batch), u_id, [saved for _, saved in unit], plan)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        print(f"❌ Upload job error ({job_id}): {str(e)}")
+        results = [
+            {"filename": saved["original_filename"], "status": "error", "error": str(e)}
+            for _, saved in unit
+        ]
+
+    try:
+        for (idx, _), result in zip(unit, results):
+            progress = _progress[job_id]
+            progress["remaining"] -= 1
+            progress["processed"] += 1
+            if result["status"] == "error":
+                progress["errors"] += 1
+
+            job_fields = {"processed": progress["processed"]}
+            if progress["remaining"] == 0:
+                # 全ファイルが失敗した場合のみジョブ自体を失敗扱いにする
+                job_fields["status"] = "failed" if progress["errors"] == progress["processed"] else "completed"
+                del _progress[job_id]
+            await run_db(job_store.update_file, job_id, idx, result, job_fields)
+    except Exception as e:
+        print(f"❌ Upload job status update error ({job_id}): {str(e)}")
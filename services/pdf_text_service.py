@@ -0,0 +1,84 @@
+"""
+PDFテキスト抽出サービス
+テキストレイヤーを持つPDF（経費精算システムの出力など）から解析用のテキストを取り出す
+"""
+import re
+import subprocess
+from utils import metrics
+import config
+
+# 文字化け・抽出失敗の目安になる文字（置換文字・制御文字）
+_BROKEN_CHARS = re.compile(r"[�\x00-\x08\x0b\x0e-\x1f]")
+_AMOUNT_PATTERN = re.compile(r"\d[\d,]*\s*円|¥\s*\d|\d{3,}")
+_DATE_PATTERN = re.compile(r"\d{4}\s*[年/.\-]\s*\d{1,2}|令和\s*\d+|R\s*\d+[./]|\d{1,2}\s*月\s*\d{1,2}\s*日")
+
+
+def _run_pdftotext(pdf_path: str):
+    """poppler の pdftotext でテキストを抽出（コマンドがなければNone）"""
+    try:
+        completed = subprocess.run(
+            ["pdftotext", "-layout", "-enc", "UTF-8", pdf_path, "-"],
+            capture_output=True,
+            timeout=config.PDF_TEXT_TIMEOUT_SECONDS,
+            check=True
+        )
+    except FileNotFoundError:
+        return None
+    except (subprocess.TimeoutExpired, subprocess.CalledProcessError) as e:
+        print(f"⚠️ pdftotext failed: {str(e)}")
+        return None
+    return completed.stdout.decode("utf-8", errors="replace")
+
+
+def _compact(pages: list) -> str:
+    """レイアウト用の空白・空行を詰めてページ番号付きのテキストにする"""
+    blocks = []
+    for number, page in enumerate(pages, start=1):
+        lines = []
+        for line in page.splitlines():
+            line = re.sub(r" {3,}", "  ", line.strip())
+            if line:
+                lines.append(line)
+        blocks.append(f"--- ページ {number} ---\n" + "\n".join(lines))
+    return "\n".join(blocks)
+
+
+def extract_pdf_text(pdf_path: str):
+    """解析に使えるテキストを抽出（品質が足りなければNone）
+
+    ページごとの文字数・文字化けの割合・日付と金額らしき記載の有無で判定する。
+    スキャンしただけのPDF（テキストレイヤーなし）は文字数不足で画像解析に回る。
+    """
+    raw = _run_pdftotext(pdf_path)
+    if raw is None:
+        metrics.incr("pdf_text.fallback.unavailable")
+        return None
+
+    # pdftotext はページごとに改ページ文字を出力する
+    pages = raw.split("\f")
+    if pages and not pages[-1].strip():
+        pages.pop()
+    if not pages:
+        metrics.incr("pdf_text.fallback.empty")
+        return None
+
+    text = _compact(pages)
+    body = re.sub(r"--- ページ \d+ ---|\s", "", text)
+    reason = None
+    if len(body) < config.PDF_TEXT_MIN_CHARS_PER_PAGE * len(pages):
+        reason = "too_short"
+    elif len(_BROKEN_CHARS.findall(raw)) > len(body) * 0.01:
+        reason = "garbled"
+    elif not _AMOUNT_PATTERN.search(text) or not _DATE_PATTERN.search(text):
+        reason = "missing_fields"
+    elif len(text) > config.PDF_TEXT_MAX_CHARS:
+        reason = "too_long"
+
+    if reason is not None:
+        print(f"📄 PDF text layer not used: {reason}")
+        metrics.incr(f"pdf_text.fallback.{reason}")
+        return None
+
+    metrics.incr("pdf_text.extracted")
+    metrics.observe("pdf_text.chars", len(text))
+    return text
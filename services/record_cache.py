@@ -0,0 +1,222 @@
+"""
+レコードキャッシュサービス
+ユーザーごとのレコード一覧をメモリに保持する（LRU + TTL、書き込み時に更新・破棄）
+"""
+import copy
+import time
+import uuid
+import threading
+from collections import OrderedDict
+import database
+from database import db
+from utils import metrics
+import config
+
+_entries = OrderedDict()  # ユーザーID → {"records": ID → レコード, "loaded_at": 読み込み時刻, "watch": 変更監視}
+_generations = {}  # ユーザーID → 書き込みのたびに増える番号（読み込み中に書き込まれた古い結果を保存しないため）
+_own_writes = OrderedDict()  # このインスタンスが集計ドキュメントに書いた write_token（監視で自分の書き込みを見分ける）
+_lock = threading.Lock()
+
+# 覚えておく自分の書き込みトークンの数（通知が届くまでの間に書き込まれる数より十分多くする）
+OWN_WRITES_LIMIT = 1000
+
+
+def _stop_watch(watch):
+    """変更監視を停止（監視のコールバック内から呼ばれても詰まらないよう別スレッドで行う）"""
+    if watch is not None:
+        threading.Thread(target=watch.unsubscribe, daemon=True).start()
+
+
+def _drop(u_id: str):
+    """エントリを破棄（ロック内で呼ぶ。戻り値は停止すべき変更監視）"""
+    entry = _entries.pop(u_id, None)
+    return entry["watch"] if entry else None
+
+
+def _bump(u_id: str):
+    """書き込みがあったことを記録（ロック内で呼ぶ）"""
+    _generations[u_id] = _generations.get(u_id, 0) + 1
+
+
+def new_write_token() -> str:
+    """集計ドキュメントに書き込む write_token を発行し、自分の書き込みとして覚える"""
+    token = uuid.uuid4().hex
+    with _lock:
+        _own_writes[token] = True
+        while len(_own_writes) > OWN_WRITES_LIMIT:
+            _own_writes.popitem(last=False)
+    return token
+
+
+def _is_own_write(data: dict, previous_version: int) -> bool:
+    """通知された集計ドキュメントがこのインスタンスの書き込みだけを反映したものか
+
+    version は書き込みごとに1増えるため、直前の通知から1だけ増えていれば間に他の書き込みはない。
+    """
+    if data.get("version", 0) != previous_version + 1:
+        return False
+    with _lock:
+        return data.get("write_token") in _own_writes
+
+
+def _watch(u_id: str):
+    """他インスタンスでの書き込みを検知して破棄する（集計ドキュメントはレコードの書き込みごとに更新される）
+
+    自分の書き込みはキャッシュに反映済み（patch_records など）のため、通知が来ても破棄しない。
+    """
+    last_version = [None]
+
+    def on_change(docs, changes, read_time):
+        data = docs[0].to_dict() if docs and docs[0].exists else {}
+        previous, last_version[0] = last_version[0], data.get("version", 0)
+        # 監視開始時の現在の状態の通知は無視する
+        if previous is None:
+            return
+        if _is_own_write(data, previous):
+            metrics.incr("record_cache.own_write_ignored")
+            return
+        metrics.incr("record_cache.remote_invalidated")
+        invalidate(u_id)
+
+    try:
+        return db.collection(config.COL_RECORD_AGGREGATES).document(u_id).on_snapshot(on_change)
+    except Exception as e:
+        print(f"⚠️ Record cache listener error: {str(e)}")
+        return None
+
+
+def _lookup(u_id: str):
+    """有効なキャッシュのレコード（ID → レコード）を取得（なければNone）"""
+    expired_watch = None
+    with _lock:
+        entry = _entries.get(u_id)
+        if entry is not None and time.monotonic() - entry["loaded_at"] > config.RECORD_CACHE_TTL_SECONDS:
+            expired_watch = _drop(u_id)
+            metrics.incr("record_cache.expired")
+            entry = None
+        if entry is not None:
+            _entries.move_to_end(u_id)
+            records = copy.deepcopy(entry["records"])
+    _stop_watch(expired_watch)
+
+    if entry is None:
+        metrics.incr("record_cache.miss")
+        return None
+    metrics.incr("record_cache.hit")
+    return records
+
+
+def _store(u_id: str, records: list, generation: int):
+    """読み込んだレコードを保存（読み込み中に書き込みがあった場合は保存しない）"""
+    if len(records) > config.RECORD_CACHE_MAX_RECORDS:
+        metrics.incr("record_cache.too_large")
+        return
+
+    watch = _watch(u_id) if config.RECORD_CACHE_LISTEN else None
+    stale = []
+    with _lock:
+        if _generations.get(u_id, 0) != generation:
+            metrics.incr("record_cache.store_skipped")
+            stale.append(watch)
+        else:
+            stale.append(_drop(u_id))
+            _entries[u_id] = {
+                "records": {record["id"]: copy.deepcopy(record) for record in records},
+                "loaded_at": time.monotonic(),
+                "watch": watch
+            }
+            while len(_entries) > config.RECORD_CACHE_MAX_USERS:
+                _, evicted = _entries.popitem(last=False)
+                stale.append(evicted["watch"])
+                metrics.incr("record_cache.evicted")
+    for old_watch in stale:
+        _stop_watch(old_watch)
+
+
+async def get_user_records(u_id: str) -> list:
+    """ユーザーの全レコードを取得（idフィールド付き、キャッシュがあればFirestoreを読まない）"""
+    if not config.RECORD_CACHE_ENABLED:
+        return await database.get_user_records(u_id)
+
+    cached = _lookup(u_id)
+    if cached is not None:
+        return list(cached.values())
+
+    with _lock:
+        generation = _generations.get(u_id, 0)
+    records = await database.get_user_records(u_id)
+    _store(u_id, records, generation)
+    return records
+
+
+async def get_user_records_by_ids(u_id: str, record_ids: list) -> list:
+    """指定IDのレコードを取得（存在するもののみ、指定順）
+
+    全件のキャッシュがあればそこから返し、なければ指定IDだけをFirestoreから読む（全件は読み込まない）。
+    """
+    if config.RECORD_CACHE_ENABLED:
+        cached = _lookup(u_id)
+        if cached is not None:
+            return [cached[record_id] for record_id in record_ids if record_id in cached]
+    return await database.get_user_records_by_ids(u_id, record_ids)
+
+
+def invalidate(u_id: str):
+    """ユーザーのキャッシュを破棄（レコードの追加など、内容を手元で再現できない書き込みの後に呼ぶ）"""
+    with _lock:
+        _bump(u_id)
+        cached = u_id in _entries
+        watch = _drop(u_id)
+    if cached:
+        metrics.incr("record_cache.invalidated")
+    _stop_watch(watch)
+
+
+def patch_records(u_id: str, record_ids: list, fields: dict):
+    """キャッシュ中のレコードに更新内容を反映"""
+    with _lock:
+        _bump(u_id)
+        entry = _entries.get(u_id)
+        if entry is None:
+            return
+        for record_id in record_ids:
+            record = entry["records"].get(record_id)
+            if record is not None:
+                record.update(copy.deepcopy(fields))
+    metrics.incr("record_cache.patched")
+
+
+def remove_records(u_id: str, record_ids: list):
+    """キャッシュ中のレコードから削除したものを除く"""
+    with _lock:
+        _bump(u_id)
+        entry = _entries.get(u_id)
+        if entry is None:
+            return
+        for record_id in record_ids:
+            entry["records"].pop(record_id, None)
+    metrics.incr("record_cache.patched")
+
+
+def get_record_cache_stats() -> dict:
+    """ヒット率などの統計を取得"""
+    hits = metrics.get_counter("record_cache.hit")
+    misses = metrics.get_counter("record_cache.miss")
+    with _lock:
+        users = len(_entries)
+        records = sum(len(entry["records"]) for entry in _entries.values())
+    return {
+        "enabled": config.RECORD_CACHE_ENABLED,
+        "listen": config.RECORD_CACHE_LISTEN,
+        "users": users,
+        "records": records,
+        "hit": hits,
+        "miss": misses,
+        "hit_rate": round(hits / (hits + misses), 3) if hits + misses else None,
+        "invalidated": metrics.get_counter("record_cache.invalidated"),
+        "remote_invalidated": metrics.get_counter("record_cache.remote_invalidated"),
+        "own_write_ignored": metrics.get_counter("record_cache.own_write_ignored"),
+        "patched": metrics.get_counter("record_cache.patched"),
+        "evicted": metrics.get_counter("record_cache.evicted"),
+        "expired": metrics.get_counter("record_cache.expired")
+    }
@@ -0,0 +1,318 @@
+"""
+解析スケジューラー
+ユーザー間でGemini解析の実行枠を公平に割り当てる（プランごとの重み付き公平キュー + 優先レーン）
+"""
+import time
+import asyncio
+import threading
+from collections import deque
+from contextlib import contextmanager, asynccontextmanager
+from utils import metrics
+import config
+
+# レーン（interactive: LINE・1ファイルのアップロード / bulk: 複数ファイルのアップロード）
+LANE_INTERACTIVE = "interactive"
+LANE_BULK = "bulk"
+LANES = (LANE_INTERACTIVE, LANE_BULK)
+
+# 実行中のスレッドが確保している枠（slot_released で一時的に手放すため）
+_local = threading.local()
+
+
+def _plan_settings(plan: str) -> dict:
+    """プランの重み・ユーザーあたりの同時実行上限を取得"""
+    plan_id = plan if plan in config.PLANS else "free"
+    plan_info = config.PLANS[plan_id]
+    return {
+        "plan": plan_id,
+        "weight": max(0.1, float(plan_info.get("weight", 1))),
+        "max_concurrent": max(1, int(plan_info.get("max_concurrent", 1)))
+    }
+
+
+def lane_for_upload(file_count: int) -> str:
+    """アップロードのファイル数からレーンを決定"""
+    return LANE_INTERACTIVE if file_count <= 1 else LANE_BULK
+
+
+class _Waiter:
+    __slots__ = ("u_id", "plan", "lane", "start_tag", "enqueued_at", "submitted_at", "granted_at", "wake", "granted")
+
+    def __init__(self, u_id: str, plan: str, lane: str, start_tag: float, wake):
+        self.u_id = u_id
+        self.plan = plan
+        self.lane = lane
+        self.start_tag = start_tag
+        self.enqueued_at = time.monotonic()
+        self.submitted_at = self.enqueued_at  # 最初の投入時刻（枠を手放して並び直しても変えない）
+        self.granted_at = None
+        self.wake = wake
+        self.granted = False
+
+
+class FairScheduler:
+    """重み付き公平キュー（Start-time Fair Queuing）
+
+    ユーザーごとに仮想時刻のタグを振り、実行枠が空くたびに最も小さいタグの処理を通す。
+    重みの大きいプランほどタグの進みが遅く、多くの枠を得る。1ユーザーが大量に投入しても、
+    他のユーザーの処理は自分の順番で割り込める。ユーザーごとの同時実行数はプランの上限まで。
+
+    レーンは interactive を優先し、bulk は interactive_reserved_slots 分を除いた枠しか使えない。
+    これにより大量アップロード中でも対話的な処理は空き枠ですぐに始まり、bulk は残りの枠で処理を続ける。
+    逆に bulk が待機している間は、interactive は bulk_reserved_slots 分を除いた枠しか使えない
+    （interactive が途切れなく続いても bulk が止まらない。bulk が待機していなければ全枠を使える）。
+    スレッド（slot）とイベントループ（async_slot）の両方から利用できる。
+    """
+
+    def __init__(self, capacity: int, interactive_reserved_slots: int = 0, bulk_reserved_slots: int = 0):
+        self.capacity = max(1, capacity)
+        # bulk が使えない（interactive 専用の）枠数。全枠を予約すると bulk が進まないため最低1枠は残す
+        self.interactive_reserved_slots = min(max(0, interactive_reserved_slots), self.capacity - 1)
+        # bulk の待機中に interactive が使えない枠数。interactive 専用の枠（最低1枠）とは重ならないようにする
+        self.bulk_reserved_slots = min(max(0, bulk_reserved_slots), self.capacity - max(1, self.interactive_reserved_slots))
+        self._lock = threading.Lock()
+        self._queues = {lane: {} for lane in LANES}       # レーン → ユーザーID → 待機中の _Waiter（投入順）
+        self._last_finish = {lane: {} for lane in LANES}  # レーン → ユーザーID → 最後に投入した処理の終了タグ
+        self._virtual_time = {lane: 0.0 for lane in LANES}
+        self._running = {}       # ユーザーID → 実行中の数（レーン共通）
+        self._running_plans = {}  # ユーザーID → 実行中の処理のプラン
+        self._lane_in_use = {lane: 0 for lane in LANES}
+
+    def _enqueue(self, u_id: str, plan: str, lane: str, wake) -> _Waiter:
+        settings = _plan_settings(plan)
+        lane = lane if lane in LANES else LANE_BULK
+        with self._lock:
+            last_finish = self._last_finish[lane]
+            start_tag = max(self._virtual_time[lane], last_finish.get(u_id, 0.0))
+            last_finish[u_id] = start_tag + 1 / settings["weight"]
+            waiter = _Waiter(u_id, settings["plan"], lane, start_tag, wake)
+            self._queues[lane].setdefault(u_id, deque()).append(waiter)
+            depth = sum(1 for queues in self._queues.values() for q in queues.values() for w in q if w.plan == waiter.plan)
+            granted = self._dispatch()
+        metrics.histogram(f"scheduler.queue_depth.{waiter.plan}", depth, buckets=(0, 1, 2, 5, 10, 20, 50, 100, 500))
+        self._wake_all(granted)
+        return waiter
+
+    def _pick(self, lane: str):
+        """レーン内で次に通す処理（最小タグ・ユーザー上限未満）を選ぶ"""
+        best = None
+        for u_id, queue in self._queues[lane].items():
+            head = queue[0]
+            if self._running.get(u_id, 0) >= _plan_settings(head.plan)["max_concurrent"]:
+                continue
+            if best is None or head.start_tag < best.start_tag:
+                best = head
+        return best
+
+    def _dispatch(self) -> list:
+        """空いている枠に待機中の処理を割り当てる（ロック内で呼ぶ）"""
+        granted = []
+        bulk_capacity = self.capacity - self.interactive_reserved_slots
+        interactive_capacity = self.capacity - self.bulk_reserved_slots
+        while sum(self._lane_in_use.values()) < self.capacity:
+            bulk = self._pick(LANE_BULK) if self._lane_in_use[LANE_BULK] < bulk_capacity else None
+            best = None
+            # bulk が待機していなければ interactive は全枠を使える
+            if bulk is None or self._lane_in_use[LANE_INTERACTIVE] < interactive_capacity:
+                best = self._pick(LANE_INTERACTIVE)
+            if best is None:
+                best = bulk
+            if best is None:
+                break
+
+            queues = self._queues[best.lane]
+            queues[best.u_id].popleft()
+            if not queues[best.u_id]:
+                del queues[best.u_id]
+            best.granted = True
+            best.granted_at = time.monotonic()
+            self._virtual_time[best.lane] = max(self._virtual_time[best.lane], best.start_tag)
+            self._running[best.u_id] = self._running.get(best.u_id, 0) + 1
+            self._running_plans[best.u_id] = best.plan
+            self._lane_in_use[best.lane] += 1
+            granted.append(best)
+
+        for lane in LANES:
+            if not self._queues[lane] and self._lane_in_use[lane] == 0:
+                # レーンが空になったらタグをリセット（値が際限なく増えないように）
+                self._virtual_time[lane] = 0.0
+                self._last_finish[lane].clear()
+        return granted
+
+    def _wake_all(self, granted: list):
+        for waiter in granted:
+            wait_ms = (waiter.granted_at - waiter.enqueued_at) * 1000
+            metrics.histogram(f"scheduler.wait_ms.{waiter.plan}", wait_ms)
+            metrics.observe(f"scheduler.wait_ms.{waiter.plan}", wait_ms)
+            metrics.observe(f"scheduler.lane.{waiter.lane}.wait_ms", wait_ms)
+            waiter.wake()
+
+    def _release(self, waiter: _Waiter, completed: bool = True):
+        with self._lock:
+            if waiter.granted:
+                self._running[waiter.u_id] -= 1
+                if self._running[waiter.u_id] == 0:
+                    del self._running[waiter.u_id]
+                    del self._running_plans[waiter.u_id]
+                self._lane_in_use[waiter.lane] -= 1
+            else:
+                # 待機中に取り消された場合はキューから外す
+                queue = self._queues[waiter.lane].get(waiter.u_id)
+                if queue and waiter in queue:
+                    queue.remove(waiter)
+                    if not queue:
+                        del self._queues[waiter.lane][waiter.u_id]
+            granted = self._dispatch()
+        self._wake_all(granted)
+
+        if waiter.granted and completed:
+            # 投入から完了までの時間（レーンごと・目標超過数）
+            latency_ms = (time.monotonic() - waiter.submitted_at) * 1000
+            metrics.observe(f"scheduler.lane.{waiter.lane}.latency_ms", latency_ms)
+            metrics.histogram(f"scheduler.lane.{waiter.lane}.latency_ms", latency_ms)
+            metrics.incr(f"scheduler.lane.{waiter.lane}.completed")
+            if waiter.lane == LANE_INTERACTIVE and latency_ms > config.INTERACTIVE_LATENCY_TARGET_MS:
+                metrics.incr("scheduler.lane.interactive.target_missed")
+
+    @contextmanager
+    def slot(self, u_id: str, plan: str = None, lane: str = LANE_BULK):
+        """実行枠を確保（ワーカースレッド用、順番が来るまでブロック）"""
+        event = threading.Event()
+        lease = SlotLease(self, self._enqueue(u_id, plan, lane, event.set))
+        previous = getattr(_local, "lease", None)
+        try:
+            event.wait()
+            _local.lease = lease
+            yield lease
+        finally:
+            _local.lease = previous
+            lease.close()
+
+    @asynccontextmanager
+    async def async_slot(self, u_id: str, plan: str = None, lane: str = LANE_BULK):
+        """実行枠を確保（イベントループ用、待機中はスレッドを占有しない）
+
+        枠内の処理をスレッドで実行する場合は lease.bind(func) を渡すと、
+        その処理の中から slot_released で枠を一時的に手放せる。
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        lease = SlotLease(self, self._enqueue(u_id, plan, lane, wake))
+        try:
+            await future
+            yield lease
+        finally:
+            lease.close()
+
+    def get_state(self) -> dict:
+        """プラン・レーンごとの待機数・実行数を取得"""
+        with self._lock:
+            plans = {plan_id: {"queued": 0, "running": 0, "users_waiting": 0} for plan_id in config.PLANS}
+            lanes = {lane: {"queued": 0, "running": self._lane_in_use[lane]} for lane in LANES}
+            for lane, queues in self._queues.items():
+                for queue in queues.values():
+                    plan_id = queue[0].plan
+                    plans[plan_id]["queued"] += len(queue)
+                    plans[plan_id]["users_waiting"] += 1
+                    lanes[lane]["queued"] += len(queue)
+            for u_id, count in self._running.items():
+                plans[self._running_plans[u_id]]["running"] += count
+            running_users = len(self._running)
+            in_use = sum(self._lane_in_use.values())
+
+        for lane in LANES:
+            for q in (50, 95):
+                value = metrics.percentile(f"scheduler.lane.{lane}.latency_ms", q)
+                lanes[lane][f"latency_p{q}_ms"] = round(value, 1) if value is not None else None
+        lanes[LANE_INTERACTIVE]["target_ms"] = config.INTERACTIVE_LATENCY_TARGET_MS
+        lanes[LANE_INTERACTIVE]["target_missed"] = metrics.get_counter("scheduler.lane.interactive.target_missed")
+
+        return {
+            "capacity": self.capacity,
+            "interactive_reserved_slots": self.interactive_reserved_slots,
+            "bulk_reserved_slots": self.bulk_reserved_slots,
+            "in_use": in_use,
+            "running_users": running_users,
+            "lanes": lanes,
+            "plans": plans
+        }
+
+
+class SlotLease:
+    """確保した実行枠（待機が長い間は一時的に手放し、改めて順番を待って取り直せる）"""
+
+    def __init__(self, scheduler: FairScheduler, waiter: _Waiter):
+        self.scheduler = scheduler
+        self.waiter = waiter  # 手放している間は None
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def bind(self, func):
+        """func を実行するスレッドでこの枠を確保中として扱う（slot_released が使えるようにする）"""
+        def run(*args, **kwargs):
+            previous = getattr(_local, "lease", None)
+            _local.lease = self
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _local.lease = previous
+        return run
+
+    def suspend(self):
+        """枠を手放す（完了としては数えない。戻り値は手放した _Waiter、手放せなかった場合は None）"""
+        with self._lock:
+            if self._closed or self.waiter is None or not self.waiter.granted:
+                return None
+            waiter, self.waiter = self.waiter, None
+            self.scheduler._release(waiter, completed=False)
+        metrics.incr("scheduler.suspended")
+        return waiter
+
+    def resume(self, first: _Waiter):
+        """手放した枠を取り直す（同じユーザー・レーンで並び直し、順番が来るまでブロック）"""
+        event = threading.Event()
+        with self._lock:
+            if self._closed:
+                return
+            waiter = self.scheduler._enqueue(first.u_id, first.plan, first.lane, event.set)
+            waiter.submitted_at = first.submitted_at
+            self.waiter = waiter
+        event.wait()
+
+    def close(self):
+        """枠を返す（待機中なら取り消し、並び直しの待機で止まっているスレッドは起こす）"""
+        with self._lock:
+            self._closed = True
+            waiter, self.waiter = self.waiter, None
+            if waiter is None:
+                return
+            self.scheduler._release(waiter)
+        if not waiter.granted:
+            waiter.wake()
+
+
+@contextmanager
+def slot_released():
+    """実行中のスレッドが確保している枠を、ブロック内の間だけ手放す
+
+    レート制限のバックオフなど、Geminiを使わずに待つ間に他の処理を通すために使う。
+    枠の外や bind していないスレッドから呼ばれた場合は何もしない。
+    """
+    lease = getattr(_local, "lease", None)
+    first = lease.suspend() if lease is not None else None
+    if first is None:
+        yield
+        return
+    try:
+        yield
+    finally:
+        lease.resume(first)
+
+
+analysis_scheduler = FairScheduler(
+    config.ANALYSIS_SLOTS, config.ANALYSIS_INTERACTIVE_RESERVED_SLOTS, config.ANALYSIS_BULK_RESERVED_SLOTS
+)
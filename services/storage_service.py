@@ -13,6 +13,13 @@ def upload_to_gcs(file_path: str, destination_blob_name: str) -> str:
     blob.upload_from_filename(file_path)
     return f"https://storage.googleapis.com/{config.BUCKET_NAME}/{destination_blob_name}"
 
+def upload_bytes(data: bytes, destination_blob_name: str, content_type: str = "image/jpeg") -> str:
+    """メモリ上のデータをCloud Storageにアップロードし、公開URLを返す"""
+    bucket = storage_client.bucket(config.BUCKET_NAME)
+    blob = bucket.blob(destination_blob_name)
+    blob.upload_from_string(data, content_type=content_type)
+    return f"https://storage.googleapis.com/{config.BUCKET_NAME}/{destination_blob_name}"
+
 def delete_from_gcs(image_url: str) -> bool:
     """Cloud Storageからファイルを削除"""
     try:
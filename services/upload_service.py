@@ -0,0 +1,245 @@
+"""
+アップロード処理サービス
+ファイル単位の解析パイプラインと並列実行を管理
+"""
+import os
+import time
+import shutil
+import asyncio
+import traceback
+from google.cloud import firestore
+from database import db
+from services.gemini_service import analyze_with_gemini_retry, analyze_batch_with_gemini
+from services.image_service import compress_image_in_pool, prepare_for_analysis_in_pool, convert_pdf_to_images
+from services.storage_service import upload_to_gcs
+from services.scheduler import analysis_scheduler, lane_for_upload
+from services.aggregates_service import apply_record_changes
+from services import record_cache
+from utils import metrics
+from utils.executors import run_analysis
+from utils.helpers import generate_record_id
+import config
+
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.webp']
+
+
+def save_upload_file(file, idx: int) -> dict:
+    """アップロードファイルを一時ディレクトリに保存"""
+    original_filename = file.filename
+    file_ext = os.path.splitext(original_filename)[1]
+    # 並列処理・複数インスタンスでもファイル名が衝突しないようにレコードIDと同じ方式で採番
+    safe_filename = f"{generate_record_id()}_{idx}{file_ext}"
+    temp_path = os.path.join(config.UPLOAD_DIR, safe_filename)
+
+    with open(temp_path, "wb") as b:
+        shutil.copyfileobj(file.file, b)
+
+    return {
+        "original_filename": original_filename,
+        "safe_filename": safe_filename,
+        "temp_path": temp_path
+    }
+
+
+def _prepare_receipt_file(saved: dict) -> dict:
+    """解析前の準備（圧縮→GCS→PDF画像化・解析用の前処理）"""
+    original_filename = saved["original_filename"]
+    temp_path = saved["temp_path"]
+    file_ext = os.path.splitext(original_filename)[1]
+
+    # PDFファイルかどうかをチェック
+    is_pdf = original_filename.lower().endswith('.pdf')
+
+    # 画像の場合は圧縮
+    if not is_pdf and file_ext.lower() in IMAGE_EXTENSIONS:
+        temp_path = compress_image_in_pool(temp_path, max_size=(1920, 1080), quality=85)
+        saved["temp_path"] = temp_path
+
+    # Cloud Storageへアップロード
+    # 圧縮で出力形式（拡張子）が変わる場合があるため、圧縮後のファイル名を使う
+    gcs_file_name = f"receipts/{os.path.basename(temp_path)}"
+    public_url = upload_to_gcs(temp_path, gcs_file_name)
+    print(f"GCS URL: {public_url}")
+
+    # PDFの場合は画像化
+    pdf_image_urls = []
+    if is_pdf:
+        pdf_image_urls = convert_pdf_to_images(temp_path)
+        print(f"PDF images created: {len(pdf_image_urls)}")
+    elif file_ext.lower() in IMAGE_EXTENSIONS:
+        # 解析には領収書部分を切り抜いたコピーを使う（GCSには撮影したままの画像を残す）
+        saved["analysis_path"] = prepare_for_analysis_in_pool(temp_path)
+
+    return {"is_pdf": is_pdf, "public_url": public_url, "pdf_image_urls": pdf_image_urls}
+
+
+def _analysis_path(saved: dict) -> str:
+    """Gemini解析に渡すファイル（前処理済みのコピーがなければ保存用のファイル）"""
+    return saved.get("analysis_path") or saved["temp_path"]
+
+
+def commit_receipt_records(u_id: str, items: list) -> list:
+    """解析結果のレコード・使用回数・集計を1回のバッチ書き込みで保存（戻り値はドキュメントID）
+
+    1ファイル分の書き込みをまとめてコミットするため、途中で失敗しても
+    レコードだけ保存されて使用回数が増えない（またはその逆の）状態にならない。
+    """
+    user_ref = db.collection(config.COL_USERS).document(u_id)
+    records_ref = user_ref.collection("records")
+
+    batch = db.batch()
+    doc_ids = []
+    for item in items:
+        doc_id = generate_record_id()
+        item["id"] = doc_id
+        # 出力済みフラグで絞り込めるよう、未出力も明示的に保存する
+        item.setdefault("exported", False)
+        batch.set(records_ref.document(doc_id), item)
+        doc_ids.append(doc_id)
+    # 使用回数をインクリメント
+    batch.update(user_ref, {"subscription.used": firestore.Increment(1)})
+    # 集計にも同じコミットで反映
+    apply_record_changes(batch, u_id, [(None, item) for item in items])
+
+    started = time.perf_counter()
+    batch.commit()
+    record_cache.invalidate(u_id)
+    metrics.observe("firestore.ingest_commit_ms", (time.perf_counter() - started) * 1000)
+    metrics.observe("firestore.ingest_docs_per_commit", len(items) + 2)
+    metrics.histogram("firestore.ingest_docs_per_commit", len(items) + 2, buckets=(1, 2, 3, 5, 10, 20, 50))
+    return doc_ids
+
+
+def _save_receipt_records(u_id: str, saved: dict, prepared: dict, data_list) -> dict:
+    """解析結果をFirestoreに保存して使用回数をインクリメント"""
+    original_filename = saved["original_filename"]
+    is_pdf = prepared["is_pdf"]
+
+    items = data_list if isinstance(data_list, list) else [data_list]
+    for item in items:
+        item.update({
+            "image_url": prepared["public_url"],
+            "created_at": firestore.SERVER_TIMESTAMP,
+            "is_pdf": is_pdf,
+            "pdf_images": prepared["pdf_image_urls"] if is_pdf else [],
+            "original_filename": original_filename,
+            "category": "その他",
+            "source": "web"
+        })
+    commit_receipt_records(u_id, items)
+
+    print(f"✅ Success: {original_filename}")
+    return {
+        "filename": original_filename,
+        "status": "success",
+        "records_count": len(data_list) if isinstance(data_list, list) else 1
+    }
+
+
+def _error_result(original_filename, e: Exception) -> dict:
+    print(f"❌ Error processing {original_filename}: {type(e).__name__}: {str(e)}")
+    if e.__traceback__ is not None:
+        traceback.print_exception(type(e), e, e.__traceback__)
+    return {
+        "filename": str(original_filename),
+        "status": "error",
+        "error": str(e)
+    }
+
+
+def process_receipt_batch(u_id: str, saved_list: list, plan: str = None) -> list:
+    """複数ファイルをまとめて処理（画像は1回のGeminiリクエストで解析）
+
+    戻り値は saved_list と同じ順序のファイルごとの結果。
+    """
+    results = [None] * len(saved_list)
+    prepared = {}
+
+    try:
+        for i, saved in enumerate(saved_list):
+            try:
+                prepared[i] = _prepare_receipt_file(saved)
+            except Exception as e:
+                results[i] = _error_result(saved["original_filename"], e)
+
+        # Gemini 解析（まとめて送信し、必要なものだけ個別にリトライ）
+        targets = list(prepared)
+        if len(targets) == 1:
+            try:
+                analyses = [analyze_with_gemini_retry(_analysis_path(saved_list[targets[0]]), max_retries=3, plan=plan)]
+            except Exception as e:
+                analyses = [e]
+        elif targets:
+            analyses = analyze_batch_with_gemini(
+                [_analysis_path(saved_list[i]) for i in targets], max_retries=3, plan=plan
+            )
+        else:
+            analyses = []
+
+        for i, data_list in zip(targets, analyses):
+            saved = saved_list[i]
+            try:
+                if isinstance(data_list, Exception):
+                    raise data_list
+                results[i] = _save_receipt_records(u_id, saved, prepared[i], data_list)
+            except Exception as e:
+                results[i] = _error_result(saved["original_filename"], e)
+
+        return results
+
+    finally:
+        # 一時ファイルを削除
+        for saved in saved_list:
+            for path in {saved["temp_path"], _analysis_path(saved)}:
+                if os.path.exists(path):
+                    os.remove(path)
+
+
+def process_receipt_file(u_id: str, saved: dict, plan: str = None) -> dict:
+    """1ファイル分の処理（圧縮→GCS→PDF画像化→Gemini解析→Firestore保存）"""
+    return process_receipt_batch(u_id, [saved], plan)[0]
+
+
+def plan_batches(saved_files: list) -> list:
+    """まとめて解析する単位に分割（画像は GEMINI_BATCH_SIZE 件ずつ、PDFは1件ずつ）
+
+    戻り値は [(入力インデックス, saved), ...] のリスト。
+    """
+    size = max(1, config.GEMINI_BATCH_SIZE)
+    units = []
+    images = []
+    for idx, saved in enumerate(saved_files):
+        file_ext = os.path.splitext(saved["original_filename"])[1].lower()
+        if file_ext in IMAGE_EXTENSIONS and size > 1:
+            images.append((idx, saved))
+            if len(images) == size:
+                units.append(images)
+                images = []
+        else:
+            units.append([(idx, saved)])
+    if images:
+        units.append(images)
+    return units
+
+
+async def process_files_concurrently(u_id: str, saved_files: list, plan: str = None, concurrency: int = None) -> list:
+    """複数ファイルを並列数を制限して処理（結果は入力順を維持）"""
+    limit = max(1, concurrency or config.UPLOAD_CONCURRENCY)
+    semaphore = asyncio.Semaphore(limit)
+    total = len(saved_files)
+    units = plan_batches(saved_files)
+    lane = lane_for_upload(total)
+    print(f"Processing {total} files in {len(units)} batches (concurrency: {limit}, lane: {lane})")
+
+    async def run(unit: list) -> list:
+        async with semaphore, analysis_scheduler.async_slot(u_id, plan, lane) as lease:
+            names = ", ".join(saved["original_filename"] for _, saved in unit)
+            print(f"\n--- Processing files {unit[0][0] + 1}-{unit[-1][0] + 1}/{total}: {names} ---")
+            return await run_analysis(lease.bind(process_receipt_batch), u_id, [saved for _, saved in unit], plan)
+
+    results = [None] * total
+    unit_results = await asyncio.gather(*(run(unit) for unit in units))
+    for unit, unit_result in zip(units, unit_results):
+        for (idx, _), result in zip(unit, unit_result):
+            results[idx] = result
+    return results
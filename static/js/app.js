@@ -17,6 +17,7 @@ window.register = auth.register;
 window.logout = auth.logout;
 window.switchMainTab = auth.switchMainTab;
 window.loadStatus = records.loadStatus;
+window.loadMoreRecords = records.loadMoreRecords;
 window.applyFilters = records.applyFilters;
 window.clearFilters = records.clearFilters;
 window.deleteRecord = records.deleteRecord;
@@ -31,6 +31,7 @@ export const state = {
     selectedFiles: [],
     editingRecordId: null,
     allRecords: [],
+    recordsCursor: null,
     currentImageIndex: 0,
     currentImages: []
 };
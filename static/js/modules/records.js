@@ -6,14 +6,39 @@
 import { state, categoryIcons } from './config.js';
 import { authFetch, showLoading, hideLoading } from './utils.js';
 
+const RECORDS_PAGE_SIZE = 50;
+
 /**
- * ステータス取得
+ * レコード一覧APIのURL（日付・カテゴリの絞り込みはサーバー側で行う）
+ */
+function recordsQuery(cursor) {
+    const startDate = document.getElementById('filterStartDate').value;
+    const endDate = document.getElementById('filterEndDate').value;
+    const category = document.getElementById('filterCategory').value;
+    const params = new URLSearchParams({
+        order: (startDate || endDate) ? 'date_desc' : 'created_desc',
+        limit: String(RECORDS_PAGE_SIZE)
+    });
+    if (startDate) params.set('start_date', startDate);
+    if (endDate) params.set('end_date', endDate);
+    if (category) params.set('category', category);
+    if (cursor) params.set('cursor', cursor);
+    return `/api/records?${params}`;
+}
+
+/**
+ * ステータス取得（レコードは1ページ目のみ、続きは loadMoreRecords で読み込む）
  */
 export async function loadStatus() {
     try {
-        const res = await authFetch('/api/status');
-        const data = await res.json();
-        state.allRecords = data.records.reverse();
+        const [statusRes, recordsRes] = await Promise.all([
+            authFetch('/api/status'),
+            authFetch(recordsQuery(null))
+        ]);
+        const data = await statusRes.json();
+        const page = await recordsRes.json();
+        state.allRecords = page.records;
+        state.recordsCursor = page.next_cursor;
 
         // サブスク情報を表示
         displaySubscriptionInfo(data.subscription);
@@ -28,6 +53,22 @@ export async function loadStatus() {
     }
 }
 
+/**
+ * 次のページを読み込んで一覧に追加
+ */
+export async function loadMoreRecords() {
+    if (!state.recordsCursor) return;
+    try {
+        const res = await authFetch(recordsQuery(state.recordsCursor));
+        const page = await res.json();
+        state.allRecords = state.allRecords.concat(page.records);
+        state.recordsCursor = page.next_cursor;
+        applyFilters();
+    } catch (e) {
+        console.error(e);
+    }
+}
+
 /**
  * サブスク情報を表示
  */
@@ -93,28 +134,13 @@ async function checkLineStatus() {
 }
 
 /**
- * フィルター適用
+ * フィルター適用（店舗名は読み込み済みのレコードから検索）
  */
 export function applyFilters() {
     const searchVendor = document.getElementById('searchVendor').value.toLowerCase();
-    const startDate = document.getElementById('filterStartDate').value;
-    const endDate = document.getElementById('filterEndDate').value;
-    const category = document.getElementById('filterCategory').value;
 
-    let filtered = state.allRecords.filter(r => {
-        if (searchVendor && !r.vendor_name.toLowerCase().includes(searchVendor)) {
-            return false;
-        }
-        if (startDate && r.date < startDate) {
-            return false;
-        }
-        if (endDate && r.date > endDate) {
-            return false;
-        }
-        if (category && r.category !== category) {
-            return false;
-        }
-        return true;
+    const filtered = state.allRecords.filter(r => {
+        return !searchVendor || (r.vendor_name || '').toLowerCase().includes(searchVendor);
     });
 
     renderRecords(filtered);
@@ -128,7 +154,7 @@ export function clearFilters() {
     document.getElementById('filterStartDate').value = '';
     document.getElementById('filterEndDate').value = '';
     document.getElementById('filterCategory').value = '';
-    renderRecords(state.allRecords);
+    loadStatus();
 }
 
 /**
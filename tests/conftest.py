@@ -0,0 +1,28 @@
+"""
+テスト共通設定
+database.py はインポート時に Firestore・Storage のクライアントを作成するため、
+認証情報のない環境でもクライアントを作成できるようエミュレーター向けの設定を入れる（実際には接続しない）。
+
+実行方法:
+    pip install -r requirements-dev.txt
+    python -m pytest tests
+"""
+import os
+import sys
+import pytest
+
+os.environ.setdefault("GOOGLE_CLOUD_PROJECT", "test-project")
+os.environ.setdefault("FIRESTORE_EMULATOR_HOST", "localhost:8080")
+os.environ.setdefault("STORAGE_EMULATOR_HOST", "http://localhost:9023")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def fresh_metrics(monkeypatch):
+    """メトリクスを空の状態にする（テストごとにカウンター・観測値を分ける）"""
+    from utils import metrics
+    monkeypatch.setattr(metrics, "_counters", {})
+    monkeypatch.setattr(metrics, "_timings", {})
+    monkeypatch.setattr(metrics, "_histograms", {})
+    return metrics
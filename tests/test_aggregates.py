@@ -0,0 +1,120 @@
+"""
+レコード集計の差分計算（services/aggregates_service.py）のテスト
+"""
+from services.aggregates_service import record_contribution, _delta, _nested, _summarize
+
+
+def make_record(**fields) -> dict:
+    record = {"date": "2026-03-15", "vendor_name": "テスト商店", "total_amount": 1200, "category": "消耗品費", "exported": False}
+    record.update(fields)
+    return record
+
+
+def test_contribution_of_basic_record():
+    values = record_contribution(make_record())
+
+    assert values == {
+        ("count",): 1,
+        ("total_amount",): 1200,
+        ("by_category", "消耗品費", "count"): 1,
+        ("by_category", "消耗品費", "amount"): 1200,
+        ("unexported_count",): 1,
+        ("by_month", "2026-03", "count"): 1,
+        ("by_month", "2026-03", "amount"): 1200,
+    }
+
+
+def test_contribution_of_empty_record():
+    assert record_contribution(None) == {}
+
+
+def test_exported_record_is_not_unexported():
+    assert ("unexported_count",) not in record_contribution(make_record(exported=True))
+
+
+def test_parking_and_bicycle_parking():
+    parking = record_contribution(make_record(vendor_name="タイムズ", is_parking=True))
+    keyword = record_contribution(make_record(vendor_name="コインパーキング駅前"))
+    bicycle = record_contribution(make_record(vendor_name="駅前駐輪場", is_parking=True))
+
+    assert parking[("parking", "amount")] == 1200
+    assert keyword[("parking", "count")] == 1
+    assert ("parking", "count") not in bicycle
+
+
+def test_ic_transport_only_when_not_parking():
+    ic = record_contribution(make_record(is_ic_transport=True))
+    both = record_contribution(make_record(is_ic_transport=True, is_parking=True))
+
+    assert ic[("ic_transport", "amount")] == 1200
+    assert ("ic_transport", "count") not in both
+
+
+def test_missing_or_invalid_values():
+    values = record_contribution(make_record(category=None, total_amount="abc", date=""))
+
+    assert values[("by_category", "その他", "count")] == 1
+    assert values[("total_amount",)] == 0
+    assert not any(path[0] == "by_month" for path in values)
+
+
+def test_delta_for_insert_and_delete():
+    record = make_record()
+
+    assert _delta([(None, record)]) == record_contribution(record)
+    assert _delta([(record, None)]) == {path: -value for path, value in record_contribution(record).items()}
+
+
+def test_delta_for_update_moves_category_and_amount():
+    old = make_record()
+    new = {**old, "category": "交通費", "total_amount": 500}
+
+    assert _delta([(old, new)]) == {
+        ("total_amount",): -700,
+        ("by_category", "消耗品費", "count"): -1,
+        ("by_category", "消耗品費", "amount"): -1200,
+        ("by_category", "交通費", "count"): 1,
+        ("by_category", "交通費", "amount"): 500,
+        ("by_month", "2026-03", "amount"): -700,
+    }
+
+
+def test_delta_for_mark_exported():
+    old = make_record()
+
+    assert _delta([(old, {**old, "exported": True})]) == {("unexported_count",): -1}
+
+
+def test_delta_without_changes_is_empty():
+    old = make_record()
+
+    assert _delta([(old, dict(old))]) == {}
+
+
+def test_delta_sums_multiple_changes():
+    a = make_record(total_amount=100)
+    b = make_record(total_amount=200, date="2026-04-01")
+
+    delta = _delta([(None, a), (None, b), (a, None)])
+
+    assert delta[("count",)] == 1
+    assert delta[("total_amount",)] == 200
+    assert delta[("by_month", "2026-04", "amount")] == 200
+    assert ("by_month", "2026-03", "count") not in delta
+
+
+def test_nested_keeps_dotted_category_names_as_single_keys():
+    nested = _nested({("by_category", "交通費.電車", "count"): 1, ("count",): 1})
+
+    assert nested == {"by_category": {"交通費.電車": {"count": 1}}, "count": 1}
+
+
+def test_summary_drops_zero_count_buckets():
+    summary = _summarize({
+        "count": 1,
+        "by_category": {"交通費": {"count": 0, "amount": 0}, "消耗品費": {"count": 1, "amount": 300}},
+        "by_month": {"2026-03": {"count": 1, "amount": 300}},
+    })
+
+    assert summary["by_category"] == {"消耗品費": {"count": 1, "amount": 300}}
+    assert summary["parking"] == {"count": 0, "amount": 0}
@@ -0,0 +1,111 @@
+"""
+解析結果キャッシュ（services/analysis_cache.py）のテスト
+"""
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+import pytest
+from services import analysis_cache
+import config
+
+
+class FakeSnapshot:
+    def __init__(self, doc_id, data):
+        self.id = doc_id
+        self._data = data
+        self.exists = data is not None
+
+    def to_dict(self):
+        return dict(self._data)
+
+
+class FakeRef:
+    def __init__(self, store, doc_id):
+        self.store = store
+        self.id = doc_id
+
+    def set(self, data):
+        self.store.docs[self.id] = data
+
+
+class FakeFirestore:
+    """analysis_cache コレクションだけを持つ Firestore の代わり（読み込み回数を数える）"""
+
+    def __init__(self):
+        self.docs = {}
+        self.reads = 0
+
+    def collection(self, name):
+        return self
+
+    def document(self, doc_id):
+        return FakeRef(self, doc_id)
+
+    def get_all(self, refs):
+        self.reads += 1
+        return [FakeSnapshot(ref.id, self.docs.get(ref.id)) for ref in refs]
+
+
+@pytest.fixture
+def store(monkeypatch, fresh_metrics):
+    fake = FakeFirestore()
+    monkeypatch.setattr(analysis_cache, "db", fake)
+    monkeypatch.setattr(analysis_cache, "_lru", OrderedDict())
+    monkeypatch.setattr(config, "ANALYSIS_CACHE_ENABLED", True)
+    return fake
+
+
+def test_key_depends_on_content_and_model():
+    key = analysis_cache.make_cache_key(b"image", "fast-model")
+
+    assert key == analysis_cache.make_cache_key(b"image", "fast-model")
+    assert key != analysis_cache.make_cache_key(b"other", "fast-model")
+    assert key != analysis_cache.make_cache_key(b"image", "pro-model")
+
+
+def test_miss_reads_firestore_once_and_counts_one_miss(store, fresh_metrics):
+    assert analysis_cache.get_cached_result("pro-key", "fast-key") is None
+
+    assert store.reads == 1
+    assert fresh_metrics.get_counter("analysis_cache.miss") == 1
+
+
+def test_same_key_for_both_tiers_is_read_once(store):
+    analysis_cache.get_cached_result("same-key", "same-key")
+
+    assert store.reads == 1
+
+
+def test_stored_result_is_served_from_memory(store, fresh_metrics):
+    analysis_cache.store_result("key", [{"total_amount": 100}], "fast-model")
+
+    result = analysis_cache.get_cached_result("key")
+    result[0]["total_amount"] = 0
+
+    assert analysis_cache.get_cached_result("key") == [{"total_amount": 100}]
+    assert store.reads == 0
+    assert fresh_metrics.get_counter("analysis_cache.hit_memory") == 2
+
+
+def test_firestore_hit_prefers_first_key(store, fresh_metrics):
+    later = datetime.now(timezone.utc) + timedelta(days=1)
+    store.docs["fast-key"] = {"result": ["fast"], "expires_at": later}
+    store.docs["pro-key"] = {"result": ["pro"], "expires_at": later}
+
+    assert analysis_cache.get_cached_result("pro-key", "fast-key") == ["pro"]
+    assert fresh_metrics.get_counter("analysis_cache.hit_firestore") == 1
+
+
+def test_expired_document_is_a_miss(store, fresh_metrics):
+    store.docs["key"] = {"result": ["old"], "expires_at": datetime.now(timezone.utc) - timedelta(seconds=1)}
+
+    assert analysis_cache.get_cached_result("key") is None
+    assert fresh_metrics.get_counter("analysis_cache.miss") == 1
+
+
+def test_stored_document_has_expiry(store, monkeypatch):
+    monkeypatch.setattr(config, "ANALYSIS_CACHE_RETENTION_SECONDS", 3600)
+
+    analysis_cache.store_result("key", ["result"], "fast-model")
+
+    expires_at = store.docs["key"]["expires_at"]
+    assert timedelta(minutes=59) < expires_at - datetime.now(timezone.utc) <= timedelta(hours=1)
@@ -0,0 +1,179 @@
+"""
+Gemini 呼び出しゲート（services/gemini_gate.py）のテスト
+"""
+import time
+import pytest
+from google.api_core import exceptions as google_exceptions
+from services.gemini_gate import GeminiGate, GeminiOverloadedError
+
+
+def make_gate(**overrides) -> GeminiGate:
+    settings = dict(
+        min_limit=1, max_limit=8, initial_limit=4, rate=0, burst=1,
+        failure_threshold=2, open_seconds=0.05, open_mode="fail", acquire_timeout=1.0,
+        latency_tolerance=3.0
+    )
+    settings.update(overrides)
+    return GeminiGate(**settings)
+
+
+def overload(gate: GeminiGate):
+    """過負荷エラーで終わる呼び出し"""
+    with pytest.raises(google_exceptions.ResourceExhausted):
+        with gate.slot():
+            raise google_exceptions.ResourceExhausted("quota")
+
+
+def succeed(gate: GeminiGate):
+    with gate.slot():
+        pass
+
+
+def test_success_increases_limit_additively():
+    gate = make_gate()
+    succeed(gate)
+
+    assert gate.get_state()["limit"] == pytest.approx(4.25)
+
+
+def test_overload_halves_limit():
+    gate = make_gate(failure_threshold=10)
+    overload(gate)
+
+    assert gate.get_state()["limit"] == 2
+
+
+def test_limit_decreases_at_most_once_per_second():
+    """連続した過負荷エラーでも下限まで一気に下がらない"""
+    gate = make_gate(failure_threshold=10)
+    overload(gate)
+    overload(gate)
+
+    assert gate.get_state()["limit"] == 2
+
+
+def test_limit_stays_within_bounds():
+    gate = make_gate(initial_limit=8)
+    for _ in range(20):
+        succeed(gate)
+
+    assert gate.get_state()["limit"] == 8
+
+
+def test_input_errors_do_not_count_as_overload():
+    """入力不正などのエラーはブレーカーの失敗に数えない"""
+    gate = make_gate(failure_threshold=1)
+    with pytest.raises(ValueError):
+        with gate.slot():
+            raise ValueError("bad response")
+
+    state = gate.get_state()
+    assert state["circuit"]["state"] == "closed"
+    assert state["limit"] == 4
+
+
+def test_breaker_opens_after_consecutive_overloads():
+    gate = make_gate()
+    overload(gate)
+    assert gate.get_state()["circuit"]["state"] == "closed"
+
+    overload(gate)
+    assert gate.get_state()["circuit"]["state"] == "open"
+    assert gate.is_open()
+    with pytest.raises(GeminiOverloadedError) as exc_info:
+        gate.acquire()
+    assert exc_info.value.retry_after >= 1.0
+
+
+def test_success_resets_consecutive_failures():
+    gate = make_gate()
+    overload(gate)
+    succeed(gate)
+    overload(gate)
+
+    assert gate.get_state()["circuit"]["state"] == "closed"
+
+
+def test_breaker_half_open_allows_single_probe_then_closes():
+    gate = make_gate()
+    overload(gate)
+    overload(gate)
+    time.sleep(0.06)
+
+    probe = gate.acquire()
+    assert probe is True
+    assert gate.get_state()["circuit"]["state"] == "half_open"
+    # 試行中は他のリクエストを通さない
+    with pytest.raises(GeminiOverloadedError):
+        gate.acquire()
+
+    gate.release(probe, success=True, overloaded=False)
+    assert gate.get_state()["circuit"]["state"] == "closed"
+    assert gate.acquire() is False
+
+
+def test_failed_probe_reopens_breaker():
+    gate = make_gate()
+    overload(gate)
+    overload(gate)
+    time.sleep(0.06)
+
+    probe = gate.acquire()
+    gate.release(probe, success=False, overloaded=True)
+
+    assert gate.get_state()["circuit"]["state"] == "open"
+
+
+def test_queue_mode_waits_for_breaker_to_half_open():
+    """queue モードでは遮断中も失敗させず、復帰確認の順番を待つ"""
+    gate = make_gate(open_mode="queue", open_seconds=0.05)
+    overload(gate)
+    overload(gate)
+
+    started = time.monotonic()
+    probe = gate.acquire()
+
+    assert probe is True
+    assert time.monotonic() - started >= 0.03
+
+
+def test_acquire_times_out_when_limit_is_full():
+    gate = make_gate(initial_limit=1, min_limit=1, max_limit=1, acquire_timeout=0.05)
+    probe = gate.acquire()
+
+    with pytest.raises(GeminiOverloadedError):
+        gate.acquire()
+    gate.release(probe, success=True, overloaded=False)
+    assert gate.get_state()["in_flight"] == 0
+
+
+def test_reset_keeps_slots_held_by_running_calls():
+    """実行中の呼び出しがある状態でリセットしても、同時実行数の上限が守られる"""
+    gate = make_gate(initial_limit=2, min_limit=1, max_limit=2, acquire_timeout=0.05)
+    held = [gate.acquire(), gate.acquire()]
+
+    gate.reset()
+    with pytest.raises(GeminiOverloadedError):
+        gate.acquire()
+
+    for probe in held:
+        gate.release(probe, success=True, overloaded=False)
+    assert gate.get_state()["in_flight"] == 0
+
+    again = [gate.acquire(), gate.acquire()]
+    with pytest.raises(GeminiOverloadedError):
+        gate.acquire()
+    for probe in again:
+        gate.release(probe, success=True, overloaded=False)
+    assert gate.get_state()["in_flight"] == 0
+
+
+def test_reset_closes_breaker():
+    gate = make_gate()
+    overload(gate)
+    overload(gate)
+
+    gate.reset()
+
+    assert gate.get_state()["circuit"]["state"] == "closed"
+    assert gate.acquire() is False
@@ -0,0 +1,266 @@
+"""
+Gemini 解析サービス（services/gemini_service.py）のテスト
+実際の API は呼ばず、モデル呼び出し部分を差し替えて振り分け・再試行の判断を確かめる。
+"""
+import json
+import time
+import threading
+import pytest
+from google.api_core import exceptions as google_exceptions
+from models.receipt import Receipt
+from services import gemini_service
+from services.scheduler import FairScheduler
+from utils import metrics
+import config
+
+
+def test_inline_call_records_saved_time_against_configured_baseline(fresh_metrics, monkeypatch):
+    monkeypatch.setattr(config, "GEMINI_FILES_API_BASELINE_MS", 1500.0)
+
+    part = gemini_service._prepare_file_part("receipt.jpg", b"x" * 1000)
+
+    assert part == {"mime_type": "image/jpeg", "data": b"x" * 1000}
+    assert fresh_metrics.get_counter("gemini.inline_calls") == 1
+    assert 1400 < fresh_metrics.percentile("gemini.inline_saved_ms", 50) <= 1500
+
+
+def test_saved_time_uses_measured_files_api_median(fresh_metrics, monkeypatch):
+    monkeypatch.setattr(config, "GEMINI_FILES_API_BASELINE_MS", 1500.0)
+    for _ in range(gemini_service.FILES_API_BASELINE_MIN_SAMPLES):
+        fresh_metrics.observe("gemini.files_api_ms", 4000)
+
+    gemini_service._prepare_file_part("receipt.jpg", b"x" * 1000)
+
+    assert fresh_metrics.percentile("gemini.inline_saved_ms", 50) > 3900
+
+
+@pytest.fixture
+def hedging(fresh_metrics, monkeypatch):
+    """ヘッジを有効にし、重複送信までの待ち時間が 0.05 秒になるようサンプルを入れる"""
+    monkeypatch.setattr(config, "GEMINI_HEDGE_ENABLED", True)
+    monkeypatch.setattr(config, "GEMINI_HEDGE_MIN_SAMPLES", 5)
+    monkeypatch.setattr(config, "GEMINI_HEDGE_MIN_DELAY_SECONDS", 0.05)
+    monkeypatch.setattr(config, "GEMINI_HEDGE_BUDGET", 1.0)
+    for _ in range(5):
+        fresh_metrics.observe("gemini.attempt_ms.test", 1)
+    return fresh_metrics
+
+
+def calls_returning(*outcomes):
+    """呼び出しごとに (待ち時間, 結果または例外) を順に返す関数"""
+    remaining = list(outcomes)
+    lock = threading.Lock()
+
+    def func():
+        with lock:
+            seconds, outcome = remaining.pop(0)
+        time.sleep(seconds)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+    return func
+
+
+def test_hedge_needs_enough_samples(fresh_metrics, monkeypatch):
+    monkeypatch.setattr(config, "GEMINI_HEDGE_ENABLED", True)
+    monkeypatch.setattr(config, "GEMINI_HEDGE_MIN_SAMPLES", 5)
+
+    assert gemini_service._call_with_hedge(calls_returning((0, "ok")), "test") == "ok"
+    assert fresh_metrics.get_counter("gemini.hedge.eligible") == 1
+    assert fresh_metrics.get_counter("gemini.hedge.fired") == 0
+
+
+def test_fast_primary_does_not_hedge(hedging):
+    assert gemini_service._call_with_hedge(calls_returning((0, "ok")), "test") == "ok"
+    time.sleep(0.1)
+
+    assert hedging.get_counter("gemini.hedge.fired") == 0
+
+
+def test_primary_runs_on_callers_thread(hedging):
+    threads = []
+
+    def func():
+        threads.append(threading.current_thread())
+        return "ok"
+
+    gemini_service._call_with_hedge(func, "test")
+
+    assert threads == [threading.current_thread()]
+
+
+def test_primary_timeout_error_is_raised_without_hedge(hedging):
+    func = calls_returning((0, TimeoutError("deadline exceeded")))
+
+    with pytest.raises(TimeoutError):
+        gemini_service._call_with_hedge(func, "test")
+    assert hedging.get_counter("gemini.hedge.fired") == 0
+
+
+def test_slow_primary_sends_hedge_and_keeps_its_result(hedging):
+    func = calls_returning((0.3, "primary"), (0, "hedge"))
+
+    assert gemini_service._call_with_hedge(func, "test") == "primary"
+    assert hedging.get_counter("gemini.hedge.fired") == 1
+    assert hedging.get_counter("gemini.hedge.wins") == 1
+
+
+def test_failed_primary_is_rescued_by_hedge(hedging):
+    func = calls_returning((0.3, RuntimeError("primary failed")), (0, "hedge"))
+
+    assert gemini_service._call_with_hedge(func, "test") == "hedge"
+    assert hedging.get_counter("gemini.hedge.rescued") == 1
+
+
+def test_both_failing_raises_primary_error(hedging):
+    func = calls_returning((0.3, RuntimeError("primary failed")), (0, ValueError("hedge failed")))
+
+    with pytest.raises(RuntimeError):
+        gemini_service._call_with_hedge(func, "test")
+
+
+def test_hedge_budget_limits_fired_hedges(hedging, monkeypatch):
+    monkeypatch.setattr(config, "GEMINI_HEDGE_BUDGET", 0.5)
+
+    gemini_service._call_with_hedge(calls_returning((0.2, "primary"), (0, "hedge")), "test")
+
+    # 1件目は予算（1件 × 0.5）を超えるため送らない
+    assert hedging.get_counter("gemini.hedge.fired") == 0
+    assert hedging.get_counter("gemini.hedge.budget_exhausted") == 1
+
+    # 2件目は予算内（1件目の応答時間が入り、待ち時間は 0.2 秒になる）
+    gemini_service._call_with_hedge(calls_returning((0.6, "primary"), (0, "hedge")), "test")
+
+    assert hedging.get_counter("gemini.hedge.fired") == 1
+
+
+GOOD = {"date": "2026-03-15", "vendor_name": "テスト商店", "total_amount": 1200}
+NO_AMOUNT = {"date": "2026-03-15", "vendor_name": "テスト商店", "total_amount": 0}
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self.text = json.dumps(data, ensure_ascii=False)
+
+
+@pytest.fixture
+def gemini(fresh_metrics, monkeypatch):
+    """モデル呼び出しを差し替え、呼び出したモデル名を記録する（batch: まとめて解析の応答 / single: 1件ずつの応答）"""
+    calls = []
+    responses = {"batch": [], "fast-model": [GOOD], "pro-model": [GOOD]}
+
+    def fake_generate(model_name, parts, generation_config=None):
+        kind = "batch" if generation_config is gemini_service.BATCH_GENERATION_CONFIG else model_name
+        calls.append(kind)
+        return FakeResponse(responses[kind])
+
+    monkeypatch.setattr(gemini_service, "_generate", fake_generate)
+    monkeypatch.setattr(gemini_service, "get_plan_models", lambda plan=None: {"fast": "fast-model", "pro": "pro-model"})
+    monkeypatch.setattr(config, "ANALYSIS_CACHE_ENABLED", False)
+    monkeypatch.setattr(config, "GEMINI_HEDGE_ENABLED", False)
+    return calls, responses
+
+
+def make_images(tmp_path, count: int) -> list:
+    paths = []
+    for i in range(count):
+        path = tmp_path / f"receipt{i}.jpg"
+        path.write_bytes(bytes([i]) * 100)
+        paths.append(str(path))
+    return paths
+
+
+def test_batch_results_are_used_and_counted_as_fast_calls(gemini, tmp_path):
+    calls, responses = gemini
+    responses["batch"] = [{"image_index": 1, "receipts": [GOOD]}, {"image_index": 2, "receipts": [GOOD]}]
+
+    results = gemini_service.analyze_batch_with_gemini(make_images(tmp_path, 2))
+
+    assert [r[0]["total_amount"] for r in results] == [1200, 1200]
+    assert calls == ["batch"]
+    assert metrics.get_counter("gemini.tier.fast.calls") == 2
+
+
+def test_escalated_batch_image_goes_straight_to_pro(gemini, tmp_path):
+    calls, responses = gemini
+    responses["batch"] = [{"image_index": 1, "receipts": [GOOD]}, {"image_index": 2, "receipts": [NO_AMOUNT]}]
+
+    results = gemini_service.analyze_batch_with_gemini(make_images(tmp_path, 2))
+
+    assert [r[0]["total_amount"] for r in results] == [1200, 1200]
+    assert calls == ["batch", "pro-model"]
+    assert metrics.get_counter("gemini.escalations") == 1
+    assert metrics.get_counter("gemini.escalation.missing_amount") == 1
+    assert gemini_service.get_routing_stats()["escalation_rate"] == 0.5
+
+
+def test_image_missing_from_batch_is_analyzed_from_fast(gemini, tmp_path):
+    calls, responses = gemini
+    responses["batch"] = [{"image_index": 1, "receipts": [GOOD]}]
+
+    gemini_service.analyze_batch_with_gemini(make_images(tmp_path, 2))
+
+    assert calls == ["batch", "fast-model"]
+    assert metrics.get_counter("gemini.batch.fallbacks") == 1
+    assert metrics.get_counter("gemini.escalations") == 0
+
+
+def test_failed_batch_falls_back_to_single_requests(gemini, tmp_path, monkeypatch):
+    calls, responses = gemini
+    responses["batch"] = "not a list"
+    monkeypatch.setattr(gemini_service, "_backoff_seconds", lambda kind, attempt: 0)
+
+    results = gemini_service.analyze_batch_with_gemini(make_images(tmp_path, 2), max_retries=1)
+
+    assert [r[0]["total_amount"] for r in results] == [1200, 1200]
+    assert calls == ["batch", "fast-model", "fast-model"]
+
+
+def test_quota_backoff_releases_analysis_slot(fresh_metrics, monkeypatch):
+    monkeypatch.setattr(gemini_service, "_backoff_seconds", lambda kind, attempt: 0)
+    func = calls_returning((0, google_exceptions.ResourceExhausted("quota")), (0, "ok"))
+
+    with FairScheduler(1).slot("user_a"):
+        assert gemini_service._run_stage("generate", func, max_retries=2) == "ok"
+
+    assert fresh_metrics.get_counter("scheduler.suspended") == 1
+
+
+def receipt(**fields) -> Receipt:
+    return Receipt.model_validate({**GOOD, **fields})
+
+
+def test_escalation_reason_accepts_complete_receipt():
+    assert gemini_service.escalation_reason([receipt(confidence=0.95)]) is None
+
+
+@pytest.mark.parametrize("receipts, reason", [
+    ([], "empty"),
+    (None, "empty"),
+    ([{"date": ""}], "missing_date"),
+    ([{"total_amount": 0}], "missing_amount"),
+    ([{"items": [{"date": "2026-03-15", "amount": 500}, {"date": "2026-03-16", "amount": 600}]}], "items_total_mismatch"),
+    ([{"date": "1996-03-15"}], "date_corrected"),
+    ([{"confidence": 0.5}], "low_confidence"),
+])
+def test_escalation_reasons(receipts, reason):
+    if receipts is not None:
+        receipts = [receipt(**fields) for fields in receipts]
+
+    assert gemini_service.escalation_reason(receipts) == reason
+
+
+def test_escalation_reason_checks_every_receipt():
+    assert gemini_service.escalation_reason([receipt(), receipt(total_amount=0)]) == "missing_amount"
+
+
+def test_items_matching_total_do_not_escalate():
+    items = [{"date": "2026-03-15", "amount": 500}, {"date": "2026-03-16", "amount": 700}]
+
+    assert gemini_service.escalation_reason([receipt(items=items)]) is None
+
+
+def test_confidence_threshold_is_configurable(monkeypatch):
+    monkeypatch.setattr(config, "GEMINI_ESCALATION_CONFIDENCE", 0.4)
+
+    assert gemini_service.escalation_reason([receipt(confidence=0.5)]) is None
@@ -0,0 +1,114 @@
+"""
+画像処理（services/image_service.py）のテスト
+予算に合わせたエンコードと、解析前処理（切り抜き・傾き補正・コントラスト調整）を合成画像で確かめる。
+"""
+import numpy as np
+from PIL import Image, ImageDraw
+from services import image_service
+import config
+
+
+def noise_image(width: int, height: int) -> Image.Image:
+    """圧縮しにくい画像（乱数の画素）"""
+    rng = np.random.default_rng(0)
+    return Image.fromarray(rng.integers(0, 256, (height, width, 3), dtype=np.uint8))
+
+
+def receipt_page(width: int, height: int, paper: int = 255, ink: int = 0) -> Image.Image:
+    """文字行に見立てた横線が並ぶ紙"""
+    img = Image.new("L", (width, height), paper)
+    draw = ImageDraw.Draw(img)
+    for y in range(height // 10, height - height // 10, max(4, height // 25)):
+        draw.rectangle((width // 10, y, width - width // 10, y + max(1, height // 100)), fill=ink)
+    return img
+
+
+def test_encode_keeps_max_quality_within_budget(monkeypatch):
+    monkeypatch.setattr(config, "IMAGE_BYTE_BUDGET", 10 * 1024 * 1024)
+
+    data, quality, img = image_service._encode_within_budget(noise_image(200, 150), "JPEG", 85)
+
+    assert quality == 85
+    assert img.size == (200, 150)
+    assert len(data) <= config.IMAGE_BYTE_BUDGET
+
+
+def test_encode_lowers_quality_to_fit_budget(monkeypatch):
+    image = noise_image(300, 200)
+    at_max = len(image_service._encode(image, "JPEG", 85))
+    at_min = len(image_service._encode(image, "JPEG", config.IMAGE_MIN_QUALITY))
+    monkeypatch.setattr(config, "IMAGE_BYTE_BUDGET", (at_max + at_min) // 2)
+
+    data, quality, img = image_service._encode_within_budget(image, "JPEG", 85)
+
+    assert config.IMAGE_MIN_QUALITY <= quality < 85
+    assert len(data) <= config.IMAGE_BYTE_BUDGET
+    assert img.size == (300, 200)
+    # 1段階上の画質では予算を超える（収まる中で最も高い画質）
+    assert len(image_service._encode(image, "JPEG", quality + 1)) > config.IMAGE_BYTE_BUDGET
+
+
+def test_encode_downscales_but_keeps_text_resolution(monkeypatch):
+    monkeypatch.setattr(config, "IMAGE_BYTE_BUDGET", 1024)
+    monkeypatch.setattr(config, "IMAGE_MIN_TEXT_LONG_SIDE_PX", 200)
+
+    data, quality, img = image_service._encode_within_budget(noise_image(400, 300), "JPEG", 85)
+
+    assert quality == config.IMAGE_MIN_QUALITY
+    assert 200 <= max(img.size) < 400
+
+
+def test_prepare_crops_receipt_from_background(tmp_path):
+    photo = Image.new("L", (800, 600), 60)
+    photo.paste(receipt_page(300, 400), (250, 100))
+    path = tmp_path / "photo.jpg"
+    photo.convert("RGB").save(path, quality=95)
+
+    stats = image_service.prepare_for_analysis(str(path))
+
+    assert stats["cropped"] is True
+    assert stats["path"].endswith("_analysis.jpg")
+    with Image.open(stats["path"]) as prepared:
+        assert 300 <= prepared.width < 400
+        assert 400 <= prepared.height < 500
+
+
+def test_prepare_skips_clean_scan(tmp_path):
+    path = tmp_path / "scan.jpg"
+    receipt_page(600, 800).convert("RGB").save(path, quality=95)
+
+    stats = image_service.prepare_for_analysis(str(path))
+
+    assert stats["skipped"] is True
+    assert stats["path"] == str(path)
+
+
+def test_prepare_stretches_faded_receipt(tmp_path):
+    path = tmp_path / "faded.jpg"
+    receipt_page(600, 800, paper=190, ink=120).convert("RGB").save(path, quality=95)
+
+    stats = image_service.prepare_for_analysis(str(path))
+
+    assert stats["contrast"] is True
+    with Image.open(stats["path"]) as prepared:
+        low, high = np.percentile(np.asarray(prepared.convert("L")), (1, 99))
+    assert high - low > 160
+
+
+def test_prepare_straightens_tilted_receipt(tmp_path):
+    path = tmp_path / "tilted.jpg"
+    receipt_page(600, 800).rotate(4, resample=Image.Resampling.BICUBIC, fillcolor=255).convert("RGB").save(path, quality=95)
+
+    stats = image_service.prepare_for_analysis(str(path))
+
+    assert abs(abs(stats["angle"]) - 4) <= 1
+
+
+def test_prepare_falls_back_to_original_on_error(tmp_path):
+    path = tmp_path / "broken.jpg"
+    path.write_bytes(b"not an image")
+
+    stats = image_service.prepare_for_analysis(str(path))
+
+    assert stats["path"] == str(path)
+    assert "error" in stats
@@ -0,0 +1,124 @@
+"""
+アップロードジョブ（services/job_service.py）の進捗・状態遷移のテスト
+解析処理は差し替え、ジョブ状態はプロセス内メモリ（LocalJobStore）に保持する。
+"""
+import asyncio
+import threading
+import pytest
+from services import job_service
+from services.job_service import LocalJobStore, enqueue_job, get_job
+from services.scheduler import FairScheduler
+import config
+
+
+@pytest.fixture
+def jobs(monkeypatch):
+    """ファイル名が bad で始まるものを解析失敗にする処理に差し替え（gate をセットすると処理中で止める）"""
+    gate = threading.Event()
+    gate.set()
+
+    def fake_process(u_id, saved_list, plan=None):
+        gate.wait(5)
+        return [
+            {"filename": saved["original_filename"], "status": "error" if saved["original_filename"].startswith("bad") else "success"}
+            for saved in saved_list
+        ]
+
+    monkeypatch.setattr(job_service, "job_store", LocalJobStore())
+    monkeypatch.setattr(job_service, "process_receipt_batch", fake_process)
+    monkeypatch.setattr(job_service, "analysis_scheduler", FairScheduler(2))
+    monkeypatch.setattr(config, "GEMINI_BATCH_SIZE", 2)
+    return gate
+
+
+def saved(name: str) -> dict:
+    return {"original_filename": name, "safe_filename": name, "temp_path": f"/tmp/{name}"}
+
+
+async def finish_all():
+    await asyncio.gather(*list(job_service._tasks))
+
+
+def test_job_completes_with_per_file_results(jobs):
+    async def run():
+        job = await enqueue_job("user_a", [saved("a.jpg"), saved("b.jpg"), saved("c.pdf")])
+        assert job["status"] == "queued"
+        await finish_all()
+        return get_job(job["id"], "user_a")
+
+    job = asyncio.run(run())
+
+    assert job["status"] == "completed"
+    assert job["processed"] == 3
+    assert [f["status"] for f in job["files"]] == ["success", "success", "success"]
+    assert job["id"] not in job_service._progress
+
+
+def test_job_shows_running_while_processing(jobs):
+    jobs.clear()
+
+    async def run():
+        job = await enqueue_job("user_a", [saved("a.jpg")])
+        for _ in range(100):
+            current = get_job(job["id"], "user_a")
+            if current["status"] == "running":
+                break
+            await asyncio.sleep(0.01)
+        jobs.set()
+        await finish_all()
+        return current
+
+    current = asyncio.run(run())
+
+    assert current["status"] == "running"
+    assert current["files"][0]["status"] == "processing"
+    assert current["processed"] == 0
+
+
+def test_partial_failure_still_completes(jobs):
+    async def run():
+        job = await enqueue_job("user_a", [saved("a.jpg"), saved("bad.jpg")])
+        await finish_all()
+        return get_job(job["id"], "user_a")
+
+    job = asyncio.run(run())
+
+    assert job["status"] == "completed"
+    assert [f["status"] for f in job["files"]] == ["success", "error"]
+
+
+def test_job_fails_when_every_file_fails(jobs):
+    failed = {0: {"filename": "broken.jpg", "status": "error", "error": "保存に失敗しました"}}
+
+    async def run():
+        job = await enqueue_job("user_a", [saved("bad.jpg")], failed_files=failed)
+        assert job["processed"] == 1
+        await finish_all()
+        return get_job(job["id"], "user_a")
+
+    job = asyncio.run(run())
+
+    assert job["status"] == "failed"
+    assert job["processed"] == 2
+    assert [f["filename"] for f in job["files"]] == ["broken.jpg", "bad.jpg"]
+
+
+def test_job_with_only_failed_files_is_failed_immediately(jobs):
+    failed = {0: {"filename": "broken.jpg", "status": "error", "error": "保存に失敗しました"}}
+
+    job = asyncio.run(enqueue_job("user_a", [], failed_files=failed))
+
+    assert job["status"] == "failed"
+    assert job["id"] not in job_service._progress
+
+
+def test_other_users_cannot_read_job(jobs):
+    async def run():
+        job = await enqueue_job("user_a", [saved("a.jpg")])
+        await finish_all()
+        return job
+
+    job = asyncio.run(run())
+
+    assert get_job(job["id"], "user_b") is None
+    assert get_job("missing", "user_a") is None
@@ -0,0 +1,105 @@
+"""
+レコードキャッシュ（services/record_cache.py）の変更監視のテスト
+"""
+import pytest
+from services import record_cache
+import config
+
+
+class FakeSnapshot:
+    def __init__(self, data):
+        self._data = data
+        self.exists = data is not None
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+
+class FakeWatch:
+    def unsubscribe(self):
+        pass
+
+
+class FakeDocument:
+    """on_snapshot に渡されたコールバックを保持し、テストから通知を送る"""
+
+    def __init__(self):
+        self.callback = None
+
+    def collection(self, name):
+        return self
+
+    def document(self, doc_id):
+        return self
+
+    def on_snapshot(self, callback):
+        self.callback = callback
+        return FakeWatch()
+
+    def notify(self, data):
+        self.callback([FakeSnapshot(data)], [], None)
+
+
+@pytest.fixture
+def aggregates(monkeypatch):
+    document = FakeDocument()
+    monkeypatch.setattr(record_cache, "db", document)
+    monkeypatch.setattr(config, "RECORD_CACHE_LISTEN", True)
+    monkeypatch.setattr(config, "RECORD_CACHE_ENABLED", True)
+    yield document
+    record_cache.invalidate("u1")
+
+
+def load(records):
+    with record_cache._lock:
+        generation = record_cache._generations.get("u1", 0)
+    record_cache._store("u1", records, generation)
+
+
+def test_own_write_keeps_patched_entry(aggregates):
+    load([{"id": "r1", "exported": False}])
+    aggregates.notify({"version": 3, "write_token": "someone-else"})
+
+    token = record_cache.new_write_token()
+    record_cache.patch_records("u1", ["r1"], {"exported": True})
+    aggregates.notify({"version": 4, "write_token": token})
+
+    assert record_cache._lookup("u1") == {"r1": {"id": "r1", "exported": True}}
+
+
+def test_remote_write_invalidates(aggregates):
+    load([{"id": "r1"}])
+    aggregates.notify({"version": 3, "write_token": "someone-else"})
+
+    aggregates.notify({"version": 4, "write_token": "another-instance"})
+
+    assert record_cache._lookup("u1") is None
+
+
+def test_remote_write_merged_into_own_notification_invalidates(aggregates):
+    load([{"id": "r1"}])
+    aggregates.notify({"version": 3, "write_token": "someone-else"})
+
+    # 他インスタンスの書き込み（4）と自分の書き込み（5）が1回の通知にまとまった場合
+    token = record_cache.new_write_token()
+    aggregates.notify({"version": 5, "write_token": token})
+
+    assert record_cache._lookup("u1") is None
+
+
+def test_first_write_to_new_aggregates_document(aggregates):
+    load([])
+    aggregates.notify(None)
+
+    token = record_cache.new_write_token()
+    aggregates.notify({"version": 1, "write_token": token})
+
+    assert record_cache._lookup("u1") == {}
+
+
+def test_own_write_tokens_are_bounded(monkeypatch):
+    monkeypatch.setattr(record_cache, "OWN_WRITES_LIMIT", 3)
+    tokens = [record_cache.new_write_token() for _ in range(5)]
+
+    assert not record_cache._is_own_write({"version": 1, "write_token": tokens[0]}, 0)
+    assert record_cache._is_own_write({"version": 1, "write_token": tokens[-1]}, 0)
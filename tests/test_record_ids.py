@@ -0,0 +1,64 @@
+"""
+レコードID生成（utils/helpers.py の generate_record_id）のテスト
+"""
+import re
+import threading
+from utils import helpers
+from utils.helpers import generate_record_id
+
+ID_PATTERN = re.compile(r"^\d{13}\d{4}[0-9a-hjkmnp-tv-z]{6}$")
+
+
+def test_format():
+    record_id = generate_record_id()
+
+    assert ID_PATTERN.match(record_id)
+
+
+def test_ids_are_strictly_increasing():
+    ids = [generate_record_id() for _ in range(5000)]
+
+    assert all(a < b for a, b in zip(ids, ids[1:]))
+
+
+def test_ids_are_unique_across_threads():
+    ids = []
+    lock = threading.Lock()
+
+    def worker():
+        local = [generate_record_id() for _ in range(5000)]
+        with lock:
+            ids.extend(local)
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(ids) == 20000
+    assert len(set(ids)) == 20000
+
+
+def test_order_survives_clock_going_backwards(monkeypatch):
+    first = generate_record_id()
+    monkeypatch.setattr(helpers.time, "time", lambda: 1_000_000_000.0)
+
+    assert generate_record_id() > first
+
+
+def test_sequence_overflow_advances_timestamp(monkeypatch):
+    """1ミリ秒内の連番を使い切っても順序と形式を保つ"""
+    frozen = (helpers._id_last_ms + 1000) / 1000
+    monkeypatch.setattr(helpers.time, "time", lambda: frozen)
+    ids = [generate_record_id() for _ in range(10 ** helpers._ID_SEQUENCE_DIGITS + 5)]
+
+    assert all(a < b for a, b in zip(ids, ids[1:]))
+    assert all(ID_PATTERN.match(record_id) for record_id in ids[-10:])
+
+
+def test_sorts_after_legacy_ids():
+    """従来の13桁（ミリ秒時刻）のIDとも時刻順に並ぶ"""
+    legacy = "1700000000000"
+
+    assert generate_record_id() > legacy
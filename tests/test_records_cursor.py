@@ -0,0 +1,32 @@
+"""
+レコード一覧のカーソル（database.py の encode/decode_records_cursor）のテスト
+"""
+import pytest
+from database import encode_records_cursor, decode_records_cursor
+
+
+@pytest.mark.parametrize("value", ["2026-01-31", 12800, None, "交通費", 0])
+def test_round_trip(value):
+    cursor = encode_records_cursor(value, "17000000000000000abcdef")
+
+    assert decode_records_cursor(cursor) == {"v": value, "id": "17000000000000000abcdef"}
+
+
+def test_cursor_is_url_safe():
+    cursor = encode_records_cursor("駐車場?&=/+", "id/with+chars")
+
+    assert "=" not in cursor
+    assert all(c.isalnum() or c in "-_" for c in cursor)
+    assert decode_records_cursor(cursor)["id"] == "id/with+chars"
+
+
+def test_id_is_returned_as_string():
+    cursor = encode_records_cursor(1, 123)
+
+    assert decode_records_cursor(cursor)["id"] == "123"
+
+
+@pytest.mark.parametrize("cursor", ["", "not-a-cursor", "e30", "!!!", encode_records_cursor("x", "y")[:-3]])
+def test_invalid_cursor_raises_value_error(cursor):
+    with pytest.raises(ValueError):
+        decode_records_cursor(cursor)
@@ -0,0 +1,221 @@
+"""
+解析スケジューラー（services/scheduler.py）のテスト
+"""
+import time
+import asyncio
+import threading
+from services.scheduler import FairScheduler, SlotLease, slot_released, LANE_INTERACTIVE, LANE_BULK
+
+
+class Recorder:
+    """実行枠が割り当てられた順番を記録する"""
+
+    def __init__(self, scheduler: FairScheduler):
+        self.scheduler = scheduler
+        self.granted = []
+        self.waiters = {}
+
+    def submit(self, name: str, u_id: str, plan: str = "free", lane: str = LANE_BULK):
+        waiter = self.scheduler._enqueue(u_id, plan, lane, lambda: self.granted.append(name))
+        self.waiters[name] = waiter
+        return waiter
+
+    def finish(self, waiter):
+        self.scheduler._release(waiter)
+
+
+def _run_in_order(recorder: Recorder) -> list:
+    """割り当てられた順に1件ずつ完了させ、割り当て順を返す"""
+    finished = 0
+    while finished < len(recorder.granted):
+        recorder.finish(recorder.waiters[recorder.granted[finished]])
+        finished += 1
+    return recorder.granted
+
+
+def test_equal_weight_users_alternate():
+    """同じプランのユーザーは、先に大量投入したユーザーがいても交互に実行される"""
+    recorder = Recorder(FairScheduler(1))
+    for i in range(4):
+        recorder.submit(f"a{i}", "user_a")
+    for i in range(4):
+        recorder.submit(f"b{i}", "user_b")
+
+    order = _run_in_order(recorder)
+
+    assert [name[0] for name in order] == ["a", "b", "a", "b", "a", "b", "a", "b"]
+
+
+def test_weight_gives_proportional_share():
+    """重み2のプランは重み1のプランのおよそ2倍の枠を得る"""
+    recorder = Recorder(FairScheduler(1))
+    for i in range(6):
+        recorder.submit(f"f{i}", "user_free", "free")
+    for i in range(6):
+        recorder.submit(f"p{i}", "user_premium", "premium")
+
+    order = _run_in_order(recorder)
+
+    assert len(order) == 12
+    first = order[:6]
+    assert sum(1 for name in first if name.startswith("p")) == 4
+    assert sum(1 for name in first if name.startswith("f")) == 2
+
+
+def test_per_user_concurrency_limit():
+    """ユーザーごとの同時実行数はプランの上限まで（空き枠は他のユーザーに回る）"""
+    scheduler = FairScheduler(4)
+    recorder = Recorder(scheduler)
+    for i in range(3):
+        recorder.submit(f"a{i}", "user_a", "free")
+    recorder.submit("b0", "user_b", "free")
+
+    # free の max_concurrent は2
+    assert sorted(recorder.granted) == ["a0", "a1", "b0"]
+
+
+def test_interactive_lane_takes_priority():
+    """待機中の bulk より後から来た interactive が先に実行される"""
+    recorder = Recorder(FairScheduler(1))
+    running = recorder.submit("bulk0", "user_a", "premium", LANE_BULK)
+    recorder.submit("bulk1", "user_a", "premium", LANE_BULK)
+    recorder.submit("line", "user_b", "free", LANE_INTERACTIVE)
+
+    recorder.finish(running)
+
+    assert recorder.granted == ["bulk0", "line"]
+
+
+def test_interactive_reserved_slots_are_not_used_by_bulk():
+    """bulk は interactive 専用の枠を使わない"""
+    scheduler = FairScheduler(3, interactive_reserved_slots=1)
+    recorder = Recorder(scheduler)
+    for i in range(4):
+        recorder.submit(f"bulk{i}", f"user_{i}", "free", LANE_BULK)
+
+    assert len(recorder.granted) == 2
+    recorder.submit("line", "user_x", "free", LANE_INTERACTIVE)
+    assert recorder.granted[-1] == "line"
+
+
+def test_bulk_reserved_slots_prevent_starvation():
+    """interactive が途切れなく続いても、待機中の bulk には予約分の枠が回る"""
+    scheduler = FairScheduler(4, interactive_reserved_slots=1, bulk_reserved_slots=1)
+    recorder = Recorder(scheduler)
+    for i in range(8):
+        recorder.submit(f"i{i}", f"user_i{i}", "free", LANE_INTERACTIVE)
+    recorder.submit("bulk0", "user_b", "free", LANE_BULK)
+
+    # bulk が来る前の interactive は全枠を使える
+    assert recorder.granted == ["i0", "i1", "i2", "i3"]
+
+    recorder.finish(recorder.waiters["i0"])
+    assert recorder.granted[-1] == "bulk0"
+    assert scheduler.get_state()["lanes"][LANE_BULK]["running"] == 1
+
+
+def test_bulk_reserved_slots_unused_without_bulk():
+    """bulk が待機していなければ interactive は全枠を使える"""
+    recorder = Recorder(FairScheduler(4, interactive_reserved_slots=1, bulk_reserved_slots=2))
+    for i in range(4):
+        recorder.submit(f"i{i}", f"user_{i}", "free", LANE_INTERACTIVE)
+
+    assert len(recorder.granted) == 4
+
+
+def test_reserved_slots_are_clamped():
+    """予約枠はレーンごとに最低1枠を残すよう丸められる"""
+    scheduler = FairScheduler(2, interactive_reserved_slots=5, bulk_reserved_slots=5)
+
+    assert scheduler.interactive_reserved_slots == 1
+    assert scheduler.bulk_reserved_slots == 1
+
+
+def test_cancelled_waiter_leaves_queue():
+    """待機中に取り消された処理はキューから外れ、枠を消費しない"""
+    scheduler = FairScheduler(1)
+    recorder = Recorder(scheduler)
+    running = recorder.submit("a0", "user_a")
+    cancelled = recorder.submit("b0", "user_b")
+    recorder.submit("c0", "user_c")
+
+    recorder.finish(cancelled)
+    recorder.finish(running)
+
+    assert recorder.granted == ["a0", "c0"]
+    assert scheduler.get_state()["in_use"] == 1
+
+
+def _run_released(scheduler: FairScheduler, released: threading.Event, resume: threading.Event, done: threading.Event):
+    """枠を確保し、slot_released の間に resume を待ってから終わるスレッド"""
+    def run():
+        with scheduler.slot("user_a"):
+            with slot_released():
+                released.set()
+                resume.wait(5)
+        done.set()
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+def test_released_slot_lets_others_run_and_is_reacquired(fresh_metrics):
+    """枠を手放している間は他の処理が動き、戻る際は空きを待って取り直す"""
+    scheduler = FairScheduler(1)
+    recorder = Recorder(scheduler)
+    released, resume, done = threading.Event(), threading.Event(), threading.Event()
+    thread = _run_released(scheduler, released, resume, done)
+    assert released.wait(5)
+
+    other = recorder.submit("b0", "user_b")
+    assert recorder.granted == ["b0"]
+
+    resume.set()
+    assert not done.wait(0.1)
+    recorder.finish(other)
+    thread.join(5)
+
+    assert done.is_set()
+    assert scheduler.get_state()["in_use"] == 0
+    # 手放した分は完了として数えない
+    assert fresh_metrics.get_counter("scheduler.lane.bulk.completed") == 2
+
+
+def test_slot_released_outside_slot_does_nothing():
+    with slot_released():
+        pass
+
+
+def test_bound_function_can_release_async_slot():
+    """async_slot の枠は lease.bind した関数の中から手放せる"""
+    scheduler = FairScheduler(1)
+    recorder = Recorder(scheduler)
+
+    def work():
+        with slot_released():
+            recorder.finish(recorder.submit("b0", "user_b"))
+        return recorder.granted[:]
+
+    async def run():
+        async with scheduler.async_slot("user_a") as lease:
+            return await asyncio.get_running_loop().run_in_executor(None, lease.bind(work))
+
+    assert asyncio.run(run()) == ["b0"]
+
+
+def test_closing_lease_wakes_thread_waiting_to_reacquire():
+    """並び直しの待機中に枠を返した場合（取り消しなど）は待機中のスレッドを起こす"""
+    scheduler = FairScheduler(1)
+    recorder = Recorder(scheduler)
+    lease = SlotLease(scheduler, recorder.submit("a0", "user_a"))
+    first = lease.suspend()
+    recorder.submit("b0", "user_b")
+
+    thread = threading.Thread(target=lease.resume, args=(first,), daemon=True)
+    thread.start()
+    time.sleep(0.05)
+    lease.close()
+    thread.join(5)
+
+    assert not thread.is_alive()
+    assert scheduler.get_state()["in_use"] == 1
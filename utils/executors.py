@@ -0,0 +1,140 @@
+"""
+実行プール管理
+ブロッキング処理をイベントループの外で実行する
+"""
+import asyncio
+import functools
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import config
+
+_db_executor = None
+_hedge_executor = None
+_image_executor = None
+_analysis_executor = None
+_line_executor = None
+# 初回呼び出しが複数のスレッドから同時に来てもプールを1つだけ生成する
+_executors_lock = threading.Lock()
+
+
+def get_db_executor() -> ThreadPoolExecutor:
+    """Firestore用スレッドプールを取得（初回呼び出し時に生成）"""
+    global _db_executor
+    if _db_executor is None:
+        with _executors_lock:
+            if _db_executor is None:
+                _db_executor = ThreadPoolExecutor(
+                    max_workers=config.DB_EXECUTOR_WORKERS,
+                    thread_name_prefix="firestore"
+                )
+    return _db_executor
+
+
+async def run_db(func, *args, **kwargs):
+    """ブロッキングなFirestore呼び出しをスレッドプールで実行して待機"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_db_executor(), functools.partial(func, *args, **kwargs))
+
+
+def get_hedge_executor() -> ThreadPoolExecutor:
+    """Geminiのヘッジリクエスト用スレッドプールを取得（初回呼び出し時に生成）"""
+    global _hedge_executor
+    if _hedge_executor is None:
+        with _executors_lock:
+            if _hedge_executor is None:
+                _hedge_executor = ThreadPoolExecutor(
+                    max_workers=config.GEMINI_HEDGE_WORKERS,
+                    thread_name_prefix="gemini-hedge"
+                )
+    return _hedge_executor
+
+
+def get_image_executor() -> ProcessPoolExecutor:
+    """画像処理（Pillow・PDF描画）用プロセスプールを取得（初回呼び出し時に生成）
+
+    gRPCなどのスレッドを持つ親プロセスをforkしないよう spawn で起動する。
+    """
+    global _image_executor
+    if _image_executor is None:
+        with _executors_lock:
+            if _image_executor is None:
+                _image_executor = ProcessPoolExecutor(
+                    max_workers=config.IMAGE_EXECUTOR_WORKERS,
+                    mp_context=multiprocessing.get_context("spawn")
+                )
+    return _image_executor
+
+
+async def run_image(func, *args, **kwargs):
+    """CPU負荷の高い画像処理をプロセスプールで実行して待機（引数・戻り値はpickle可能なもの）"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_image_executor(), functools.partial(func, *args, **kwargs))
+
+
+def get_analysis_executor() -> ThreadPoolExecutor:
+    """解析（アップロード1単位の処理）用スレッドプールを取得（初回呼び出し時に生成）
+
+    解析枠を確保してから投入する。レート制限のバックオフ中は枠を手放してスレッドだけが待機するため、
+    その間に枠を得た処理も待たされないよう枠数の2倍のスレッドを用意する。
+    既定のスレッドプール（asyncio.to_thread）の空きに左右されないよう専用にする。
+    """
+    global _analysis_executor
+    if _analysis_executor is None:
+        with _executors_lock:
+            if _analysis_executor is None:
+                _analysis_executor = ThreadPoolExecutor(
+                    max_workers=config.ANALYSIS_SLOTS * 2,
+                    thread_name_prefix="analysis"
+                )
+    return _analysis_executor
+
+
+async def run_analysis(func, *args, **kwargs):
+    """解析枠を確保済みの処理を解析用スレッドプールで実行して待機"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_analysis_executor(), functools.partial(func, *args, **kwargs))
+
+
+def get_line_executor() -> ThreadPoolExecutor:
+    """LINE Webhook処理用スレッドプールを取得（初回呼び出し時に生成）
+
+    画像メッセージの処理は解析枠が空くまでスレッドをブロックして待つため、
+    他の処理と共有する既定のスレッドプールを使い切らないよう専用にする。
+    """
+    global _line_executor
+    if _line_executor is None:
+        with _executors_lock:
+            if _line_executor is None:
+                _line_executor = ThreadPoolExecutor(
+                    max_workers=config.LINE_WEBHOOK_WORKERS,
+                    thread_name_prefix="line-webhook"
+                )
+    return _line_executor
+
+
+async def run_line(func, *args, **kwargs):
+    """LINE Webhookのハンドラーを専用スレッドプールで実行して待機"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_line_executor(), functools.partial(func, *args, **kwargs))
+
+
+def shutdown_executors():
+    """スレッドプール・プロセスプールを終了"""
+    global _db_executor, _hedge_executor, _image_executor, _analysis_executor, _line_executor
+    with _executors_lock:
+        if _db_executor is not None:
+            _db_executor.shutdown(wait=False)
+            _db_executor = None
+        if _hedge_executor is not None:
+            _hedge_executor.shutdown(wait=False)
+            _hedge_executor = None
+        if _image_executor is not None:
+            _image_executor.shutdown(wait=False, cancel_futures=True)
+            _image_executor = None
+        if _analysis_executor is not None:
+            _analysis_executor.shutdown(wait=False)
+            _analysis_executor = None
+        if _line_executor is not None:
+            _line_executor.shutdown(wait=False)
+            _line_executor = None
@@ -1,8 +1,11 @@
 """
 共通ヘルパー関数
 """
+import time
 import random
 import string
+import secrets
+import threading
 from database import db
 import config
 
@@ -10,6 +13,39 @@ def generate_user_id() -> str:
     """ユニークなユーザーIDを生成"""
     return 'user_' + ''.join(random.choices(string.ascii_lowercase + string.digits, k=12))
 
+# レコードID用（Crockford Base32 の小文字。ASCII順と値の順序が一致する）
+_ID_ALPHABET = "0123456789abcdefghjkmnpqrstvwxyz"
+_ID_SEQUENCE_DIGITS = 4
+_id_lock = threading.Lock()
+_id_last_ms = 0
+_id_sequence = 0
+
+
+def generate_record_id() -> str:
+    """時刻順に並ぶ重複しないレコードIDを生成
+
+    形式は「13桁のミリ秒時刻 + 4桁の連番 + 6文字のランダム値」。
+    同じミリ秒内は連番で区別し（プロセス内で単調増加）、インスタンス間の重複はランダム値で防ぐ。
+    時計が戻った場合も直前の時刻を使い続けるため、順序は逆転しない。
+    文字列の辞書順が作成順になり、従来の13桁のIDとも時刻順に並ぶ。
+    """
+    global _id_last_ms, _id_sequence
+    with _id_lock:
+        now_ms = int(time.time() * 1000)
+        if now_ms > _id_last_ms:
+            _id_last_ms = now_ms
+            _id_sequence = 0
+        else:
+            _id_sequence += 1
+            if _id_sequence >= 10 ** _ID_SEQUENCE_DIGITS:
+                # 1ミリ秒内の連番を使い切った場合は時刻を1ミリ秒進める
+                _id_last_ms += 1
+                _id_sequence = 0
+        timestamp, sequence = _id_last_ms, _id_sequence
+    suffix = ''.join(secrets.choice(_ID_ALPHABET) for _ in range(6))
+    return f"{timestamp:013d}{sequence:0{_ID_SEQUENCE_DIGITS}d}{suffix}"
+
+
 def generate_token(length=8) -> str:
     """LINE連携用トークンを生成"""
     return ''.join(random.choices(string.ascii_uppercase + string.digits, k=length))
@@ -0,0 +1,106 @@
+"""
+メトリクス集計
+カウンターと所要時間をプロセス内で集計する
+"""
+import threading
+from collections import deque
+
+# 所要時間の分位点計算に使う直近サンプル数
+TIMING_WINDOW = 1000
+# ヒストグラムの既定の区切り（ミリ秒）
+DEFAULT_BUCKETS_MS = (50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+
+_lock = threading.Lock()
+_counters = {}
+_timings = {}
+_histograms = {}
+
+
+def incr(name: str, value: float = 1):
+    """カウンターを加算"""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def observe(name: str, value: float):
+    """所要時間などの観測値を記録"""
+    with _lock:
+        timing = _timings.get(name)
+        if timing is None:
+            timing = {"count": 0, "sum": 0.0, "min": value, "max": value, "samples": deque(maxlen=TIMING_WINDOW)}
+            _timings[name] = timing
+        timing["count"] += 1
+        timing["sum"] += value
+        timing["min"] = min(timing["min"], value)
+        timing["max"] = max(timing["max"], value)
+        timing["samples"].append(value)
+
+
+def histogram(name: str, value: float, buckets: tuple = DEFAULT_BUCKETS_MS):
+    """観測値を区切りごとの件数として記録（上限以下の最小の区切りに加算、超えたら "+Inf"）"""
+    with _lock:
+        hist = _histograms.get(name)
+        if hist is None:
+            hist = {"buckets": tuple(buckets), "counts": [0] * (len(buckets) + 1)}
+            _histograms[name] = hist
+        for i, bound in enumerate(hist["buckets"]):
+            if value <= bound:
+                hist["counts"][i] += 1
+                break
+        else:
+            hist["counts"][-1] += 1
+
+
+def get_counter(name: str) -> float:
+    """カウンターの現在値を取得"""
+    with _lock:
+        return _counters.get(name, 0)
+
+
+def sample_count(name: str) -> int:
+    """直近サンプル数を取得"""
+    with _lock:
+        timing = _timings.get(name)
+        return len(timing["samples"]) if timing else 0
+
+
+def percentile(name: str, q: float):
+    """直近サンプルの分位点を取得（q: 0〜100、サンプルがなければNone）"""
+    with _lock:
+        timing = _timings.get(name)
+        if not timing or not timing["samples"]:
+            return None
+        samples = sorted(timing["samples"])
+    index = min(len(samples) - 1, int(len(samples) * q / 100))
+    return samples[index]
+
+
+def ratio(numerator: str, denominator: str):
+    """2つのカウンターの比率（分母が0ならNone）"""
+    with _lock:
+        total = _counters.get(denominator, 0)
+        return _counters.get(numerator, 0) / total if total else None
+
+
+def snapshot() -> dict:
+    """全メトリクスのスナップショットを取得"""
+    with _lock:
+        counters = dict(_counters)
+        timings = {name: (t, sorted(t["samples"])) for name, t in _timings.items()}
+        histograms = {
+            name: dict(zip([str(b) for b in h["buckets"]] + ["+Inf"], h["counts"]))
+            for name, h in _histograms.items()
+        }
+
+    summary = {}
+    for name, (t, samples) in timings.items():
+        summary[name] = {
+            "count": t["count"],
+            "avg": round(t["sum"] / t["count"], 2),
+            "min": round(t["min"], 2),
+            "max": round(t["max"], 2),
+            "p50": round(samples[len(samples) // 2], 2),
+            "p95": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 2),
+            "p99": round(samples[min(len(samples) - 1, int(len(samples) * 0.99))], 2),
+        }
+    return {"counters": counters, "timings": summary, "histograms": histograms}